@@ -1,24 +1,48 @@
+import time
+_import_started = time.perf_counter()  # Para el informe de arranque (ver /stats)
 import base64
+import json
+import sys
 from datetime import datetime
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Request, Query
 from pydantic import BaseModel
-import requests
+import httpx
 import os
-from pptx import Presentation
 import logging
-from typing import Optional, List
+from typing import Optional, List, Union, Callable
+import io
+import tempfile
 import uuid
+import queue
+import threading
+import hashlib
+import sqlite3
+import zlib
+import importlib
+import zipfile
+import shutil
+import math
+import re
+import unicodedata
+import random
+import contextvars
+import argparse
+import subprocess
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict, deque
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from starlette.background import BackgroundTask
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from starlette.middleware.sessions import SessionMiddleware
 import uvicorn
 from fastapi import File, UploadFile
-import fitz
-import torch
-import easyocr
-from PIL import Image
-from docx import Document
-import openpyxl
+import numpy as np
+# Las librerías de cada formato (fitz, python-docx, python-pptx, openpyxl, PIL, easyOCR/torch)
+# se importan al usarse por primera vez, ver FORMAT_HANDLERS
 
 
 
@@ -27,210 +51,3344 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Configuración desde variables de entorno
-OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")  # Uno o varios servidores separados por comas
+OLLAMA_HOSTS = [host.strip() for host in OLLAMA_HOST.split(",") if host.strip()]
 MODEL_NAME = os.getenv("MODEL_NAME", "gemma3:12b") # mistral, phi4, llama3, llama3.2, gemma3:12b, gemma3:27b
+MODEL_SMALL = os.getenv("MODEL_SMALL", "")  # Modelo pequeño para prompts cortos sin documento (p. ej. llama3.2), vacío = siempre MODEL_NAME
+MODEL_SMALL_MAX_TOKENS = int(os.getenv("MODEL_SMALL_MAX_TOKENS", "1000"))  # Tamaño máximo del prompt (en tokens) para usar MODEL_SMALL
+OLLAMA_HEALTH_INTERVAL = float(os.getenv("OLLAMA_HEALTH_INTERVAL", "15"))  # Segundos entre comprobaciones de /api/tags
+OLLAMA_AFFINITY_SLACK = int(os.getenv("OLLAMA_AFFINITY_SLACK", "2"))  # Peticiones de más que se toleran para mantener una sesión en su servidor
+
+OLLAMA_API = os.getenv("OLLAMA_API", "chat")  # chat (/api/chat) o generate (/api/generate, para versiones antiguas de Ollama)
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")  # Tiempo que Ollama mantiene el modelo (y su caché de prompt) cargado
+OLLAMA_WARM = os.getenv("OLLAMA_WARM", "true").lower() in ("1", "true", "yes")  # Cargar los modelos al arrancar y mantenerlos cargados aunque no haya peticiones
+OLLAMA_WARM_INTERVAL = float(os.getenv("OLLAMA_WARM_INTERVAL", "300"))  # Segundos entre avisos de keep_alive (menos que OLLAMA_KEEP_ALIVE)
+OLLAMA_WARM_MODELS = [model.strip() for model in os.getenv("OLLAMA_WARM_MODELS", "").split(",") if model.strip()]  # Modelos que se mantienen cargados, vacío = MODEL_NAME, MODEL_SMALL y HISTORY_SUMMARY_MODEL
+SPECULATIVE_PREFILL = os.getenv("SPECULATIVE_PREFILL", "true").lower() in ("1", "true", "yes")  # Al subir un archivo, adelantar en Ollama la lectura del prompt del siguiente turno
+NUM_CTX = int(os.getenv("NUM_CTX", "8192"))  # Tamaño de contexto del modelo en tokens (prompt + respuesta)
+GENERATION_TEMPERATURE = float(os.getenv("GENERATION_TEMPERATURE", "0.5"))  # Temperatura por defecto de las respuestas
+
+# Control de admisión de generaciones en Ollama
+OLLAMA_MAX_CONCURRENCY = int(os.getenv("OLLAMA_MAX_CONCURRENCY", str(2 * len(OLLAMA_HOSTS))))  # Generaciones simultáneas enviadas a Ollama
+OLLAMA_MAX_QUEUE = int(os.getenv("OLLAMA_MAX_QUEUE", "32"))  # Peticiones en espera antes de responder 429
+OLLAMA_QUEUE_TIMEOUT = float(os.getenv("OLLAMA_QUEUE_TIMEOUT", "60"))  # Segundos máximos en cola antes de responder 503
+
+# Caché de respuestas del modelo para prompts idénticos
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "512"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))  # Segundos que se conserva una respuesta
+RESPONSE_CACHE_NONZERO_TEMPERATURE = os.getenv("RESPONSE_CACHE_NONZERO_TEMPERATURE", "false").lower() in ("1", "true", "yes")  # Cachear también si temperatura > 0
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "5"))  # Segundos para conectar con Ollama
+OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", "300"))  # Segundos máximos esperando la respuesta del modelo
+OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "20"))  # Conexiones abiertas con Ollama (keep-alive)
+OLLAMA_RETRIES = int(os.getenv("OLLAMA_RETRIES", "2"))  # Reintentos ante errores 5xx o de conexión
+OLLAMA_RETRY_BACKOFF = float(os.getenv("OLLAMA_RETRY_BACKOFF", "0.5"))  # Espera inicial entre reintentos, se duplica en cada uno
+
+# Configuración del OCR (easyOCR)
+OCR_LANGS = [lang.strip() for lang in os.getenv("OCR_LANGS", "es,en").split(",") if lang.strip()]
+OCR_POOL_SIZE = max(1, int(os.getenv("OCR_POOL_SIZE", "1")))  # Lectores por idioma, ajustar al número de workers que hacen OCR
+OCR_PRELOAD = os.getenv("OCR_PRELOAD", "false").lower() in ("1", "true", "yes")  # Cargar el modelo al arrancar en vez de en el primer uso
+EXTRACT_WARMUP = [fmt.strip() for fmt in os.getenv("EXTRACT_WARMUP", "").split(",") if fmt.strip()]  # Formatos cuyas librerías se importan al arrancar (p. ej. "pdf,docx" o "all"), vacío = al primer uso
+OCR_MAX_SIDE = int(os.getenv("OCR_MAX_SIDE", "2000"))  # Lado máximo (px) de las imágenes que entran al OCR, las mayores se reducen (0 = sin límite)
+OCR_BATCH_SIZE = max(1, int(os.getenv("OCR_BATCH_SIZE", "8")))  # Imágenes (o páginas escaneadas) que se pasan juntas a easyOCR
+OCR_BUCKET_PX = max(1, int(os.getenv("OCR_BUCKET_PX", "128")))  # Las imágenes cuyo tamaño difiere menos que esto se rellenan para ir en el mismo lote
+OCR_SKIP_TEXTLESS = os.getenv("OCR_SKIP_TEXTLESS", "false").lower() in ("1", "true", "yes")  # Saltar las imágenes que parecen no tener texto (fotos)
+OCR_TEXTLESS_THRESHOLD = float(os.getenv("OCR_TEXTLESS_THRESHOLD", "0.25"))  # Proporción de bordes nítidos por debajo de la que se considera que no hay texto
+
+# Configuración de la extracción de texto de archivos
+EXTRACTOR_VERSION = "4"  # Cambiar cuando cambie la forma de extraer el texto para invalidar la caché
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))  # Procesos de extracción, 0 = hilos en este proceso
+EXTRACT_MAX_QUEUE = int(os.getenv("EXTRACT_MAX_QUEUE", "16"))  # Extracciones en curso o en espera antes de responder 429
+EXTRACT_SERVICE = os.getenv("EXTRACT_SERVICE", "")  # Servicio de extracción compartido ("unix:/ruta.sock" o "http://host:puerto"), vacío = extraer en este proceso
+EXTRACT_SERVICE_TIMEOUT = float(os.getenv("EXTRACT_SERVICE_TIMEOUT", "600"))  # Segundos máximos esperando una extracción del servicio
+MAX_FILE_CHARS = int(os.getenv("MAX_FILE_CHARS", "8000"))  # Caracteres que se extraen por defecto de cada archivo
+MAX_FILE_CHARS_LIMIT = int(os.getenv("MAX_FILE_CHARS_LIMIT", "200000"))  # Máximo que se puede pedir con ?max_chars=
+UPLOAD_SPOOL_THRESHOLD = int(os.getenv("UPLOAD_SPOOL_THRESHOLD", str(16 * 1024 * 1024)))  # Bytes a partir de los que la subida se vuelca a un archivo temporal
+UPLOAD_TMP_DIR = os.getenv("UPLOAD_TMP_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir())  # Carpeta de los temporales (mejor en tmpfs)
+UPLOAD_BATCH_CONCURRENCY = int(os.getenv("UPLOAD_BATCH_CONCURRENCY", str(max(EXTRACT_WORKERS, 1))))  # Archivos de un mismo lote que se extraen a la vez
+UPLOAD_BATCH_MAX_FILES = int(os.getenv("UPLOAD_BATCH_MAX_FILES", "500"))  # Archivos por lote (contando los de dentro de los zip)
+UPLOAD_ZIP_MAX_BYTES = int(os.getenv("UPLOAD_ZIP_MAX_BYTES", str(1024 * 1024 * 1024)))  # Tamaño máximo descomprimido de un zip
+INGEST_MAX_JOBS = int(os.getenv("INGEST_MAX_JOBS", "100"))  # Trabajos de /ingest terminados que se conservan para consultar su estado
+EXTRACT_LIMITS = {  # Extracciones simultáneas por formato, p. ej. "pdf=2,imagen=1"
+    fmt.strip(): int(limit)
+    for fmt, limit in (item.split("=") for item in os.getenv("EXTRACT_LIMITS", "imagen=1").split(",") if "=" in item)
+}
+XLSX_MAX_ROWS = int(os.getenv("XLSX_MAX_ROWS", "5000"))  # Filas que se leen de cada hoja de un XLSX
+XLSX_MAX_COLS = int(os.getenv("XLSX_MAX_COLS", "50"))  # Columnas que se leen de cada hoja de un XLSX
+XLSX_FORMAT = os.getenv("XLSX_FORMAT", "tsv")  # tsv o markdown: cómo se convierten las hojas en texto
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "16"))  # Páginas de cada trozo de PDF que se manda a un worker
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "32"))  # Páginas a partir de las que un PDF se reparte entre workers
+PDF_PARALLEL_MIN_BYTES = int(os.getenv("PDF_PARALLEL_MIN_BYTES", str(1024 * 1024)))  # Tamaño a partir del que se cuentan las páginas de un PDF para repartirlo (los pequeños van en una tarea)
+PDF_OCR = os.getenv("PDF_OCR", "true").lower() in ("1", "true", "yes")  # Pasar por OCR las páginas escaneadas (sin texto)
+PDF_OCR_MIN_CHARS = int(os.getenv("PDF_OCR_MIN_CHARS", "20"))  # Una página con imágenes y menos caracteres que esto se considera escaneada
+PDF_OCR_DPI = int(os.getenv("PDF_OCR_DPI", "200"))  # Resolución a la que se rasterizan las páginas escaneadas
+
+# Caché de textos extraídos (clave: SHA-256 del archivo + versión del extractor)
+EXTRACT_CACHE_MAX_ENTRIES = int(os.getenv("EXTRACT_CACHE_MAX_ENTRIES", "256"))  # Archivos guardados en memoria
+EXTRACT_CACHE_MAX_BYTES = int(os.getenv("EXTRACT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # Tamaño máximo en memoria
+EXTRACT_CACHE_TTL = float(os.getenv("EXTRACT_CACHE_TTL", str(7 * 24 * 3600)))  # Segundos que se conserva una entrada
+EXTRACT_CACHE_DB = os.getenv("EXTRACT_CACHE_DB", "")  # Ruta a un sqlite para conservar la caché entre reinicios (vacío = desactivado)
+EXTRACT_CACHE_DISK_MAX_BYTES = int(os.getenv("EXTRACT_CACHE_DISK_MAX_BYTES", str(1024 * 1024 * 1024)))  # Tamaño máximo en disco (comprimido)
+
+
+# Configuración de la búsqueda de fragmentos relevantes en los documentos subidos
+RAG_ENABLED = os.getenv("RAG_ENABLED", "true").lower() in ("1", "true", "yes")
+RAG_MAX_CHARS = int(os.getenv("RAG_MAX_CHARS", "200000"))  # Caracteres de cada documento que se indexan
+RAG_CHUNK_CHARS = int(os.getenv("RAG_CHUNK_CHARS", "1000"))  # Tamaño de cada fragmento
+RAG_CHUNK_OVERLAP = int(os.getenv("RAG_CHUNK_OVERLAP", "150"))  # Caracteres compartidos entre fragmentos consecutivos
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "4"))  # Fragmentos que se añaden al prompt
+RAG_MAX_DOCUMENTS = int(os.getenv("RAG_MAX_DOCUMENTS", "256"))  # Documentos indexados en memoria
+EMBED_MODEL = os.getenv("EMBED_MODEL", "")  # Modelo de embeddings de Ollama (p. ej. nomic-embed-text), vacío = solo BM25
+
+# Configuración de las sesiones
+HISTORY_TURNS = int(os.getenv("HISTORY_TURNS", "4"))  # Intercambios del historial que se incluyen en el prompt
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")  # memory o sqlite (compartido entre workers)
+SESSION_DB = os.getenv("SESSION_DB", "sessions.db")  # Ruta del sqlite de sesiones
+HISTORY_SUMMARY = os.getenv("HISTORY_SUMMARY", "true").lower() in ("1", "true", "yes")  # Resumir los intercambios que salen de HISTORY_TURNS en vez de olvidarlos
+HISTORY_SUMMARY_BATCH = max(1, int(os.getenv("HISTORY_SUMMARY_BATCH", "2")))  # Intercambios que se añaden al resumen de una vez
+HISTORY_SUMMARY_MAX_TOKENS = int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", "300"))  # Tamaño máximo del resumen en tokens
+HISTORY_SUMMARY_MODEL = os.getenv("HISTORY_SUMMARY_MODEL", "")  # Modelo que escribe los resúmenes, vacío = MODEL_SMALL o MODEL_NAME
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", str(HISTORY_TURNS + 2 * HISTORY_SUMMARY_BATCH)))  # Intercambios guardados por sesión
+SESSION_MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", "1000"))  # Sesiones guardadas a la vez (se expulsan las menos usadas)
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", str(2 * 3600)))  # Segundos sin actividad antes de borrar una sesión
+DOCUMENT_STORE_MAX_BYTES = int(os.getenv("DOCUMENT_STORE_MAX_BYTES", str(256 * 1024 * 1024)))  # Tamaño máximo de los textos del almacén de documentos (mismo backend que las sesiones)
+UNNAMED_DOCUMENT = "documento"  # Nombre con el que ve un documento del almacén una sesión que no lo subió
+
+# Configuración del apagado
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "30"))  # Segundos que se esperan las peticiones y los trabajos de /ingest en curso al apagar
+
+# Configuración de las métricas y el registro
+PROMPT_LOG_SAMPLE_RATE = float(os.getenv("PROMPT_LOG_SAMPLE_RATE", "0"))  # Fracción de peticiones cuyo prompt completo se escribe en el log (0 = ninguna, 1 = todas)
+SERVER_TIMING = os.getenv("SERVER_TIMING", "true").lower() in ("1", "true", "yes")  # Añadir la cabecera Server-Timing con la duración de cada etapa
+
+
+class Metrics:
+    """
+    Métricas en formato de texto de Prometheus (contadores e histogramas).
+
+    Las etiquetas tienen que tener pocos valores posibles (etapa, ruta, código de
+    estado...), nunca ids de sesión ni nombres de archivo.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}    # (nombre, etiquetas) -> valor
+        self._histograms = {}  # (nombre, etiquetas) -> [buckets, cuentas por bucket, suma, total]
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, buckets: tuple = BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [buckets, [0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(histogram[0]):
+                if value <= bound:
+                    histogram[1][i] += 1
+            histogram[2] += value
+            histogram[3] += 1
+
+    @staticmethod
+    def _labels(labels, extra: tuple = ()) -> str:
+        items = tuple(labels) + extra
+        if not items:
+            return ""
+        escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in items)
+        return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(items, escaped)) + "}"
+
+    def render(self, gauges: List[tuple] = ()) -> str:
+        """Texto para /metrics; `gauges` son (nombre, etiquetas, valor) calculados en el momento"""
+        lines = []
+        typed = set()
+
+        def declare(name: str, kind: str):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                declare(name, "counter")
+                lines.append(f"{name}{self._labels(labels)} {value:g}")
+            for (name, labels), (buckets, counts, total, count) in sorted(self._histograms.items()):
+                declare(name, "histogram")
+                for bound, bucket_count in zip(buckets, counts):
+                    lines.append(f"{name}_bucket{self._labels(labels, (('le', f'{bound:g}'),))} {bucket_count}")
+                lines.append(f"{name}_bucket{self._labels(labels, (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{self._labels(labels)} {total:g}")
+                lines.append(f"{name}_count{self._labels(labels)} {count}")
+        for name, labels, value in gauges:
+            declare(name, "gauge")
+            lines.append(f"{name}{self._labels(sorted(labels.items()))} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+# Etapas medidas en la petición en curso (etapa -> segundos acumulados)
+_trace = contextvars.ContextVar("trace", default=None)
+
+
+def record(stage: str, seconds: float):
+    """Suma `seconds` a la etapa `stage` de la traza en curso (si la hay)"""
+    stages = _trace.get()
+    if stages is not None:
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def span(stage: str):
+    """Mide el bloque y lo añade a la traza en curso como la etapa `stage`"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+@contextmanager
+def trace():
+    """Abre una traza nueva; al cerrarla, la duración de cada etapa se publica en las métricas"""
+    stages = {}
+    token = _trace.set(stages)
+    try:
+        yield stages
+    finally:
+        _trace.reset(token)
+        for stage, seconds in stages.items():
+            metrics.observe("app_stage_seconds", seconds, stage=stage)
+
+
+def traced(func, *args):
+    """
+    Ejecuta func(*args) con una traza propia y devuelve (resultado, etapas, contadores del proceso)
+
+    Se usa en los procesos de extracción, que no comparten las métricas con el servidor:
+    las etapas se devuelven junto al resultado y se suman con merge_trace(), y los
+    contadores del proceso (pool de OCR) se guardan por pid en el pipeline.
+    """
+    stages = {}
+    token = _trace.set(stages)
+    try:
+        return func(*args), stages, worker_stats()
+    finally:
+        _trace.reset(token)
+
+
+def merge_trace(stages: dict):
+    for stage, seconds in stages.items():
+        record(stage, seconds)
+
+
+class OCRReaderPool:
+    """
+    Pool de lectores de easyOCR compartido por todo el proceso.
+
+    Cargar un Reader lee de disco los pesos de detección y reconocimiento, así que
+    se crean como mucho `size` lectores por conjunto de idiomas y se reutilizan.
+    """
+
+    def __init__(self, size: int = 1):
+        self.size = size
+        self._lock = threading.Lock()
+        self._idle = {}     # idiomas -> cola de lectores libres
+        self._created = {}  # idiomas -> número de lectores creados
+        self.hits = 0
+        self.misses = 0
+        self.load_time = 0.0
+
+    def _load(self, langs: tuple):
+        import easyocr  # Importa torch: solo se paga en los procesos que hacen OCR
+
+        start = time.perf_counter()
+        reader = easyocr.Reader(list(langs))
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.load_time += elapsed
+        logger.info(f"Lector de easyOCR {list(langs)} cargado en {elapsed:.2f}s")
+        return reader
+
+    @contextmanager
+    def reader(self, langs: Optional[List[str]] = None):
+        """Presta un lector para los idiomas indicados y lo devuelve al pool al terminar"""
+        key = tuple(sorted(langs or OCR_LANGS))
+        with self._lock:
+            idle = self._idle.setdefault(key, queue.Queue())
+            try:
+                reader = idle.get_nowait()
+                self.hits += 1
+            except queue.Empty:
+                reader = None
+                create = self._created.get(key, 0) < self.size
+                if create:
+                    self._created[key] = self._created.get(key, 0) + 1
+                    self.misses += 1
+                else:
+                    self.hits += 1
+
+        if reader is None:
+            if create:
+                try:
+                    reader = self._load(key)
+                except Exception:
+                    with self._lock:
+                        self._created[key] -= 1
+                    raise
+            else:
+                # Todos los lectores están ocupados: esperar a que se libere uno
+                reader = idle.get()
+
+        try:
+            yield reader
+        finally:
+            idle.put(reader)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": self.size,
+                "readers": {",".join(key): count for key, count in self._created.items()},
+                "hits": self.hits,
+                "misses": self.misses,
+                "load_time_seconds": round(self.load_time, 3),
+            }
+
+
+ocr_pool = OCRReaderPool(size=OCR_POOL_SIZE)
+
+
+def worker_stats() -> dict:
+    """Contadores de este proceso que solo se ven desde él (los lectores de OCR viven en cada worker)"""
+    return {"pid": os.getpid(), "ocr": ocr_pool.stats()}
+
+
+def _entry_size(entry: dict) -> int:
+    """Tamaño aproximado en bytes de una entrada del historial"""
+    return sum(len(str(value)) for value in entry.values())
+
+
+class SessionStore(ABC):
+    """
+    Almacén de historiales de conversación.
+
+    Cada sesión guarda como mucho `max_entries` intercambios (los más antiguos se
+    descartan). Las sesiones sin actividad durante `idle_ttl` segundos se borran y,
+    si hay más de `max_sessions`, se expulsan las usadas hace más tiempo.
+    """
+
+    def __init__(self, max_entries: int, max_sessions: int, idle_ttl: float):
+        self.max_entries = max_entries
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.evicted = 0
+
+    @abstractmethod
+    def history(self, session_id: Optional[str]) -> List[dict]:
+        """Devuelve los intercambios guardados de la sesión, del más antiguo al más reciente"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def append(self, session_id: Optional[str], entry: dict):
+        """
+        Añade un intercambio al historial de la sesión
+
+        El almacén le asigna un número de orden (`seq`) que solo crece dentro de la sesión,
+        aunque se descarten los intercambios antiguos: el resumen guarda hasta cuál cubre.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def summary(self, session_id: Optional[str]) -> Optional[dict]:
+        """Devuelve el resumen de los intercambios antiguos ({"text", "through", "turns", "document_ids"}) o None"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_summary(self, session_id: Optional[str], summary: dict):
+        """Guarda el resumen de la sesión (si la sesión sigue existiendo)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def clear(self, session_id: Optional[str]):
+        """Borra el historial de la sesión"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def stats(self) -> dict:
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    """Historiales en memoria del proceso (no se comparten entre workers)"""
+
+    def __init__(self, max_entries: int, max_sessions: int, idle_ttl: float):
+        super().__init__(max_entries, max_sessions, idle_ttl)
+        self._sessions = OrderedDict()  # session_id -> {"entries": deque, "summary": dict, "seq": int, "last_access": float}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _drop(self, session_id):
+        session = self._sessions.pop(session_id)
+        self._bytes -= sum(_entry_size(entry) for entry in session["entries"])
+        if session["summary"] is not None:
+            self._bytes -= _entry_size(session["summary"])
+
+    def _evict(self, now: float):
+        # Las sesiones están ordenadas por último acceso, las inactivas están al principio
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if now - session["last_access"] <= self.idle_ttl and len(self._sessions) <= self.max_sessions:
+                break
+            self._drop(session_id)
+            self.evicted += 1
+
+    def history(self, session_id: Optional[str]) -> List[dict]:
+        now = time.time()
+        with self._lock:
+            self._evict(now)
+            session = self._sessions.get(session_id)
+            if session is None:
+                return []
+            session["last_access"] = now
+            self._sessions.move_to_end(session_id)
+            return list(session["entries"])
+
+    def append(self, session_id: Optional[str], entry: dict):
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = {"entries": deque(maxlen=self.max_entries), "summary": None, "seq": 0, "last_access": now}
+            session["seq"] += 1
+            entry = {**entry, "seq": session["seq"]}
+            entries = session["entries"]
+            if len(entries) == entries.maxlen:
+                self._bytes -= _entry_size(entries[0])
+            entries.append(entry)
+            self._bytes += _entry_size(entry)
+            session["last_access"] = now
+            self._sessions.move_to_end(session_id)
+            self._evict(now)
+
+    def summary(self, session_id: Optional[str]) -> Optional[dict]:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            return session["summary"] if session is not None else None
+
+    def set_summary(self, session_id: Optional[str], summary: dict):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return
+            if session["summary"] is not None:
+                self._bytes -= _entry_size(session["summary"])
+            session["summary"] = summary
+            self._bytes += _entry_size(summary)
+
+    def clear(self, session_id: Optional[str]):
+        with self._lock:
+            if session_id in self._sessions:
+                self._drop(session_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            summaries = sum(session["summary"] is not None for session in self._sessions.values())
+            return {"backend": "memory", "sessions": len(self._sessions), "summaries": summaries, "bytes": self._bytes, "evicted": self.evicted}
+
+
+class SqliteSessionStore(SessionStore):
+    """Historiales en un sqlite compartido por todos los workers de la máquina"""
+
+    def __init__(self, db_path: str, max_entries: int, max_sessions: int, idle_ttl: float):
+        super().__init__(max_entries, max_sessions, idle_ttl)
+        self.db_path = db_path
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, last_access REAL)")
+            db.execute("CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT, entry TEXT, size INTEGER)")
+            db.execute("CREATE INDEX IF NOT EXISTS history_session ON history (session_id, id)")
+            db.execute("CREATE TABLE IF NOT EXISTS summaries (session_id TEXT PRIMARY KEY, summary TEXT, size INTEGER)")
+
+    @contextmanager
+    def _connect(self):
+        """Abre una conexión con el sqlite, confirma los cambios y la cierra al terminar"""
+        db = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _evict(self, db: sqlite3.Connection, now: float):
+        expired = db.execute("SELECT session_id FROM sessions WHERE last_access < ?", (now - self.idle_ttl,)).fetchall()
+        excess = db.execute(
+            "SELECT session_id FROM sessions ORDER BY last_access DESC LIMIT -1 OFFSET ?", (self.max_sessions,)
+        ).fetchall()
+        for (session_id,) in set(expired + excess):
+            db.execute("DELETE FROM history WHERE session_id = ?", (session_id,))
+            db.execute("DELETE FROM summaries WHERE session_id = ?", (session_id,))
+            db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            self.evicted += 1
+
+    def history(self, session_id: Optional[str]) -> List[dict]:
+        session_id = session_id or ""
+        now = time.time()
+        with self._connect() as db:
+            self._evict(db, now)
+            db.execute("UPDATE sessions SET last_access = ? WHERE session_id = ?", (now, session_id))
+            rows = db.execute("SELECT id, entry FROM history WHERE session_id = ? ORDER BY id", (session_id,)).fetchall()
+        # El id autoincremental de la fila hace de número de orden del intercambio
+        return [{**json.loads(entry), "seq": seq} for seq, entry in rows]
+
+    def append(self, session_id: Optional[str], entry: dict):
+        session_id = session_id or ""
+        now = time.time()
+        with self._connect() as db:
+            db.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?)", (session_id, now))
+            db.execute("INSERT INTO history (session_id, entry, size) VALUES (?, ?, ?)", (session_id, json.dumps(entry, ensure_ascii=False), _entry_size(entry)))
+            # Conservar solo los últimos max_entries intercambios de la sesión
+            db.execute(
+                "DELETE FROM history WHERE session_id = ? AND id NOT IN (SELECT id FROM history WHERE session_id = ? ORDER BY id DESC LIMIT ?)",
+                (session_id, session_id, self.max_entries)
+            )
+            self._evict(db, now)
+
+    def summary(self, session_id: Optional[str]) -> Optional[dict]:
+        with self._connect() as db:
+            row = db.execute("SELECT summary FROM summaries WHERE session_id = ?", (session_id or "",)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_summary(self, session_id: Optional[str], summary: dict):
+        session_id = session_id or ""
+        with self._connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO summaries SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM sessions WHERE session_id = ?)",
+                (session_id, json.dumps(summary, ensure_ascii=False), _entry_size(summary), session_id)
+            )
+
+    def clear(self, session_id: Optional[str]):
+        session_id = session_id or ""
+        with self._connect() as db:
+            db.execute("DELETE FROM history WHERE session_id = ?", (session_id,))
+            db.execute("DELETE FROM summaries WHERE session_id = ?", (session_id,))
+            db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def stats(self) -> dict:
+        with self._connect() as db:
+            sessions = db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+            summaries, summary_size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM summaries").fetchone()
+            size = db.execute("SELECT COALESCE(SUM(size), 0) FROM history").fetchone()[0]
+        return {"backend": "sqlite", "sessions": sessions, "summaries": summaries, "bytes": size + summary_size, "evicted": self.evicted}
+
+
+def create_session_store() -> SessionStore:
+    """Crea el almacén de sesiones configurado en SESSION_BACKEND"""
+    if SESSION_BACKEND == "sqlite":
+        return SqliteSessionStore(SESSION_DB, SESSION_MAX_ENTRIES, SESSION_MAX_SESSIONS, SESSION_IDLE_TTL)
+    return MemorySessionStore(SESSION_MAX_ENTRIES, SESSION_MAX_SESSIONS, SESSION_IDLE_TTL)
+
+
+class DocumentStore(ABC):
+    """
+    Almacén de los textos de los documentos subidos, compartido por todas las sesiones.
+
+    Cada documento se guarda una sola vez, identificado por el hash de su texto, y las
+    sesiones lo referencian por ese id (document_id) en vez de reenviar y copiar el texto
+    en cada turno. El nombre y el tipo del archivo se guardan en la referencia de cada
+    sesión: dos sesiones que suben el mismo contenido comparten el texto pero cada una ve
+    su propio nombre. Una sesión mantiene su referencia mientras lo use en menos de
+    `idle_ttl` segundos. Si los textos superan `max_bytes` se expulsan primero los
+    documentos sin referencias y, si no basta, los usados hace más tiempo.
+    """
+
+    def __init__(self, max_bytes: int, idle_ttl: float):
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.deduplicated = 0
+        self.evicted = 0
+
+    @abstractmethod
+    def put(self, session_id: Optional[str], name: str, file_type: str, text: str, chars: int) -> str:
+        """
+        Guarda el documento (si no estaba) con una referencia de la sesión
+
+        `chars` son los caracteres que se pidieron al subirlo: los que se usan como
+        contexto cuando no se buscan fragmentos en el índice.
+
+        Returns:
+            str: Id del documento
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def get(self, session_id: Optional[str], doc_id: str) -> Optional[dict]:
+        """
+        Devuelve el documento ({"name", "file_type", "text", "chars"}) y renueva la referencia de la sesión
+
+        Si la sesión no lo había subido (usa el id de otra sesión) no se le muestra el nombre
+        con el que lo subió la otra: se usa UNNAMED_DOCUMENT.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def release(self, session_id: Optional[str]):
+        """Quita las referencias de la sesión"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def stats(self) -> dict:
+        raise NotImplementedError
+
+
+class MemoryDocumentStore(DocumentStore):
+    """Documentos en memoria del proceso (no se comparten entre workers)"""
+
+    def __init__(self, max_bytes: int, idle_ttl: float):
+        super().__init__(max_bytes, idle_ttl)
+        self._documents = OrderedDict()  # doc_id -> {"file_type", "text", "chars", "refs": {session_id: {"used", "name", "file_type"}}}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _referenced(self, document: dict, now: float) -> bool:
+        """Descarta las referencias caducadas e indica si le queda alguna"""
+        document["refs"] = {session_id: ref for session_id, ref in document["refs"].items() if now - ref["used"] <= self.idle_ttl}
+        return bool(document["refs"])
+
+    def _drop(self, doc_id: str):
+        self._bytes -= len(self._documents.pop(doc_id)["text"])
+        self.evicted += 1
+
+    def _evict(self, now: float, keep: str):
+        if self._bytes <= self.max_bytes:
+            return
+        # Los documentos están ordenados por último uso: primero los que ya no usa nadie
+        for doc_id in [doc_id for doc_id, document in self._documents.items() if doc_id != keep and not self._referenced(document, now)]:
+            self._drop(doc_id)
+            if self._bytes <= self.max_bytes:
+                return
+        for doc_id in [doc_id for doc_id in self._documents if doc_id != keep]:
+            self._drop(doc_id)
+            if self._bytes <= self.max_bytes:
+                return
+
+    def put(self, session_id: Optional[str], name: str, file_type: str, text: str, chars: int) -> str:
+        doc_id = document_hash(text)
+        now = time.time()
+        with self._lock:
+            document = self._documents.get(doc_id)
+            if document is None:
+                document = self._documents[doc_id] = {"file_type": file_type, "text": text, "chars": chars, "refs": {}}
+                self._bytes += len(text)
+            else:
+                document["chars"] = max(document["chars"], chars)
+                self.deduplicated += 1
+            document["refs"][session_id] = {"used": now, "name": name, "file_type": file_type}
+            self._documents.move_to_end(doc_id)
+            self._evict(now, doc_id)
+        return doc_id
+
+    def get(self, session_id: Optional[str], doc_id: str) -> Optional[dict]:
+        with self._lock:
+            document = self._documents.get(doc_id)
+            if document is None:
+                return None
+            ref = document["refs"].setdefault(session_id, {"name": UNNAMED_DOCUMENT, "file_type": document["file_type"]})
+            ref["used"] = time.time()
+            self._documents.move_to_end(doc_id)
+            return {"name": ref["name"], "file_type": ref["file_type"], "text": document["text"], "chars": document["chars"]}
+
+    def release(self, session_id: Optional[str]):
+        with self._lock:
+            for document in self._documents.values():
+                document["refs"].pop(session_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "backend": "memory",
+                "documents": len(self._documents),
+                "bytes": self._bytes,
+                "references": sum(len(document["refs"]) for document in self._documents.values()),
+                "deduplicated": self.deduplicated,
+                "evicted": self.evicted,
+            }
+
+
+class SqliteDocumentStore(DocumentStore):
+    """Documentos (comprimidos) en el sqlite de las sesiones, compartidos por todos los workers"""
+
+    def __init__(self, db_path: str, max_bytes: int, idle_ttl: float):
+        super().__init__(max_bytes, idle_ttl)
+        self.db_path = db_path
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS documents (doc_id TEXT PRIMARY KEY, file_type TEXT, text BLOB, chars INTEGER, size INTEGER, accessed REAL)")
+            db.execute("CREATE TABLE IF NOT EXISTS document_refs (doc_id TEXT, session_id TEXT, last_used REAL, name TEXT, file_type TEXT, PRIMARY KEY (doc_id, session_id))")
+            # Bases creadas cuando el nombre se guardaba en el documento compartido
+            columns = {row[1] for row in db.execute("PRAGMA table_info(document_refs)")}
+            for column in ("name", "file_type"):
+                if column not in columns:
+                    db.execute(f"ALTER TABLE document_refs ADD COLUMN {column} TEXT")
+            db.execute("CREATE INDEX IF NOT EXISTS document_refs_session ON document_refs (session_id)")
+
+    @contextmanager
+    def _connect(self):
+        """Abre una conexión con el sqlite, confirma los cambios y la cierra al terminar"""
+        db = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _evict(self, db: sqlite3.Connection, now: float, keep: str):
+        db.execute("DELETE FROM document_refs WHERE last_used < ?", (now - self.idle_ttl,))
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM documents").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Primero los documentos sin referencias y después los usados hace más tiempo
+        candidates = db.execute(
+            "SELECT doc_id, size FROM documents WHERE doc_id != ? "
+            "ORDER BY EXISTS (SELECT 1 FROM document_refs WHERE document_refs.doc_id = documents.doc_id), accessed",
+            (keep,)
+        ).fetchall()
+        for doc_id, size in candidates:
+            db.execute("DELETE FROM documents WHERE doc_id = ?", (doc_id,))
+            db.execute("DELETE FROM document_refs WHERE doc_id = ?", (doc_id,))
+            self.evicted += 1
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def put(self, session_id: Optional[str], name: str, file_type: str, text: str, chars: int) -> str:
+        doc_id = document_hash(text)
+        now = time.time()
+        with self._connect() as db:
+            updated = db.execute("UPDATE documents SET chars = MAX(chars, ?), accessed = ? WHERE doc_id = ?", (chars, now, doc_id)).rowcount
+            if updated:
+                self.deduplicated += 1
+            else:
+                db.execute(
+                    "INSERT INTO documents (doc_id, file_type, text, chars, size, accessed) VALUES (?, ?, ?, ?, ?, ?)",
+                    (doc_id, file_type, zlib.compress(text.encode("utf-8")), chars, len(text), now)
+                )
+            db.execute(
+                "INSERT OR REPLACE INTO document_refs (doc_id, session_id, last_used, name, file_type) VALUES (?, ?, ?, ?, ?)",
+                (doc_id, session_id or "", now, name, file_type)
+            )
+            self._evict(db, now, doc_id)
+        return doc_id
+
+    def get(self, session_id: Optional[str], doc_id: str) -> Optional[dict]:
+        now = time.time()
+        with self._connect() as db:
+            row = db.execute("SELECT file_type, text, chars FROM documents WHERE doc_id = ?", (doc_id,)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE documents SET accessed = ? WHERE doc_id = ?", (now, doc_id))
+            db.execute(
+                "INSERT INTO document_refs (doc_id, session_id, last_used, name, file_type) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (doc_id, session_id) DO UPDATE SET last_used = excluded.last_used",
+                (doc_id, session_id or "", now, UNNAMED_DOCUMENT, row[0])
+            )
+            name, file_type = db.execute(
+                "SELECT COALESCE(name, ?), COALESCE(file_type, ?) FROM document_refs WHERE doc_id = ? AND session_id = ?",
+                (UNNAMED_DOCUMENT, row[0], doc_id, session_id or "")
+            ).fetchone()
+        return {"name": name, "file_type": file_type, "text": zlib.decompress(row[1]).decode("utf-8"), "chars": row[2]}
+
+    def release(self, session_id: Optional[str]):
+        with self._connect() as db:
+            db.execute("DELETE FROM document_refs WHERE session_id = ?", (session_id or "",))
+
+    def stats(self) -> dict:
+        with self._connect() as db:
+            documents, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM documents").fetchone()
+            references = db.execute("SELECT COUNT(*) FROM document_refs").fetchone()[0]
+        return {
+            "backend": "sqlite",
+            "documents": documents,
+            "bytes": size,
+            "references": references,
+            "deduplicated": self.deduplicated,
+            "evicted": self.evicted,
+        }
+
+
+def create_document_store() -> DocumentStore:
+    """Crea el almacén de documentos con el mismo backend que las sesiones (SESSION_BACKEND)"""
+    if SESSION_BACKEND == "sqlite":
+        return SqliteDocumentStore(SESSION_DB, DOCUMENT_STORE_MAX_BYTES, SESSION_IDLE_TTL)
+    return MemoryDocumentStore(DOCUMENT_STORE_MAX_BYTES, SESSION_IDLE_TTL)
+
+
+ollama_client: Optional[httpx.AsyncClient] = None
+
+
+class OllamaBackend:
+    """Un servidor de Ollama con su estado de salud y las peticiones que tiene en curso"""
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.healthy = True
+        self.models = set()  # Modelos instalados según /api/tags (vacío = desconocido)
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+
+    def has_model(self, model: Optional[str]) -> bool:
+        return not self.models or not model or model in self.models or f"{model}:latest" in self.models
+
+    @contextmanager
+    def track(self):
+        """Cuenta la petición como pendiente mientras dura"""
+        self.outstanding += 1
+        self.requests += 1
+        try:
+            yield
+        finally:
+            self.outstanding -= 1
+
+    def stats(self) -> dict:
+        return {
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "models": sorted(self.models),
+        }
+
+
+class OllamaBackends:
+    """
+    Reparto de peticiones entre varios servidores de Ollama (OLLAMA_HOST separado por comas).
+
+    Se elige el servidor sano con menos peticiones pendientes que tenga el modelo, pero
+    cada sesión vuelve al mismo servidor mientras no esté mucho más cargado que el resto,
+    para aprovechar la caché del prompt que ya tiene. Un proceso en segundo plano consulta
+    /api/tags periódicamente para marcar los servidores caídos y saber qué modelos tienen.
+    """
+
+    def __init__(self, urls: List[str], affinity_slack: int, max_sessions: int):
+        self.backends = [OllamaBackend(url) for url in urls]
+        self.affinity_slack = affinity_slack
+        self.max_sessions = max_sessions
+        self._affinity = OrderedDict()  # session_id -> url del servidor
+
+    def choose(self, session_id: Optional[str], model: Optional[str], exclude: set = frozenset()) -> OllamaBackend:
+        candidates = [backend for backend in self.backends if backend.url not in exclude] or self.backends
+        candidates = [backend for backend in candidates if backend.healthy and backend.has_model(model)] or candidates
+        least = min(candidates, key=lambda backend: backend.outstanding)
+
+        preferred = self._affinity.get(session_id)
+        for backend in candidates:
+            if backend.url == preferred and backend.outstanding <= least.outstanding + self.affinity_slack:
+                least = backend
+                break
+
+        if session_id is not None:
+            self._affinity[session_id] = least.url
+            self._affinity.move_to_end(session_id)
+            while len(self._affinity) > self.max_sessions:
+                self._affinity.popitem(last=False)
+        return least
+
+    def has_alternative(self, exclude: set) -> bool:
+        return any(backend.healthy and backend.url not in exclude for backend in self.backends)
+
+    def mark_down(self, backend: OllamaBackend):
+        backend.healthy = False
+        backend.failures += 1
+
+    async def probe(self):
+        """Consulta /api/tags en todos los servidores y actualiza su estado"""
+        async def check(backend: OllamaBackend):
+            try:
+                response = await ollama_client.get(f"{backend.url}/api/tags", timeout=OLLAMA_CONNECT_TIMEOUT)
+                response.raise_for_status()
+                backend.models = {model["name"] for model in response.json().get("models", [])}
+                if not backend.healthy:
+                    logger.info(f"Ollama {backend.url} vuelve a estar disponible")
+                backend.healthy = True
+            except (httpx.HTTPError, ValueError) as e:
+                if backend.healthy:
+                    logger.warning(f"Ollama {backend.url} no responde: {e}")
+                backend.healthy = False
+
+        await asyncio.gather(*(check(backend) for backend in self.backends))
+
+    async def health_loop(self, interval: float):
+        while True:
+            await self.probe()
+            await asyncio.sleep(interval)
+
+    def stats(self) -> dict:
+        return {backend.url: backend.stats() for backend in self.backends}
+
+
+ollama_backends = OllamaBackends(OLLAMA_HOSTS, OLLAMA_AFFINITY_SLACK, SESSION_MAX_SESSIONS)
+
+
+async def ollama_post(path: str, payload: dict, headers: Optional[dict] = None, session_id: Optional[str] = None) -> httpx.Response:
+    """
+    Envía una petición POST a Ollama con el cliente compartido
+
+    Elige el servidor con OllamaBackends. Si responde 5xx o no se puede conectar se
+    reintenta en otro servidor y, si no quedan más, con espera exponencial.
+
+    Raises:
+        httpx.HTTPError: Si la petición sigue fallando tras los reintentos
+    """
+    delay = OLLAMA_RETRY_BACKOFF
+    tried = set()
+    for attempt in range(OLLAMA_RETRIES + 1):
+        backend = ollama_backends.choose(session_id, payload.get("model"), exclude=tried)
+        tried.add(backend.url)
+        try:
+            with backend.track():
+                response = await ollama_client.post(f"{backend.url}{path}", json=payload, headers=headers)
+            if response.status_code < 500 or attempt == OLLAMA_RETRIES:
+                response.raise_for_status()
+                return response
+            backend.failures += 1
+            logger.warning(f"Ollama {backend.url} respondió {response.status_code}, reintentando")
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError) as e:
+            ollama_backends.mark_down(backend)
+            if attempt == OLLAMA_RETRIES:
+                raise
+            logger.warning(f"Error conectando con Ollama {backend.url} ({e}), reintentando")
+        # Esperar solo si no queda otro servidor por probar
+        if not ollama_backends.has_alternative(tried):
+            await asyncio.sleep(delay)
+            delay *= 2
+
+
+async def ollama_stream(path: str, payload: dict, session_id: Optional[str] = None):
+    """
+    Envía una petición a Ollama en modo streaming y devuelve los fragmentos NDJSON
+
+    Solo se reintenta (en otro servidor si lo hay) si el error ocurre antes de recibir
+    el primer fragmento.
+
+    Raises:
+        httpx.HTTPError: Si la petición sigue fallando tras los reintentos
+    """
+    delay = OLLAMA_RETRY_BACKOFF
+    tried = set()
+    for attempt in range(OLLAMA_RETRIES + 1):
+        backend = ollama_backends.choose(session_id, payload.get("model"), exclude=tried)
+        tried.add(backend.url)
+        try:
+            with backend.track():
+                async with ollama_client.stream("POST", f"{backend.url}{path}", json=payload) as response:
+                    if response.status_code >= 500 and attempt < OLLAMA_RETRIES:
+                        backend.failures += 1
+                        logger.warning(f"Ollama {backend.url} respondió {response.status_code}, reintentando")
+                    else:
+                        response.raise_for_status()
+                        async for line in response.aiter_lines():
+                            if line.strip():
+                                yield json.loads(line)
+                        return
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            ollama_backends.mark_down(backend)
+            if attempt == OLLAMA_RETRIES:
+                raise
+            logger.warning(f"Error conectando con Ollama {backend.url} ({e}), reintentando")
+        if not ollama_backends.has_alternative(tried):
+            await asyncio.sleep(delay)
+            delay *= 2
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Inicialización y limpieza de recursos compartidos de la aplicación"""
+    global ollama_client
+    extraction_pipeline.start()
+    # Cliente HTTP compartido: reutiliza las conexiones con Ollama entre peticiones
+    ollama_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(OLLAMA_TIMEOUT, connect=OLLAMA_CONNECT_TIMEOUT),
+        limits=httpx.Limits(max_connections=OLLAMA_MAX_CONNECTIONS, max_keepalive_connections=OLLAMA_MAX_CONNECTIONS)
+    )
+    health_task = asyncio.create_task(ollama_backends.health_loop(OLLAMA_HEALTH_INTERVAL))
+    # Cargar los modelos en segundo plano: el servidor ya atiende mientras Ollama los lee de disco
+    warm_task = asyncio.create_task(model_warmer.run(OLLAMA_WARM_INTERVAL)) if OLLAMA_WARM else None
+    startup.mark_ready()
+    yield
+    # uvicorn ya ha dejado de aceptar peticiones y ha esperado a las que estaban en curso;
+    # los trabajos de /ingest tienen DRAIN_TIMEOUT segundos para terminar
+    health_task.cancel()
+    if warm_task is not None:
+        warm_task.cancel()
+    await ingest_jobs.drain(DRAIN_TIMEOUT)
+    history_compactor.shutdown()
+    model_warmer.shutdown()
+    await ollama_client.aclose()
+    await extraction_pipeline.aclose()
+
 
 app = FastAPI(
     title="Chat Inteligente sin Búsqueda",
     description="API que genera respuestas utilizando un modelo de lenguaje sin búsqueda web.",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
-# Configuración de archivos estáticos y templates
-app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
+# Configuración de archivos estáticos y templates (relativos a app.py, no al directorio actual)
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+app.mount("/static", StaticFiles(directory=os.path.join(APP_DIR, "static")), name="static")
+templates = Jinja2Templates(directory=os.path.join(APP_DIR, "templates"))
+
+# Configuración del middleware de sesiones
+app.add_middleware(SessionMiddleware, secret_key="vivan_las_practicas")
+
+
+class MetricsMiddleware:
+    """
+    Middleware ASGI que abre una traza por petición y mide su duración total
+
+    Se mide hasta que se envía el último byte, así en las respuestas en streaming se
+    cuenta la generación completa. Con SERVER_TIMING, las etapas medidas hasta que
+    empieza la respuesta se envían en la cabecera Server-Timing.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = {"code": 500}
+        with trace() as stages:
+            async def send_with_timing(message):
+                if message["type"] == "http.response.start":
+                    status["code"] = message["status"]
+                    if SERVER_TIMING and stages:
+                        timing = ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in stages.items())
+                        message["headers"] = list(message.get("headers", [])) + [(b"server-timing", timing.encode())]
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_timing)
+            finally:
+                # La ruta de la plantilla (/ingest/{job_id}) y no la URL, para no crear una serie por petición
+                route = getattr(scope.get("route"), "path", "other")
+                elapsed = time.perf_counter() - start
+                metrics.observe("http_request_duration_seconds", elapsed, method=scope["method"], path=route, status=str(status["code"]))
+
+
+app.add_middleware(MetricsMiddleware)
+
+# Almacén de los historiales de las sesiones (en memoria o en sqlite, ver SESSION_BACKEND)
+session_store = create_session_store()
+# Textos de los documentos subidos, referenciados por id desde las sesiones
+document_store = create_document_store()
+
+@app.get("/", include_in_schema=False)
+async def chat_interface(request: Request):
+    """
+    Endpoint principal que sirve la interfaz web de chat con manejo de sesión
+    
+    Args:
+        request (Request): Objeto de solicitud FastAPI
+    
+    Returns:
+        TemplateResponse: Renderiza la plantilla index.html
+    """
+    # Recuperar o generar un session_id
+    session_id = request.cookies.get("session_id")
+    
+    if not session_id:
+        session_id = str(uuid.uuid4())  # Generar un ID de sesión nuevo si no existe
+
+    # Limpiar historial anterior (si existiera)
+    await asyncio.to_thread(session_store.clear, session_id)
+    retrieval_index.clear(session_id)
+    await asyncio.to_thread(document_store.release, session_id)
+
+    # Establecer la cookie de la sesión
+    response = templates.TemplateResponse("index.html", {"request": request, "session_id": session_id})
+    response.set_cookie("session_id", session_id)
+    
+    return response
+
+@app.get("/stats")
+async def stats():
+    """
+    Endpoint con estadísticas internas del servidor
+    
+    Returns:
+        dict: Contadores de los recursos compartidos (pool de OCR, ...)
+    """
+    # Con sqlite los contadores de sesiones y documentos se leen del disco
+    return await asyncio.to_thread(collect_stats)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """
+    Endpoint con las métricas en formato de texto de Prometheus
+
+    Incluye los histogramas de latencia (total por ruta y por etapa: lectura de la
+    subida, extracción por formato, OCR, búsqueda, espera en cola, primer token de
+    Ollama...), los tokens generados y los contadores de /stats como gauges.
+
+    Returns:
+        PlainTextResponse: Métricas en formato de exposición de Prometheus
+    """
+    snapshot = await asyncio.to_thread(collect_stats)
+    return PlainTextResponse(metrics.render(stats_gauges(snapshot)), media_type="text/plain; version=0.0.4")
+
+
+def stats_gauges(snapshot: dict) -> List[tuple]:
+    """
+    Convierte los contadores de /stats en gauges (nombre, etiquetas, valor)
+
+    Los valores anidados se convierten en etiquetas: {"readers": {"es,en": 1}} pasa a
+    app_ocr_readers{name="es,en"} y {"http://...": {"healthy": true}} a
+    app_ollama_healthy{name="http://..."}.
+    """
+    gauges = []
+    for component, values in snapshot.items():
+        for key, value in values.items():
+            if isinstance(value, (bool, int, float)):
+                gauges.append((f"app_{component}_{key}", {}, float(value)))
+            elif isinstance(value, dict):
+                for inner_key, inner in value.items():
+                    if isinstance(inner, (bool, int, float)) and key.isidentifier():
+                        gauges.append((f"app_{component}_{key}", {"name": inner_key}, float(inner)))
+                    elif isinstance(inner, (bool, int, float)) and inner_key.isidentifier():
+                        gauges.append((f"app_{component}_{inner_key}", {"name": key}, float(inner)))
+    return gauges
+
+
+def collect_stats() -> dict:
+    return {
+        "ocr": extraction_pipeline.ocr_stats(),
+        "extraction": extraction_pipeline.stats(),
+        "extraction_cache": extraction_cache.stats(),
+        "sessions": session_store.stats(),
+        "documents": document_store.stats(),
+        "retrieval": retrieval_index.stats(),
+        "response_cache": response_cache.stats(),
+        "scheduler": scheduler.stats(),
+        "ollama": ollama_backends.stats(),
+        "ingest": ingest_jobs.stats(),
+        "history_summary": history_compactor.stats(),
+        "warmer": model_warmer.stats(),
+        "startup": startup.stats(),
+    }
+
+class PromptRequest(BaseModel):
+    """Modelo Pydantic para las solicitudes de generación de texto"""
+    prompt: str
+    max_tokens: Optional[int] = None
+    file_type: Optional[str] = None
+    file_name: Optional[str] = None
+    file_text: Optional[str] = None  
+    document_ids: Optional[List[str]] = None  # Ids devueltos por /upload_file: el texto se toma del almacén de documentos
+    temperature: Optional[float] = None  # Por defecto GENERATION_TEMPERATURE
+    use_cache: bool = True  # False para no usar la caché de respuestas
+    priority: int = 1  # Prioridad en la cola de generación: 1 normal, 2 baja (la 0 solo la usa el servidor)
+
+class SimplifiedResponse(BaseModel):
+    """Modelo Pydantic para las respuestas simplificadas"""
+    model: str
+    response: str
+    sources: Optional[List[str]] = None
+    context_used: bool = False
+
+
+FileSource = Union[str, bytes]  # Ruta a un archivo o su contenido en memoria
+
+
+def _as_file(source: FileSource):
+    """Devuelve algo que las librerías de Office puedan abrir: la ruta o un buffer en memoria"""
+    return io.BytesIO(source) if isinstance(source, bytes) else source
+
+
+def collect_text(chunks, max_chars: Optional[int] = None) -> str:
+    """
+    Junta los fragmentos de texto de un extractor hasta llegar a `max_chars` caracteres
+
+    En cuanto se alcanza el límite se deja de leer, así el tiempo y la memoria
+    dependen del límite y no del tamaño del archivo.
+    """
+    parts = []
+    total = 0
+    try:
+        for chunk in chunks:
+            if max_chars is not None and total + len(chunk) >= max_chars:
+                parts.append(chunk[:max_chars - total])
+                break
+            parts.append(chunk)
+            total += len(chunk)
+    finally:
+        chunks.close()  # Cierra el generador (y el documento abierto) si se corta antes de tiempo
+    return "".join(parts)
+
+
+def _open_pdf(source: FileSource):
+    import fitz
+
+    return fitz.open(stream=source, filetype="pdf") if isinstance(source, bytes) else fitz.open(source)
+
+
+def pdf_page_count(source: FileSource) -> int:
+    """Número de páginas de un PDF (solo lee la tabla de páginas, no el contenido); 0 si no se puede abrir"""
+    try:
+        with _open_pdf(source) as doc:
+            return doc.page_count
+    except Exception as e:
+        # El PDF lo leerá entero read_pdf, que ya devuelve "" si está dañado
+        logger.warning(f"No se pudieron contar las páginas del PDF: {str(e)}")
+        return 0
+
+
+def rasterize_pdf_page(page) -> np.ndarray:
+    """Rasteriza una página a PDF_OCR_DPI (reducida a OCR_MAX_SIDE si hace falta)"""
+    dpi = PDF_OCR_DPI
+    if OCR_MAX_SIDE:
+        longest = max(page.rect.width, page.rect.height) / 72 * dpi
+        if longest > OCR_MAX_SIDE:
+            dpi = int(dpi * OCR_MAX_SIDE / longest)
+    import fitz
+
+    pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csRGB, alpha=False)
+    return np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+
+
+def iter_pdf(source: FileSource, start: int = 0, stop: Optional[int] = None, max_chars: Optional[int] = None):
+    """
+    Genera el texto de un PDF página a página (solo las páginas [start, stop))
+
+    Las páginas sin apenas texto pero con imágenes (escaneadas) se rasterizan y se
+    pasan por OCR en lotes de OCR_BATCH_SIZE; el resto no se rasteriza. Las páginas
+    se devuelven siempre en orden, así que las de texto que van detrás de una escaneada
+    esperan a su lote; con `max_chars` el lote se cierra en cuanto esas páginas bastan
+    para llegar al límite, para no leer el resto del PDF sin poder cortar.
+    """
+    pending = []  # [texto, imagen a pasar por OCR o None] de las páginas aún sin devolver
+    scanned = 0
+    held = 0  # Caracteres de las páginas de texto retenidas en `pending`
+    emitted = 0
+
+    def flush():
+        images = [page[1] for page in pending if page[1] is not None]
+        try:
+            ocr_texts = iter(ocr_images(images))
+            for page in pending:
+                if page[1] is not None:
+                    page[0] = next(ocr_texts)
+        except Exception as e:
+            # Si falla el OCR se conserva lo que haya en las páginas y se sigue con las demás
+            logger.error(f"Error en el OCR de {len(images)} páginas del PDF: {str(e)}")
+        texts = [page[0] for page in pending]
+        pending.clear()
+        return texts
+
+    with _open_pdf(source) as doc:
+        for page in doc.pages(start, stop if stop is not None else doc.page_count):
+            text = page.get_text("text")
+            if PDF_OCR and len(text.strip()) < PDF_OCR_MIN_CHARS and page.get_images():
+                with span("pdf_rasterize"):
+                    pending.append([text, rasterize_pdf_page(page)])
+                scanned += 1
+            elif scanned:
+                pending.append([text, None])
+                held += len(text)
+            else:
+                emitted += len(text)
+                yield text
+                continue
+            if scanned >= OCR_BATCH_SIZE or (max_chars is not None and emitted + held >= max_chars):
+                for text in flush():
+                    emitted += len(text)
+                    yield text
+                scanned = held = 0
+        yield from flush()
+
+
+def iter_docx(source: FileSource):
+    """Genera el texto de un DOCX párrafo a párrafo"""
+    from docx import Document
+
+    doc = Document(_as_file(source))
+    for para in doc.paragraphs:
+        yield para.text + "\n"
+
+
+def iter_txt(source: FileSource, block_size: int = 64 * 1024):
+    """Genera el texto de un TXT en bloques"""
+    with (io.TextIOWrapper(io.BytesIO(source), encoding="utf-8") if isinstance(source, bytes) else open(source, 'r', encoding='utf-8')) as file:
+        while block := file.read(block_size):
+            yield block
+
+
+def iter_pptx(source: FileSource):
+    """Genera el texto de un PPTX forma a forma"""
+    from pptx import Presentation
+
+    prs = Presentation(_as_file(source))
+    for slide in prs.slides:
+        for shape in slide.shapes:
+            if hasattr(shape, "text"):
+                yield shape.text + "\n"
+
+
+def _xlsx_cell(value) -> str:
+    """Texto de una celda en una sola línea y sin separadores de tabla"""
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return " ".join(str(value).split()).replace("|", "/")
+
+
+def iter_xlsx(source: FileSource):
+    """
+    Genera el texto de todas las hojas de un XLSX fila a fila
+
+    Se abre en modo solo lectura, que va leyendo el XML de cada hoja sin cargar el
+    libro entero en memoria. Cada hoja empieza con su nombre y se convierte en una
+    tabla (TSV o markdown según XLSX_FORMAT) con como mucho XLSX_MAX_ROWS filas y
+    XLSX_MAX_COLS columnas.
+    """
+    import openpyxl
+
+    wb = openpyxl.load_workbook(_as_file(source), read_only=True, data_only=True)
+    try:
+        for sheet in wb.worksheets:
+            yield f"## {sheet.title}\n"
+            width = 0
+            rows = 0
+            for row in sheet.iter_rows(max_col=XLSX_MAX_COLS, values_only=True):
+                cells = [_xlsx_cell(value) for value in row]
+                while cells and not cells[-1]:
+                    cells.pop()
+                if not cells:
+                    continue  # Saltar las filas vacías
+                if rows == XLSX_MAX_ROWS:
+                    yield f"... (hoja recortada a {XLSX_MAX_ROWS} filas)\n"
+                    break
+
+                if XLSX_FORMAT == "markdown":
+                    if rows == 0:
+                        # La primera fila con datos hace de cabecera de la tabla
+                        width = len(cells)
+                        yield "| " + " | ".join(cells) + " |\n" + "|" + "---|" * width + "\n"
+                    else:
+                        cells += [""] * (width - len(cells))
+                        yield "| " + " | ".join(cells) + " |\n"
+                else:
+                    yield "\t".join(cells) + "\n"
+                rows += 1
+            yield "\n"
+    finally:
+        wb.close()  # En modo solo lectura el archivo queda abierto hasta cerrarlo
+
+
+def load_ocr_image(source: FileSource) -> np.ndarray:
+    """Decodifica una imagen en RGB y la reduce si supera OCR_MAX_SIDE"""
+    from PIL import Image
+
+    with Image.open(_as_file(source)) as img:
+        img = img.convert("RGB")
+        if OCR_MAX_SIDE and max(img.size) > OCR_MAX_SIDE:
+            img.thumbnail((OCR_MAX_SIDE, OCR_MAX_SIDE), Image.LANCZOS)
+        return np.array(img)
+
+
+def looks_textless(image: np.ndarray) -> bool:
+    """
+    Heurística barata para descartar imágenes sin texto antes del OCR
+
+    El texto produce bordes muy nítidos (trazos oscuros sobre fondo claro o al revés),
+    mientras que en una foto la mayoría de los bordes son suaves. Se mide qué parte de
+    los bordes es nítida en una versión reducida en escala de grises.
+    """
+    from PIL import Image
+
+    gray = Image.fromarray(image).convert("L")
+    gray.thumbnail((512, 512))
+    pixels = np.asarray(gray, dtype=np.int16)
+    gradient = np.maximum(np.abs(np.diff(pixels, axis=1))[:-1, :], np.abs(np.diff(pixels, axis=0))[:, :-1])
+    edges = np.count_nonzero(gradient > 16)
+    if edges == 0:
+        return True  # Imagen lisa
+    return bool(np.count_nonzero(gradient > 64) / edges < OCR_TEXTLESS_THRESHOLD)
+
+
+def _pad(image: np.ndarray, height: int, width: int) -> np.ndarray:
+    """Rellena la imagen con blanco por abajo y por la derecha hasta el tamaño indicado"""
+    if image.shape[:2] == (height, width):
+        return image
+    padded = np.full((height, width, image.shape[2]), 255, dtype=image.dtype)
+    padded[:image.shape[0], :image.shape[1]] = image
+    return padded
+
+
+def ocr_images(images: List[np.ndarray]) -> List[str]:
+    """
+    Extrae el texto de varias imágenes RGB con easyOCR en lotes
+
+    readtext_batched necesita imágenes del mismo tamaño, así que se agrupan por tamaño
+    (en tramos de OCR_BUCKET_PX) y se rellenan con blanco hasta el mayor de cada grupo.
+    Devuelve el texto de cada imagen en el mismo orden, una línea por detección.
+    """
+    texts = [""] * len(images)
+    groups = {}
+    for index, image in enumerate(images):
+        if OCR_SKIP_TEXTLESS and looks_textless(image):
+            continue
+        bucket = (-(-image.shape[0] // OCR_BUCKET_PX), -(-image.shape[1] // OCR_BUCKET_PX))
+        groups.setdefault(bucket, []).append(index)
+
+    if not groups:
+        return texts
+
+    with span("ocr"), ocr_pool.reader() as reader:
+        for indexes in groups.values():
+            for start in range(0, len(indexes), OCR_BATCH_SIZE):
+                batch = indexes[start:start + OCR_BATCH_SIZE]
+                height = max(images[index].shape[0] for index in batch)
+                width = max(images[index].shape[1] for index in batch)
+                results = reader.readtext_batched([_pad(images[index], height, width) for index in batch], batch_size=OCR_BATCH_SIZE)
+                # El texto extraído está en la segunda posición de cada tupla
+                for index, result in zip(batch, results):
+                    texts[index] = "".join(detection[1] + "\n" for detection in result)
+    return texts
+
+
+def iter_image(source: FileSource):
+    """Genera el texto de una imagen usando OCR (easyOCR)"""
+    # Decodificar la imagen en memoria, easyOCR acepta directamente el array
+    yield ocr_images([load_ocr_image(source)])[0]
+
+
+def read_pdf(source: FileSource, max_chars: Optional[int] = None, start: int = 0, stop: Optional[int] = None) -> str:
+    """Lee el contenido de un archivo PDF (ruta o bytes), o de un rango de páginas, y extrae el texto"""
+    try:
+        return collect_text(iter_pdf(source, start, stop, max_chars), max_chars)
+    except Exception as e:
+        logger.error(f"Error al leer el PDF: {str(e)}")
+        return ""
+
+def read_docx(source: FileSource, max_chars: Optional[int] = None) -> str:
+    """Lee el contenido de un archivo DOCX (ruta o bytes) y extrae el texto"""
+    try:
+        return collect_text(iter_docx(source), max_chars)
+    except Exception as e:
+        logger.error(f"Error al leer el DOCX: {str(e)}")
+        return ""
+    
+def read_txt(source: FileSource, max_chars: Optional[int] = None) -> str:
+    """Lee el contenido de un archivo TXT (ruta o bytes) y extrae el texto"""
+    try:
+        return collect_text(iter_txt(source), max_chars)
+    except Exception as e:
+        logger.error(f"Error al leer el TXT: {str(e)}")
+        return ""
+
+def read_pptx(source: FileSource, max_chars: Optional[int] = None) -> str:
+    """Lee el contenido de un archivo PPTX (ruta o bytes) y extrae el texto"""
+    try:
+        return collect_text(iter_pptx(source), max_chars)
+    except Exception as e:
+        logger.error(f"Error al leer el PPTX: {str(e)}")
+        return ""
+    
+def read_xlsx(source: FileSource, max_chars: Optional[int] = None) -> str:
+    """Lee el contenido de un archivo XLSX (ruta o bytes) y extrae el texto de todas las hojas"""
+    try:
+        return collect_text(iter_xlsx(source), max_chars).strip()  # Eliminar espacios adicionales al final
+    except Exception as e:
+        logger.error(f"Error al leer el XLSX: {str(e)}")
+        return ""
+
+def read_image(source: FileSource, max_chars: Optional[int] = None) -> str:
+    """Lee el contenido de una imagen (ruta o bytes) y extrae el texto usando OCR (easyOCR)."""
+    try:
+        return collect_text(iter_image(source), max_chars).strip()  # Eliminar espacios adicionales al final
+    except Exception as e:
+        logger.error(f"Error al leer la imagen: {str(e)}")
+        return ""
+
+class FormatHandler:
+    """
+    Extractor de un formato: extensiones que lee, librerías que necesita y función de lectura.
+
+    Las librerías no se importan al cargar app.py sino la primera vez que se extrae un
+    archivo del formato (o en el warm-up, ver EXTRACT_WARMUP), así un proceso que nunca
+    ve imágenes no carga easyOCR ni torch.
+    """
+
+    def __init__(self, name: str, extensions: tuple, modules: tuple, reader: Callable[..., str]):
+        self.name = name
+        self.extensions = extensions
+        self.modules = modules
+        self.reader = reader
+
+    @property
+    def loaded(self) -> bool:
+        return all(module in sys.modules for module in self.modules)
+
+    def load(self) -> float:
+        """Importa las librerías del formato y devuelve los segundos que ha costado"""
+        start = time.perf_counter()
+        for module in self.modules:
+            importlib.import_module(module)
+        return time.perf_counter() - start
+
+
+FORMAT_HANDLERS = [
+    FormatHandler("pdf", ("pdf",), ("fitz",), read_pdf),
+    FormatHandler("docx", ("docx",), ("docx",), read_docx),
+    FormatHandler("txt", ("txt",), (), read_txt),
+    FormatHandler("pptx", ("pptx",), ("pptx",), read_pptx),
+    FormatHandler("xlsx", ("xlsx",), ("openpyxl",), read_xlsx),
+    FormatHandler("imagen", ("jpg", "png", "jpeg", "webp"), ("PIL.Image", "easyocr"), read_image),
+]
+HANDLERS_BY_EXTENSION = {extension: handler for handler in FORMAT_HANDLERS for extension in handler.extensions}
+
+
+def extract_text(file_ext: str, source: FileSource, max_chars: Optional[int] = None) -> str:
+    """
+    Extrae como mucho `max_chars` caracteres de un archivo (ruta o bytes) según su extensión
+    (se ejecuta en los workers de extracción)
+    """
+    handler = HANDLERS_BY_EXTENSION.get(file_ext)
+    if handler is None:
+        raise ValueError(f"Formato de archivo no soportado: {file_ext}")
+    with span(f"extract_{handler.name}"):
+        return handler.reader(source, max_chars)
+
+
+def file_format(file_ext: str) -> Optional[str]:
+    """Devuelve el grupo de formato ("pdf", "docx", ..., "imagen") o None si no está soportado"""
+    handler = HANDLERS_BY_EXTENSION.get(file_ext)
+    return handler.name if handler else None
+
+
+def warm_up(formats: List[str]) -> dict:
+    """Importa por adelantado las librerías de los formatos indicados ("all" = todos)"""
+    timings = {}
+    for handler in FORMAT_HANDLERS:
+        if ("all" in formats or handler.name in formats) and not handler.loaded:
+            try:
+                timings[handler.name] = round(handler.load(), 3)
+            except ImportError as e:
+                logger.error(f"No se pudo cargar el extractor de {handler.name}: {str(e)}")
+    return timings
+
+
+_worker_warmup = {}  # Lo que costó el warm-up de este proceso (para el informe de arranque)
+
+
+def worker_warmup_report() -> dict:
+    return {**worker_stats(), **_worker_warmup}
+
+
+class StartupReport:
+    """Informe del arranque: tiempo hasta estar listo, warm-up de cada worker y librerías pesadas cargadas"""
+
+    HEAVY_MODULES = ("fitz", "docx", "pptx", "openpyxl", "PIL.Image", "torch", "easyocr")
+
+    def __init__(self):
+        self.ready_seconds = None
+        self.workers = {}  # pid -> warm-up de ese worker
+
+    def loaded_modules(self) -> List[str]:
+        return [module for module in self.HEAVY_MODULES if module in sys.modules]
+
+    def mark_ready(self):
+        self.ready_seconds = time.perf_counter() - _import_started
+        logger.info(f"Servidor listo en {self.ready_seconds:.2f}s (librerías pesadas cargadas: {', '.join(self.loaded_modules()) or 'ninguna'})")
+
+    def add_worker(self, future):
+        """Guarda el warm-up de un worker (future del executor, o None si se extrae en este proceso)"""
+        try:
+            report = dict(worker_warmup_report() if future is None else future.result())
+        except Exception as e:
+            logger.error(f"Error en el warm-up de un worker de extracción: {str(e)}")
+            return
+        report.pop("ocr", None)  # Se cuenta en ExtractionPipeline.ocr_stats()
+        pid = str(report.pop("pid"))
+        self.workers[pid] = report
+        logger.info(f"Worker de extracción {pid} preparado en {report.get('seconds', 0):.2f}s: {report.get('formats') or 'sin warm-up'}")
+
+    def stats(self) -> dict:
+        return {
+            "ready_seconds": round(self.ready_seconds, 3) if self.ready_seconds is not None else None,
+            "loaded_modules": self.loaded_modules(),
+            "workers": dict(self.workers),
+        }
+
+
+startup = StartupReport()
+
+
+def _init_extract_worker():
+    """Inicializador de cada proceso de extracción"""
+    start = time.perf_counter()
+    _worker_warmup["formats"] = warm_up(EXTRACT_WARMUP)
+    if OCR_PRELOAD:
+        # Cargar un lector por adelantado para que la primera imagen no pague la carga
+        with ocr_pool.reader():
+            pass
+    _worker_warmup["seconds"] = round(time.perf_counter() - start, 3)
+
+
+def spool_upload(data: bytes, file_ext: str) -> str:
+    """Vuelca el archivo a un temporal de UPLOAD_TMP_DIR y devuelve su ruta (hay que borrarlo al terminar)"""
+    with tempfile.NamedTemporaryFile(dir=UPLOAD_TMP_DIR, suffix=f".{file_ext}", delete=False) as f:
+        f.write(data)
+        return f.name
+
+
+class ClientDisconnected(Exception):
+    """El cliente cerró la conexión antes de que terminara la extracción"""
+
+
+class ExtractionPipeline:
+    """
+    Ejecuta las extracciones de texto fuera del bucle de eventos.
+
+    Las extracciones (PDF, OCR, ...) son CPU intensivas, así que se mandan a un pool
+    de procesos acotado con un límite de concurrencia por formato. Si hay demasiadas
+    extracciones pendientes se rechazan nuevas peticiones con 429.
+    """
+
+    def __init__(self, workers: int, max_queue: int, limits: dict):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.limits = limits
+        self.executor = None
+        self._semaphores = {}
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.cancelled = 0
+        self._worker_ocr = {}  # pid -> contadores del pool de OCR de ese proceso
+
+    def start(self):
+        if self.workers > 0:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_extract_worker)
+            if EXTRACT_WARMUP or OCR_PRELOAD:
+                # Arrancar ya los workers para que hagan el warm-up antes de la primera subida
+                for _ in range(self.workers):
+                    future = self.executor.submit(worker_warmup_report)
+                    future.add_done_callback(startup.add_worker)
+                    future.add_done_callback(lambda future: future.exception() or self._remember_worker(future.result()))
+        else:
+            self.executor = ThreadPoolExecutor()
+            _init_extract_worker()
+            startup.add_worker(None)
+            self._remember_worker(worker_stats())
+
+    def _remember_worker(self, report: dict):
+        self._worker_ocr[str(report["pid"])] = report["ocr"]
+
+    def _merge(self, result: tuple) -> str:
+        """Suma las etapas y guarda los contadores del worker que devolvió `traced()`; devuelve el texto"""
+        text, stages, worker = result
+        merge_trace(stages)
+        self._remember_worker(worker)
+        return text
+
+    def ocr_stats(self) -> dict:
+        """Pool de OCR sumando el de cada proceso de extracción (con EXTRACT_WORKERS=0, el de este proceso)"""
+        workers = dict(self._worker_ocr)
+        readers = Counter()
+        for stats in workers.values():
+            readers.update(stats["readers"])
+        return {
+            "size": OCR_POOL_SIZE,
+            "processes": len(workers),
+            "readers": dict(readers),
+            "hits": sum(stats["hits"] for stats in workers.values()),
+            "misses": sum(stats["misses"] for stats in workers.values()),
+            "load_time_seconds": round(sum(stats["load_time_seconds"] for stats in workers.values()), 3),
+            "workers": {pid: {key: stats[key] for key in ("hits", "misses", "load_time_seconds")} for pid, stats in workers.items()},
+        }
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+    async def aclose(self):
+        """Apaga el pool sin bloquear el bucle de eventos mientras terminan las extracciones en curso"""
+        await asyncio.to_thread(self.shutdown)
+
+    def _semaphore(self, fmt: str) -> asyncio.Semaphore:
+        if fmt not in self._semaphores:
+            self._semaphores[fmt] = asyncio.Semaphore(self.limits.get(fmt, max(self.workers, 1)))
+        return self._semaphores[fmt]
+
+    async def _run(self, file_ext: str, source: FileSource, max_chars: Optional[int]) -> str:
+        semaphore = self._semaphore(file_format(file_ext))
+        with span("extract_wait"):
+            await semaphore.acquire()
+        try:
+            size = len(source) if isinstance(source, bytes) else os.path.getsize(source)
+            if file_ext == "pdf" and self.workers > 1 and size >= PDF_PARALLEL_MIN_BYTES:
+                return await self._run_large_pdf(source, max_chars)
+            # El worker devuelve también lo que ha tardado cada etapa (extracción, OCR...)
+            loop = asyncio.get_running_loop()
+            return self._merge(await loop.run_in_executor(self.executor, traced, extract_text, file_ext, source, max_chars))
+        finally:
+            semaphore.release()
+
+    async def _run_large_pdf(self, source: FileSource, max_chars: Optional[int]) -> str:
+        """
+        Extrae un PDF de al menos PDF_PARALLEL_MIN_BYTES, repartido entre los workers si tiene páginas de sobra
+
+        Si está en memoria se vuelca una vez a UPLOAD_TMP_DIR y los workers reciben la
+        ruta, en vez de una copia del archivo en cada tarea. Las páginas se cuentan en un
+        worker para no cargar PyMuPDF en el proceso del servidor.
+        """
+        loop = asyncio.get_running_loop()
+        temp_file_path = None
+        if isinstance(source, bytes):
+            temp_file_path = source = await asyncio.to_thread(spool_upload, source, "pdf")
+        try:
+            pages = await loop.run_in_executor(self.executor, pdf_page_count, source)
+            if pages >= PDF_PARALLEL_MIN_PAGES:
+                with span("extract_pdf"):
+                    return await self._run_pdf_pages(source, pages, max_chars)
+            return self._merge(await loop.run_in_executor(self.executor, traced, extract_text, "pdf", source, max_chars))
+        finally:
+            if temp_file_path is not None:
+                os.remove(temp_file_path)  # Los trozos que ya lo tienen abierto pueden seguir leyéndolo
+
+    async def _run_pdf_pages(self, source: FileSource, pages: int, max_chars: Optional[int]) -> str:
+        """
+        Reparte un PDF grande en trozos de PDF_PAGES_PER_TASK páginas entre los workers
+
+        Se mantienen como mucho `workers` trozos en marcha y los resultados se juntan en
+        orden de página; en cuanto se llega a `max_chars` no se lanzan más trozos.
+        """
+        loop = asyncio.get_running_loop()
+        ranges = deque((start, min(start + PDF_PAGES_PER_TASK, pages)) for start in range(0, pages, PDF_PAGES_PER_TASK))
+        running = deque()
+        parts = []
+        total = 0
+        try:
+            while ranges or running:
+                while ranges and len(running) < self.workers:
+                    start, stop = ranges.popleft()
+                    running.append(loop.run_in_executor(self.executor, traced, read_pdf, source, max_chars, start, stop))
+                text, stages, worker = await running.popleft()
+                stages.pop("extract_pdf", None)  # La duración total del PDF ya se mide aquí
+                text = self._merge((text, stages, worker))
+                parts.append(text)
+                total += len(text)
+                if max_chars is not None and total >= max_chars:
+                    break
+        finally:
+            for future in running:
+                future.cancel()
+        return "".join(parts)[:max_chars]
+
+    async def extract(self, request: Optional[Request], file_ext: str, source: FileSource, max_chars: Optional[int] = None) -> str:
+        """Extrae el texto del archivo y cancela el trabajo si el cliente se desconecta"""
+        if self.pending >= self.max_queue:
+            self.rejected += 1
+            raise HTTPException(status_code=429, detail="Servidor ocupado extrayendo archivos, inténtalo más tarde", headers={"Retry-After": "5"})
+
+        self.pending += 1
+        task = asyncio.ensure_future(self._run(file_ext, source, max_chars))
+        # Sin petición (trabajos en segundo plano) no hay cliente que vigilar
+        watcher = asyncio.ensure_future(_wait_disconnect(request)) if request is not None else asyncio.Future()
+        try:
+            await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if not task.done():
+                # Si sigue en cola se descarta; si ya está en un worker su resultado se ignora
+                task.cancel()
+                self.cancelled += 1
+                raise ClientDisconnected()
+            self.completed += 1
+            return task.result()
+        finally:
+            watcher.cancel()
+            self.pending -= 1
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "max_queue": self.max_queue,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "cancelled": self.cancelled,
+        }
+
+
+async def _wait_disconnect(request: Request, interval: float = 0.5):
+    """Termina cuando el cliente cierra la conexión"""
+    while not await request.is_disconnected():
+        await asyncio.sleep(interval)
+
+
+class RemoteExtractionPipeline(ExtractionPipeline):
+    """
+    Manda las extracciones al servicio de extracción compartido (ver extract_service).
+
+    Con varios workers de uvicorn cada uno tendría su propio pool de procesos y su
+    propia copia del modelo de OCR; así todos comparten un único pool, al que se llega
+    por un socket unix ("unix:/ruta.sock") o por HTTP. La cola (429) y la cancelación
+    cuando el cliente se desconecta funcionan igual que en local: al cancelar la
+    petición se cierra la conexión y el servicio cancela la extracción.
+    """
+
+    def __init__(self, url: str, max_queue: int, timeout: float):
+        super().__init__(0, max_queue, {})
+        self.url = url
+        self.timeout = timeout
+        self.client = None
+        self.failed = 0
+
+    def start(self):
+        if self.url.startswith("unix:"):
+            transport = httpx.AsyncHTTPTransport(uds=self.url[len("unix:"):])
+            base_url = "http://extract-service"
+        else:
+            transport = None
+            base_url = self.url.rstrip("/")
+        self.client = httpx.AsyncClient(base_url=base_url, transport=transport, timeout=httpx.Timeout(self.timeout, connect=OLLAMA_CONNECT_TIMEOUT))
+
+    def shutdown(self):
+        pass
+
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def _run(self, file_ext: str, source: FileSource, max_chars: Optional[int]) -> str:
+        params = {"ext": file_ext}
+        if max_chars is not None:
+            params["max_chars"] = max_chars
+        # Los archivos volcados a disco no se copian: el servicio los lee de UPLOAD_TMP_DIR
+        if isinstance(source, str):
+            params["path"] = source
+            content = b""
+        else:
+            content = source
+
+        try:
+            with span("extract_remote"):
+                response = await self.client.post("/extract", params=params, content=content)
+        except httpx.HTTPError as e:
+            self.failed += 1
+            logger.error(f"Error conectando con el servicio de extracción {self.url}: {str(e)}")
+            raise HTTPException(status_code=503, detail="Servicio de extracción no disponible")
+
+        if response.status_code != 200:
+            try:
+                detail = response.json().get("detail", response.text)
+            except ValueError:
+                detail = response.text
+            if response.status_code != 429:
+                self.failed += 1
+            retry_after = response.headers.get("Retry-After")
+            raise HTTPException(status_code=response.status_code, detail=detail, headers={"Retry-After": retry_after} if retry_after else None)
+
+        result = response.json()
+        merge_trace(result["stages"])
+        # El OCR se hace en los workers del servicio: se guardan sus contadores tal cual
+        self._worker_ocr = result["ocr_workers"]
+        return result["text"]
+
+    def stats(self) -> dict:
+        return {**super().stats(), "service": self.url, "failed": self.failed}
+
+
+if EXTRACT_SERVICE:
+    extraction_pipeline = RemoteExtractionPipeline(EXTRACT_SERVICE, EXTRACT_MAX_QUEUE, EXTRACT_SERVICE_TIMEOUT)
+else:
+    extraction_pipeline = ExtractionPipeline(EXTRACT_WORKERS, EXTRACT_MAX_QUEUE, EXTRACT_LIMITS)
+
+
+class ExtractionCache:
+    """
+    Caché de textos extraídos direccionada por contenido.
+
+    La clave es el SHA-256 del archivo subido junto con su extensión y la versión del
+    extractor. Tiene un nivel en memoria (LRU acotado por entradas y bytes) y un nivel
+    opcional en sqlite, con el texto comprimido, que sobrevive a los reinicios.
+
+    Como la extracción se corta al llegar al límite de caracteres pedido, cada entrada
+    indica si el texto está completo; uno recortado solo sirve para límites menores.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float, db_path: str = "", disk_max_bytes: int = 0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.db_path = db_path
+        self.disk_max_bytes = disk_max_bytes
+        self._memory = OrderedDict()  # clave -> (texto, completo, instante de creación)
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if db_path:
+            with self._connect() as db:
+                db.execute("CREATE TABLE IF NOT EXISTS extractions (key TEXT PRIMARY KEY, text BLOB, size INTEGER, created REAL, accessed REAL, complete INTEGER DEFAULT 1)")
+                columns = [row[1] for row in db.execute("PRAGMA table_info(extractions)")]
+                if "complete" not in columns:
+                    db.execute("ALTER TABLE extractions ADD COLUMN complete INTEGER DEFAULT 1")
+
+    @staticmethod
+    def key(data: bytes, file_ext: str) -> str:
+        return f"{hashlib.sha256(data).hexdigest()}:{file_ext}:{EXTRACTOR_VERSION}"
+
+    @staticmethod
+    def _usable(text: str, complete: bool, max_chars: Optional[int]) -> bool:
+        """Un texto recortado solo sirve si tiene al menos los caracteres pedidos"""
+        return complete or (max_chars is not None and len(text) >= max_chars)
+
+    @contextmanager
+    def _connect(self):
+        """Abre una conexión con el sqlite, confirma los cambios y la cierra al terminar"""
+        db = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _remember(self, key: str, text: str, complete: bool, created: float):
+        """Guarda una entrada en memoria y expulsa las menos usadas si se supera el límite"""
+        with self._lock:
+            if key in self._memory:
+                self._memory_bytes -= len(self._memory.pop(key)[0])
+            self._memory[key] = (text, complete, created)
+            self._memory_bytes += len(text)
+            while self._memory and (len(self._memory) > self.max_entries or self._memory_bytes > self.max_bytes):
+                _, (old_text, _, _) = self._memory.popitem(last=False)
+                self._memory_bytes -= len(old_text)
+
+    def get(self, key: str, max_chars: Optional[int] = None) -> Optional[str]:
+        """Devuelve el texto guardado (recortado a `max_chars`) o None si no está o no basta"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and now - entry[2] <= self.ttl:
+                if self._usable(entry[0], entry[1], max_chars):
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return entry[0][:max_chars]
+                # Está en memoria pero recortado a un límite menor: hay que volver a extraer
+                self.misses += 1
+                return None
+            if entry:
+                self._memory_bytes -= len(self._memory.pop(key)[0])
+
+        if self.db_path:
+            with self._connect() as db:
+                row = db.execute("SELECT text, created, complete FROM extractions WHERE key = ?", (key,)).fetchone()
+                if row and now - row[1] <= self.ttl:
+                    text = zlib.decompress(row[0]).decode("utf-8")
+                    if self._usable(text, bool(row[2]), max_chars):
+                        db.execute("UPDATE extractions SET accessed = ? WHERE key = ?", (now, key))
+                        self._remember(key, text, bool(row[2]), row[1])
+                        with self._lock:
+                            self.disk_hits += 1
+                        return text[:max_chars]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, text: str, complete: bool = True):
+        now = time.time()
+        self._remember(key, text, complete, now)
+        if self.db_path:
+            blob = zlib.compress(text.encode("utf-8"))
+            with self._connect() as db:
+                db.execute(
+                    "INSERT OR REPLACE INTO extractions (key, text, size, created, accessed, complete) VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, blob, len(blob), now, now, int(complete))
+                )
+                self._evict_disk(db, now)
+
+    def _evict_disk(self, db: sqlite3.Connection, now: float):
+        """Borra del disco las entradas caducadas y, si se supera el tamaño máximo, las menos usadas"""
+        db.execute("DELETE FROM extractions WHERE created < ?", (now - self.ttl,))
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM extractions").fetchone()[0]
+        if total <= self.disk_max_bytes:
+            return
+        for key, size in db.execute("SELECT key, size FROM extractions ORDER BY accessed").fetchall():
+            db.execute("DELETE FROM extractions WHERE key = ?", (key,))
+            total -= size
+            if total <= self.disk_max_bytes:
+                break
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "entries": len(self._memory),
+                "bytes": self._memory_bytes,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": round(hits / lookups, 3) if lookups else 0.0,
+                "disk": bool(self.db_path),
+            }
+
+
+extraction_cache = ExtractionCache(EXTRACT_CACHE_MAX_ENTRIES, EXTRACT_CACHE_MAX_BYTES, EXTRACT_CACHE_TTL, EXTRACT_CACHE_DB, EXTRACT_CACHE_DISK_MAX_BYTES)
+
+
+_TOKEN_RE = re.compile(r"\w+")
+_STOPWORDS = frozenset(
+    "a al algo como con de del el en es esta este esto la las lo los mas me mi no o para pero por que se si sin "
+    "su sus te tu un una uno y ya an and are as at be by for from in is it of on or that the this to was with".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """Normaliza el texto (minúsculas, sin tildes) y lo separa en términos sin palabras vacías"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return [token for token in _TOKEN_RE.findall(text) if token not in _STOPWORDS]
+
+
+def split_chunks(text: str, size: int, overlap: int) -> List[str]:
+    """Divide el texto en fragmentos de unos `size` caracteres cortando en saltos de línea o espacios"""
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + size)
+        if end < len(text):
+            # Cortar en el último salto de línea (o espacio) de la segunda mitad del fragmento
+            cut = text.rfind("\n", start + size // 2, end)
+            if cut == -1:
+                cut = text.rfind(" ", start + size // 2, end)
+            if cut != -1:
+                end = cut
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return chunks
+
+
+class ChunkIndex:
+    """
+    Índice BM25 de los fragmentos de un documento.
+
+    Guarda un índice invertido término -> (fragmentos, frecuencias) como arrays de NumPy
+    para puntuar todos los fragmentos de una consulta con operaciones vectorizadas.
+    """
+
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self, text: str):
+        self.chunks = split_chunks(text, RAG_CHUNK_CHARS, RAG_CHUNK_OVERLAP)
+        self.embeddings = None  # Matriz normalizada (fragmentos x dimensiones) si hay EMBED_MODEL
+
+        postings = {}
+        lengths = []
+        for chunk_id, chunk in enumerate(self.chunks):
+            tokens = tokenize(chunk)
+            lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                ids, tfs = postings.setdefault(term, ([], []))
+                ids.append(chunk_id)
+                tfs.append(tf)
+
+        self.postings = {term: (np.array(ids, dtype=np.int32), np.array(tfs, dtype=np.float32)) for term, (ids, tfs) in postings.items()}
+        lengths = np.array(lengths, dtype=np.float32)
+        avg_length = float(lengths.mean()) if len(lengths) and lengths.mean() > 0 else 1.0
+        self._length_norm = self.K1 * (1 - self.B + self.B * lengths / avg_length)
+
+    def bm25(self, terms: List[str]) -> np.ndarray:
+        """Puntuación BM25 de cada fragmento para los términos de la consulta"""
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        total = len(self.chunks)
+        for term in set(terms):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            ids, tfs = posting
+            idf = math.log(1 + (total - len(ids) + 0.5) / (len(ids) + 0.5))
+            scores[ids] += idf * tfs * (self.K1 + 1) / (tfs + self._length_norm[ids])
+        return scores
+
+
+async def embed(texts: List[str]) -> Optional[np.ndarray]:
+    """Calcula los embeddings normalizados con EMBED_MODEL en Ollama (None si no hay modelo o falla)"""
+    if not EMBED_MODEL or not texts:
+        return None
+    try:
+        response = await ollama_post("/api/embed", {"model": EMBED_MODEL, "input": texts})
+        vectors = np.array(response.json()["embeddings"], dtype=np.float32)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    except (httpx.HTTPError, KeyError, ValueError) as e:
+        logger.warning(f"No se pudieron calcular los embeddings: {e}")
+        return None
+
+
+class RetrievalIndex:
+    """
+    Documentos indexados por sesión.
+
+    Los índices se guardan con el id del documento en el almacén (document_store), así el
+    mismo documento subido en varias sesiones se indexa una vez, en un LRU acotado; cada
+    sesión guarda los documentos que subió con el nombre que les dio.
+    """
+
+    def __init__(self, max_documents: int, max_sessions: int):
+        self.max_documents = max_documents
+        self.max_sessions = max_sessions
+        self._documents = OrderedDict()  # doc_id -> ChunkIndex
+        self._sessions = OrderedDict()   # session_id -> OrderedDict(doc_id -> nombre)
+        self.searches = 0
+
+    def get(self, doc_id: str) -> Optional[ChunkIndex]:
+        index = self._documents.get(doc_id)
+        if index is not None:
+            self._documents.move_to_end(doc_id)
+        return index
+
+    def add(self, session_id: Optional[str], doc_id: str, name: str, index: ChunkIndex):
+        self._documents[doc_id] = index
+        self._documents.move_to_end(doc_id)
+        while len(self._documents) > self.max_documents:
+            self._documents.popitem(last=False)
+
+        documents = self._sessions.setdefault(session_id, OrderedDict())
+        documents[doc_id] = name
+        documents.move_to_end(doc_id)
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def clear(self, session_id: Optional[str]):
+        self._sessions.pop(session_id, None)
+
+    def document_ids(self, session_id: Optional[str]) -> List[str]:
+        """Ids de los documentos de la sesión que siguen indexados en este proceso"""
+        return [doc_id for doc_id in self._sessions.get(session_id, []) if doc_id in self._documents]
+
+    def documents(self, session_id: Optional[str]) -> List[tuple]:
+        """Tuplas (nombre, índice) de los documentos de la sesión, del más reciente al más antiguo"""
+        documents = self._sessions.get(session_id, {})
+        return [(name, self._documents[doc_id]) for doc_id, name in reversed(documents.items()) if doc_id in self._documents]
+
+    def search(self, session_id: Optional[str], query: str, k: int, query_embedding: Optional[np.ndarray] = None, fallback: bool = False) -> List[tuple]:
+        """
+        Busca los `k` fragmentos más relevantes de los documentos de la sesión
+
+        Returns:
+            list: Tuplas (nombre, índice, número de fragmento) en orden de aparición en los documentos.
+                Si ningún fragmento coincide con la consulta solo se devuelven los primeros
+                fragmentos del documento más reciente cuando `fallback` es True.
+        """
+        documents = self.documents(session_id)
+        if not documents:
+            return []
+        self.searches += 1
+
+        terms = tokenize(query)
+        candidates = []
+        for order, (_, index) in enumerate(documents):
+            scores = index.bm25(terms)
+            if query_embedding is not None and index.embeddings is not None:
+                # Búsqueda híbrida: BM25 normalizado más similitud coseno
+                top = float(scores.max()) if len(scores) else 0.0
+                scores = (scores / top if top > 0 else scores) + index.embeddings @ query_embedding
+            candidates.extend((float(score), order, chunk_id) for chunk_id, score in enumerate(scores) if score > 0)
+
+        if not candidates:
+            if not fallback:
+                return []
+            name, index = documents[0]
+            return [(name, index, chunk_id) for chunk_id in range(min(k, len(index.chunks)))]
+
+        best = sorted(candidates, key=lambda candidate: -candidate[0])[:k]
+        # Devolver en el orden del documento para que el modelo lea el texto seguido
+        return [(*documents[order], chunk_id) for _, order, chunk_id in sorted(best, key=lambda candidate: (candidate[1], candidate[2]))]
+
+    def stats(self) -> dict:
+        return {
+            "documents": len(self._documents),
+            "chunks": sum(len(index.chunks) for index in self._documents.values()),
+            "sessions": len(self._sessions),
+            "searches": self.searches,
+            "embeddings": bool(EMBED_MODEL),
+        }
+
+
+retrieval_index = RetrievalIndex(RAG_MAX_DOCUMENTS, SESSION_MAX_SESSIONS)
+
+
+async def index_document(session_id: Optional[str], doc_id: str, name: str, text: str):
+    """Divide el documento `doc_id` del almacén en fragmentos y lo añade al índice de la sesión"""
+    index = retrieval_index.get(doc_id)
+    if index is None:
+        # Tokenizar un documento grande lleva su tiempo: hacerlo fuera del bucle de eventos
+        index = await asyncio.to_thread(ChunkIndex, text)
+        index.embeddings = await embed(index.chunks)
+    retrieval_index.add(session_id, doc_id, name, index)
+
+
+def session_document_ids(history: List[dict], summary: Optional[dict]) -> List[str]:
+    """Ids de los documentos usados en la sesión (resumen e historial), del más antiguo al más reciente"""
+    doc_ids = list(summary.get("document_ids", [])) if summary else []
+    for entry in history:
+        doc_ids.extend(entry.get("document_ids", []))
+    return list(dict.fromkeys(doc_ids))
+
+
+async def restore_index(session_id: str):
+    """
+    Vuelve a indexar desde el almacén los documentos de la sesión que no están en el índice
+    de este proceso: con varios workers el turno anterior pudo atenderlo otro worker, o el
+    índice pudo expulsar el documento
+    """
+    history = await asyncio.to_thread(session_store.history, session_id)
+    summary = await asyncio.to_thread(session_store.summary, session_id)
+    indexed = set(retrieval_index.document_ids(session_id))
+    for doc_id in session_document_ids(history, summary):
+        if doc_id in indexed:
+            continue
+        document = await asyncio.to_thread(document_store.get, session_id, doc_id)
+        if document is not None:  # Si ya caducó no hay nada que recuperar
+            await index_document(session_id, doc_id, document["name"], document["text"])
+
+
+async def process_upload(request: Optional[Request], session_id: Optional[str], file_name: str, data: bytes, max_chars: int) -> dict:
+    """
+    Extrae el texto de un archivo subido (usando la caché), lo indexa para la sesión y
+    lo guarda en el almacén de documentos
+
+    Con RAG_ENABLED y sesión se extraen hasta RAG_MAX_CHARS caracteres para el índice;
+    sin sesión solo `max_chars`.
+
+    Raises:
+        HTTPException: Si el formato no está soportado o el servidor está saturado (429)
+        ClientDisconnected: Si el cliente se desconecta durante la extracción
+    """
+    file_ext = file_name.split(".")[-1].lower()
+    if file_format(file_ext) is None:
+        raise HTTPException(status_code=400, detail="Formato de archivo no soportado")
+
+    file_type = "imagen" if file_format(file_ext) == "imagen" else "documento"
+    # Si el documento se va a indexar para la sesión se extraen hasta RAG_MAX_CHARS caracteres
+    # aunque se devuelvan menos: la extracción cuesta lo que cuesten esos caracteres, no `max_chars`
+    index = RAG_ENABLED and bool(session_id)
+    extract_chars = max(max_chars, RAG_MAX_CHARS) if index else max_chars
+
+    # Si ya se extrajo este mismo archivo se usa el texto guardado
+    cache_key = ExtractionCache.key(data, file_ext)
+    text = await asyncio.to_thread(extraction_cache.get, cache_key, extract_chars)
+    cached = text is not None
+    if not cached:
+        # Los archivos pequeños se extraen desde memoria; solo los grandes se vuelcan a disco
+        # para no copiarlos entero a los procesos de extracción
+        source = data
+        temp_file_path = None
+        try:
+            if len(data) > UPLOAD_SPOOL_THRESHOLD:
+                with span("upload_spool"):
+                    temp_file_path = source = spool_upload(data, file_ext)
+
+            # La extracción se hace en el pool de procesos para no bloquear el bucle de eventos
+            text = await extraction_pipeline.extract(request, file_ext, source, extract_chars)
+        finally:
+            # Eliminar archivo temporal después de procesarlo
+            if temp_file_path and os.path.exists(temp_file_path):
+                os.remove(temp_file_path)
+
+        # Los textos vacíos no se guardan: pueden venir de un error puntual del extractor
+        if text:
+            await asyncio.to_thread(extraction_cache.put, cache_key, text, len(text) < extract_chars)
+
+    document_id = None
+    if text:
+        # El cliente manda después el id en document_ids en vez de reenviar el texto
+        document_id = await asyncio.to_thread(document_store.put, session_id, file_name, file_type, text, max_chars)
+        if index:
+            await index_document(session_id, document_id, file_name, text)
+
+    return {"file_type": file_type, "file_text": text[:max_chars], "file_name": file_name, "cached": cached, "document_id": document_id}
+
+
+@app.post("/upload_file")
+async def upload_file(request: Request, file: UploadFile = File(...), max_chars: int = Query(MAX_FILE_CHARS, ge=1, le=MAX_FILE_CHARS_LIMIT)):
+    """
+    Endpoint para cargar documentos (PDF, DOCX, TXT, PPTX) o imágenes (JPG, PNG, JPEG, WEBP).
+    
+    - Extrae texto de documentos.
+    - Convierte imágenes a Base64.
+    
+    Args:
+        file (UploadFile): Archivo a procesar.
+        max_chars (int): Caracteres máximos a extraer; la extracción se detiene al alcanzarlos.
+    
+    Returns:
+        dict: Texto extraído o imagen en Base64.
+    """
+    try:
+        with span("upload_read"):
+            data = await file.read()
+        session_id = request.cookies.get("session_id")
+        result = await process_upload(request, session_id, file.filename, data, max_chars)
+        if SPECULATIVE_PREFILL and result["document_id"]:
+            model_warmer.prefill(session_id, [result["document_id"]])
+        return result
+
+    except HTTPException:
+        raise
+    except ClientDisconnected:
+        logger.info(f"Cliente desconectado, extracción de {file.filename} cancelada")
+        raise HTTPException(status_code=499, detail="Cliente desconectado")
+    except Exception as e:
+        logger.error(f"Error al procesar el archivo: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error al procesar el archivo")
+
+
+BatchItem = tuple  # (nombre del archivo, función que devuelve su contenido)
+
+
+def batch_items(uploads: List[tuple]) -> List[BatchItem]:
+    """
+    Lista los archivos de un lote a partir de (nombre, archivo abierto) y abre los zip
+
+    De cada zip se toman los archivos con formato soportado; su contenido se lee cuando
+    llega su turno, no al listar.
+
+    Raises:
+        HTTPException: Si un zip no es válido o el lote supera los límites
+    """
+    items = []
+    for name, fileobj in uploads:
+        if not name.lower().endswith(".zip"):
+            items.append((name, fileobj.read))
+            continue
+        try:
+            archive = zipfile.ZipFile(fileobj)
+        except zipfile.BadZipFile:
+            raise HTTPException(status_code=400, detail=f"El zip {name} no es válido")
+        members = [
+            info for info in archive.infolist()
+            if not info.is_dir() and not info.filename.startswith("__MACOSX/")
+            and file_format(info.filename.split(".")[-1].lower()) is not None
+        ]
+        # Comprobar el tamaño descomprimido antes de leer nada (zip bombs)
+        if sum(info.file_size for info in members) > UPLOAD_ZIP_MAX_BYTES:
+            raise HTTPException(status_code=413, detail=f"El zip {name} es demasiado grande una vez descomprimido")
+        items += [(info.filename, lambda archive=archive, info=info: archive.read(info)) for info in members]
+
+    if len(items) > UPLOAD_BATCH_MAX_FILES:
+        raise HTTPException(status_code=413, detail=f"Como mucho se pueden subir {UPLOAD_BATCH_MAX_FILES} archivos a la vez")
+    return items
+
+
+async def process_batch(request: Optional[Request], session_id: Optional[str], items: List[BatchItem], max_chars: int):
+    """
+    Extrae los archivos de un lote de forma concurrente y genera el resultado de cada uno según terminan
+
+    Se procesan como mucho UPLOAD_BATCH_CONCURRENCY archivos a la vez. Si el servidor de
+    extracción está saturado (429) se espera y se reintenta en vez de fallar el archivo.
+    Cada resultado lleva su posición en el lote (`index`) y, si falla, `error` y `status`.
+    """
+    semaphore = asyncio.Semaphore(UPLOAD_BATCH_CONCURRENCY)
+
+    async def process(index: int, name: str, load: Callable[[], bytes]) -> dict:
+        # Los trabajos en segundo plano no tienen una petición que recoja sus etapas: cada archivo abre su traza
+        async with semaphore:
+            with trace() if request is None else nullcontext():
+                return await process_one(index, name, load)
+
+    async def process_one(index: int, name: str, load: Callable[[], bytes]) -> dict:
+        try:
+            with span("upload_read"):
+                data = await asyncio.to_thread(load)
+            while True:
+                try:
+                    result = await process_upload(request, session_id, name, data, max_chars)
+                    break
+                except HTTPException as e:
+                    if e.status_code != 429:
+                        raise
+                    await asyncio.sleep(float(e.headers.get("Retry-After", 1)))
+            return {"index": index, **result}
+        except HTTPException as e:
+            return {"index": index, "file_name": name, "error": e.detail, "status": e.status_code}
+        except ClientDisconnected:
+            raise
+        except Exception as e:
+            logger.error(f"Error al procesar el archivo {name}: {str(e)}")
+            return {"index": index, "file_name": name, "error": "Error al procesar el archivo", "status": 500}
+
+    tasks = [asyncio.ensure_future(process(index, name, load)) for index, (name, load) in enumerate(items)]
+    try:
+        for next_result in asyncio.as_completed(tasks):
+            yield await next_result
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+@app.post("/upload_files")
+async def upload_files(request: Request, files: List[UploadFile] = File(...), max_chars: int = Query(MAX_FILE_CHARS, ge=1, le=MAX_FILE_CHARS_LIMIT)):
+    """
+    Endpoint para cargar varios archivos, o zips con archivos, en una sola petición.
+
+    Los archivos se extraen a la vez en el pool de extracción y el resultado de cada uno
+    se envía en cuanto termina, como una línea JSON (NDJSON) con el mismo formato que
+    /upload_file más `index` (posición en el lote) o `error` y `status` si ha fallado.
+
+    Args:
+        files (List[UploadFile]): Archivos a procesar.
+        max_chars (int): Caracteres máximos a extraer de cada archivo.
+
+    Returns:
+        StreamingResponse: Una línea JSON por archivo, en orden de finalización.
+
+    Raises:
+        HTTPException: Si un zip no es válido o el lote supera los límites.
+    """
+    items = batch_items([(file.filename, file.file) for file in files])
+    session_id = request.cookies.get("session_id")
+
+    async def event_stream():
+        document_ids = []
+        try:
+            async for result in process_batch(request, session_id, items, max_chars):
+                if result.get("document_id"):
+                    document_ids.append(result["document_id"])
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        except ClientDisconnected:
+            logger.info("Cliente desconectado, subida de archivos cancelada")
+            return
+        # Los ids van en el mismo orden en que los recibe el cliente, que es como los enviará
+        if SPECULATIVE_PREFILL:
+            model_warmer.prefill(session_id, document_ids)
+
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson")
+
+
+class IngestJobs:
+    """
+    Trabajos de ingesta de lotes grandes de documentos en segundo plano.
+
+    /ingest copia los archivos a una carpeta temporal, responde con el id del trabajo
+    y los procesa sin mantener abierta la petición. El estado se consulta en
+    /ingest/{job_id}; se conservan los últimos `max_jobs` trabajos terminados.
+    """
+
+    def __init__(self, max_jobs: int):
+        self.max_jobs = max_jobs
+        self._jobs = OrderedDict()  # job_id -> estado del trabajo
+        self._tasks = {}            # job_id -> tarea en curso
+
+    def start(self, session_id: Optional[str], folder: str, handles: list, items: List[BatchItem], max_chars: int) -> dict:
+        job_id = str(uuid.uuid4())
+        job = {
+            "job_id": job_id,
+            "status": "running",
+            "total": len(items),
+            "done": 0,
+            "failed": 0,
+            "created": time.time(),
+            "finished": None,
+            "results": [],
+        }
+        self._jobs[job_id] = job
+        self._tasks[job_id] = asyncio.create_task(self._run(job, session_id, folder, handles, items, max_chars))
+        return job
+
+    async def _run(self, job: dict, session_id: Optional[str], folder: str, handles: list, items: List[BatchItem], max_chars: int):
+        try:
+            async for result in process_batch(None, session_id, items, max_chars):
+                # El estado solo guarda un resumen: el texto queda en la caché y en el índice de la sesión
+                text = result.pop("file_text", None)
+                if text is not None:
+                    result["chars"] = len(text)
+                job["results"].append(result)
+                job["done"] += 1
+                job["failed"] += "error" in result
+            job["status"] = "done"
+        except asyncio.CancelledError:
+            job["status"] = "cancelled"
+            raise
+        except Exception as e:
+            logger.error(f"Error en el trabajo de ingesta {job['job_id']}: {str(e)}")
+            job["status"] = "failed"
+        finally:
+            job["finished"] = time.time()
+            self._tasks.pop(job["job_id"], None)
+            for handle in handles:
+                handle.close()
+            await asyncio.to_thread(shutil.rmtree, folder, True)
+            self._evict()
+
+    def _evict(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job["finished"] is not None]
+        for job_id in finished[:max(0, len(finished) - self.max_jobs)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id: str) -> Optional[dict]:
+        return self._jobs.get(job_id)
+
+    async def drain(self, timeout: float):
+        """Espera a los trabajos en curso hasta `timeout` segundos y cancela los que queden"""
+        tasks = list(self._tasks.values())
+        if not tasks:
+            return
+        logger.info(f"Esperando a {len(tasks)} trabajos de ingesta antes de apagar")
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f"{len(pending)} trabajos de ingesta cancelados al apagar")
+            await asyncio.wait(pending)
+
+    def stats(self) -> dict:
+        return {
+            "running": len(self._tasks),
+            "jobs": len(self._jobs),
+        }
+
+
+ingest_jobs = IngestJobs(INGEST_MAX_JOBS)
+
+
+@app.post("/ingest", status_code=202)
+async def ingest(request: Request, files: List[UploadFile] = File(...), max_chars: int = Query(MAX_FILE_CHARS, ge=1, le=MAX_FILE_CHARS_LIMIT)):
+    """
+    Endpoint para ingerir un lote grande de archivos (o zips) en segundo plano.
+
+    Los documentos se extraen, se guardan en la caché y se indexan para la sesión;
+    el progreso se consulta en /ingest/{job_id}.
+
+    Args:
+        files (List[UploadFile]): Archivos a procesar.
+        max_chars (int): Caracteres máximos a extraer de cada archivo.
+
+    Returns:
+        dict: Id del trabajo, número de archivos y URL de estado.
+
+    Raises:
+        HTTPException: Si un zip no es válido o el lote supera los límites.
+    """
+    # Las subidas se cierran al terminar la petición: copiarlas a una carpeta del trabajo
+    folder = tempfile.mkdtemp(dir=UPLOAD_TMP_DIR, prefix="ingest-")
+    uploads = []
+    try:
+        for position, file in enumerate(files):
+            path = os.path.join(folder, str(position))
+            with open(path, "wb") as f:
+                await asyncio.to_thread(shutil.copyfileobj, file.file, f)
+            uploads.append((file.filename, open(path, "rb")))
+        items = batch_items(uploads)
+    except Exception:
+        for _, handle in uploads:
+            handle.close()
+        shutil.rmtree(folder, ignore_errors=True)
+        raise
+
+    job = ingest_jobs.start(request.cookies.get("session_id"), folder, [handle for _, handle in uploads], items, max_chars)
+    return {"job_id": job["job_id"], "total": job["total"], "status_url": f"/ingest/{job['job_id']}"}
+
+
+@app.get("/ingest/{job_id}")
+async def ingest_status(job_id: str):
+    """
+    Endpoint para consultar el progreso de un trabajo de /ingest.
+
+    Returns:
+        dict: Estado, archivos procesados y fallidos, y el resumen de cada archivo.
+
+    Raises:
+        HTTPException: Si el trabajo no existe.
+    """
+    job = ingest_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return job
+
+
+async def build_context(prompt_request: PromptRequest, session_id: Optional[str]) -> tuple:
+    """
+    Construye el bloque de contexto con el texto de los archivos de la sesión
+
+    Si la sesión tiene documentos indexados se añaden solo los fragmentos más relevantes
+    para el input; si no, el texto de los archivos adjuntos (si los hay), ya sea en
+    `file_text` o referenciados por id en `document_ids`.
+
+    Returns:
+        tuple: (contexto, fuentes consultadas o None, si el contexto viene del índice)
+
+    Raises:
+        HTTPException: 404 si algún documento de `document_ids` ya no está en el almacén
+    """
+    documents = await asyncio.to_thread(request_documents, prompt_request, session_id) if prompt_request.document_ids else []
+    attached = bool(prompt_request.file_text or documents)
+    if RAG_ENABLED and session_id:
+        await restore_index(session_id)
+        # Un documento referenciado (quizá subido en otra sesión) pasa a estar en el índice de esta
+        for doc_id, document in zip(prompt_request.document_ids or [], documents):
+            await index_document(session_id, doc_id, document["name"], document["text"])
+
+    if RAG_ENABLED and retrieval_index.documents(session_id):
+        query_embedding = await embed([prompt_request.prompt])
+        # Con un archivo recién adjuntado siempre se incluye algo de él aunque no haya coincidencias
+        results = retrieval_index.search(
+            session_id, prompt_request.prompt, RAG_TOP_K,
+            query_embedding=query_embedding[0] if query_embedding is not None else None,
+            fallback=attached
+        )
+        if results:
+            context = "".join(
+                f"\n\nFragmento {chunk_id + 1} del archivo con nombre {name}:\n{index.chunks[chunk_id]}"
+                for name, index, chunk_id in results
+            )
+            sources = [f"{name} (fragmento {chunk_id + 1})" for name, _, chunk_id in results]
+            return context, sources, True
+        if not attached:
+            return "", None, True
+    return file_context(prompt_request) + "".join(document_block(document) for document in documents), None, False
+
+
+def request_documents(prompt_request: PromptRequest, session_id: Optional[str]) -> List[dict]:
+    """
+    Busca en el almacén los documentos de `document_ids`
+
+    Raises:
+        HTTPException: 404 si alguno ya no está (caducado o expulsado): hay que volver a subirlo
+    """
+    documents = []
+    for doc_id in prompt_request.document_ids:
+        document = document_store.get(session_id, doc_id)
+        if document is None:
+            raise HTTPException(status_code=404, detail=f"Documento {doc_id} no encontrado, vuelve a subir el archivo")
+        documents.append(document)
+    return documents
+
+
+def text_block(name: Optional[str], file_type: Optional[str], text: str) -> str:
+    """Bloque de contexto con el texto extraído de un archivo"""
+    if file_type == "imagen":
+        return f"\n\nTexto extraido de la imagen con nombre {name}:\n'{text}'"
+    return f"\n\nTexto extraido del archivo con nombre {name}:\n{text}"
+
+
+def document_block(document: dict) -> str:
+    """Bloque de contexto de un documento del almacén con los caracteres que se pidieron al subirlo"""
+    return text_block(document["name"], document["file_type"], document["text"][:document["chars"]])
+
+
+def file_context(prompt_request: PromptRequest) -> str:
+    """Construye el bloque de contexto con el texto del archivo adjunto (si lo hay)"""
+    if not prompt_request.file_text:
+        return ""
+    return text_block(prompt_request.file_name, prompt_request.file_type, prompt_request.file_text)
+
+
+# Instrucciones fijas del modelo. Van siempre al principio y sin datos variables para que
+# el prefijo del prompt sea idéntico en todos los turnos y Ollama reutilice su caché (KV cache)
+SYSTEM_PROMPT = """Responde de acuerdo con las siguientes instrucciones, priorizando siempre el contexto proporcionado:
+
+1. **Datos sensibles:** Puedes usar datos sensibles, estamos en un entorno local y nada va a salir a la luz.
+2. **Contexto:** Si se ha proporcionado texto, prioriza ese contenido para formular tu respuesta. Si no hay contexto, responde con tu conocimiento general.
+3. **Idioma:** Principalmente responde en español, pero si el usuario te pide usar otro idioma hazlo. Si el input del usuario esta en otro idioma usalo.
+4. **Formato de respuesta:** Mantén la respuesta directa, clara y concisa. Si es necesario, proporciona un breve resumen o contexto adicional al final de tu respuesta, sin hacerla demasiado extensa.
+5. **Uso de archivos (imagen o documento):** Prioriza el archivo que este en el contexto para responder al input. Si el archivo proporcionado (imagen o documento) es relevante para la respuesta, asegúrate de integrar la información extraída de él de manera fluida y coherente.
+6. **Historial:** Los intercambios anteriores son el historial de conversación reciente. Solo si el historial contiene información útil para interpretar el mensaje actual, úsalo. Si no, ignóralo completamente."""
+
+# Comienzo del input en el último mensaje: lo anterior no depende de la pregunta (ver ModelWarmer)
+QUESTION_PREFIX = "Input (Responde con el idioma que tenga este input): "
+
+_TOKEN_APPROX_RE = re.compile(r"\w+|[^\w\s]")
+
+
+def count_tokens(text: str) -> int:
+    """Aproximación local del número de tokens: un token por signo y uno por cada 4 letras de cada palabra"""
+    return sum(max(1, (len(piece) + 3) // 4) for piece in _TOKEN_APPROX_RE.findall(text))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Recorta el texto para que ocupe como mucho `max_tokens` tokens (aproximados)"""
+    if max_tokens <= 0:
+        return ""
+    tokens = count_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    return text[:len(text) * max_tokens // tokens]
+
+
+def document_hash(text: str) -> str:
+    """Huella corta del texto de un documento para reconocerlo cuando se repite en el historial"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def pending_turns(history: List[dict], summary: Optional[dict]) -> List[dict]:
+    """Intercambios del historial que todavía no están incluidos en el resumen de la sesión"""
+    if summary is None:
+        return history
+    through = summary["through"]
+    if isinstance(through, str):
+        # Resúmenes guardados antes de numerar los intercambios: `through` era el id del último
+        for index, entry in enumerate(history):
+            if entry.get("id") == through:
+                return history[index + 1:]
+        return history
+    # Por número de orden: aunque el último intercambio resumido ya no esté guardado, los
+    # anteriores a él siguen cubiertos por el resumen
+    return [entry for entry in history if entry["seq"] > through]
+
+
+def build_messages(prompt_request: PromptRequest, context: str, session_id: Optional[str]) -> List[dict]:
+    """
+    Construye los mensajes para el modelo respetando el tamaño de contexto (NUM_CTX)
+
+    Orden: instrucciones fijas, resumen de los intercambios antiguos, historial reciente
+    (solo crece por el final) y por último el contexto del documento junto con el input,
+    que son lo que cambia en cada turno. Un documento que ya aparece antes en el prompt
+    (o que es el del contexto actual) no se repite: se sustituye por una referencia.
+    Si no cabe todo se recorta el contexto del documento y se quitan los turnos más antiguos.
+
+    Lee el historial y los documentos de los almacenes (con sqlite, del disco), así que
+    desde el bucle de eventos se llama con asyncio.to_thread.
+    """
+    num_predict = prompt_request.max_tokens if prompt_request.max_tokens else 512
+    available = NUM_CTX - num_predict - count_tokens(SYSTEM_PROMPT)
+
+    entries = session_store.history(session_id)
+    if HISTORY_SUMMARY:
+        summary = session_store.summary(session_id)
+        # Mientras se escribe el resumen nuevo los intercambios pendientes siguen yendo literales
+        entries = pending_turns(entries, summary)[-(HISTORY_TURNS + HISTORY_SUMMARY_BATCH):]
+    else:
+        summary = None
+        entries = entries[-HISTORY_TURNS:]
+    summary_message = f"Resumen de la conversación anterior:\n{summary['text']}" if summary else ""
+    available -= count_tokens(summary_message)
+
+    # Incluir el historial de la sesión en el prompt. Los documentos del almacén se
+    # identifican por su id y los copiados en el historial por el hash de su texto
+    current = set(prompt_request.document_ids or [])
+    if context:
+        current.add(document_hash(context))
+    seen = set(current)
+    history = []
+    for entry in entries:
+        user = f"Hora de entrada: {entry['timestamp']}\nUsuario: {entry['user_input']}"
+        # Los documentos indexados no se repiten: sus fragmentos se buscan de nuevo en cada turno
+        documents = [] if entry.get("retrieved") else [(doc_id, None) for doc_id in entry.get("document_ids", [])]
+        if entry['Former_document_text']:
+            documents.append((entry.get("document_hash") or document_hash(entry['Former_document_text']), entry['Former_document_text']))
+        for digest, text in documents:
+            if digest in current:
+                user += "\n(Pasó el mismo archivo que está en el contexto disponible)"
+            elif digest in seen:
+                user += "\n(Pasó el mismo archivo que en un intercambio anterior)"
+            else:
+                if text is None:
+                    document = document_store.get(session_id, digest)
+                    if document is None:
+                        continue
+                    text = "Archivo pasado anteriormente, usalo solo si no hay uno en el contexto: " + document_block(document)
+                seen.add(digest)
+                user += f"\n{text}"
+        history.append((user, entry['model_response'], count_tokens(user) + count_tokens(entry['model_response'])))
+
+    question = f"{QUESTION_PREFIX}{prompt_request.prompt}\n\nRespuesta concisa:"
+    available -= count_tokens(question)
+
+    # El documento tiene prioridad, pero se reserva hasta un cuarto del espacio para el historial
+    history_tokens = sum(tokens for _, _, tokens in history)
+    context = truncate_tokens(context, available - min(history_tokens, available // 4))
+    available -= count_tokens(context)
+    while history and history_tokens > available:
+        history_tokens -= history.pop(0)[2]
+
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    if summary_message:
+        messages.append({"role": "system", "content": summary_message})
+    for user, assistant, _ in history:
+        messages.append({"role": "user", "content": user})
+        messages.append({"role": "assistant", "content": assistant})
+    messages.append({"role": "user", "content": f"Contexto disponible:\n{context if context else 'Sin contexto específico'}\n\n{question}"})
+    return messages
+
+
+def messages_to_prompt(messages: List[dict]) -> str:
+    """Convierte los mensajes en un único prompt para /api/generate (con el mismo orden)"""
+    history = "\n".join(
+        f"Modelo: {message['content']}" if message["role"] == "assistant" else f"{message['content']}"
+        for message in messages[1:-1]
+    )
+    return f"{messages[0]['content']}\n\nHistorial de conversación reciente:\n{history if history else 'No hay historial previo.'}\n\n{messages[-1]['content']}"
+
 
-# Configuración del middleware de sesiones
-app.add_middleware(SessionMiddleware, secret_key="vivan_las_practicas")
+def choose_model(prompt_request: PromptRequest, context: str, messages: List[dict]) -> str:
+    """
+    Usa MODEL_SMALL para los prompts cortos sin documento (ni `file_text`, ni `document_ids`,
+    ni fragmentos del índice en el contexto) y MODEL_NAME para el resto
+    """
+    if prompt_request.file_text or prompt_request.document_ids or context:
+        return MODEL_NAME
+    if MODEL_SMALL and sum(count_tokens(message["content"]) for message in messages) <= MODEL_SMALL_MAX_TOKENS:
+        return MODEL_SMALL
+    return MODEL_NAME
 
-# Diccionario para almacenar los historiales de las sesiones (en memoria)
-session_histories = {}
 
-@app.get("/", include_in_schema=False)
-async def chat_interface(request: Request):
+def build_payload(prompt_request: PromptRequest, context: str, messages: List[dict], stream: bool) -> dict:
+    """Construye el cuerpo de la petición a Ollama (/api/chat o /api/generate según OLLAMA_API)"""
+    payload = {
+        "model": choose_model(prompt_request, context, messages),
+        "stream": stream,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "options": {
+            "num_predict": prompt_request.max_tokens if prompt_request.max_tokens else 512,
+            "num_ctx": NUM_CTX,
+            "temperature": generation_temperature(prompt_request),
+            "top_p": 0.9
+        }
+    }
+    if OLLAMA_API == "chat":
+        payload["messages"] = messages
+    else:
+        payload["prompt"] = messages_to_prompt(messages)
+    return payload
+
+
+def generation_temperature(prompt_request: PromptRequest) -> float:
+    return prompt_request.temperature if prompt_request.temperature is not None else GENERATION_TEMPERATURE
+
+
+class ResponseCache:
     """
-    Endpoint principal que sirve la interfaz web de chat con manejo de sesión
-    
-    Args:
-        request (Request): Objeto de solicitud FastAPI
-    
-    Returns:
-        TemplateResponse: Renderiza la plantilla index.html
+    Caché de respuestas de Ollama con coalescencia de peticiones idénticas.
+
+    La clave es un hash del modelo, las opciones y los mensajes. Si llega una petición
+    idéntica a otra que todavía se está generando, espera a esa misma llamada en lugar
+    de lanzar otra generación (single-flight).
     """
-    # Recuperar o generar un session_id
-    session_id = request.cookies.get("session_id")
-    
-    if not session_id:
-        session_id = str(uuid.uuid4())  # Generar un ID de sesión nuevo si no existe
 
-    # Limpiar historial anterior (si existiera)
-    session_histories.pop(session_id, None)
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # clave -> (respuesta de Ollama, instante de creación)
+        self._inflight = {}  # clave -> asyncio.Future con la respuesta
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
 
-    # Establecer la cookie de la sesión
-    response = templates.TemplateResponse("index.html", {"request": request, "session_id": session_id})
-    response.set_cookie("session_id", session_id)
-    
-    return response
+    @staticmethod
+    def key(payload: dict) -> str:
+        """Hash normalizado de lo que determina la respuesta (sin stream ni keep_alive)"""
+        relevant = {name: payload.get(name) for name in ("model", "options", "messages", "prompt")}
+        return hashlib.sha256(json.dumps(relevant, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
 
-class PromptRequest(BaseModel):
-    """Modelo Pydantic para las solicitudes de generación de texto"""
-    prompt: str
-    max_tokens: Optional[int] = None
-    file_type: Optional[str] = None
-    file_name: Optional[str] = None
-    file_text: Optional[str] = None  
+    @staticmethod
+    def cacheable(prompt_request: PromptRequest) -> bool:
+        """Con temperatura > 0 las respuestas varían, así que solo se cachean si se configura"""
+        return prompt_request.use_cache and (generation_temperature(prompt_request) == 0 or RESPONSE_CACHE_NONZERO_TEMPERATURE)
 
-class SimplifiedResponse(BaseModel):
-    """Modelo Pydantic para las respuestas simplificadas"""
-    model: str
-    response: str
-    sources: Optional[List[str]] = None
-    context_used: bool = False
+    def get(self, key: str) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None or time.time() - entry[1] > self.ttl:
+            self._entries.pop(key, None)
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
 
+    def put(self, key: str, ollama_data: dict):
+        self._entries[key] = (ollama_data, time.time())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
 
-def read_pdf(file_path: str) -> str:
-    """Lee el contenido de un archivo PDF y extrae el texto"""
-    try:
-        doc = fitz.open(file_path)
-        text = ""
-        for page in doc:
-            text += page.get_text("text")
-        return text
-    except Exception as e:
-        logger.error(f"Error al leer el PDF: {str(e)}")
-        return ""
+    async def get_or_fetch(self, key: str, fetch) -> dict:
+        """Devuelve la respuesta cacheada, la de una petición idéntica en curso o la de `fetch()`"""
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        if key in self._inflight:
+            self.coalesced += 1
+            return await asyncio.shield(self._inflight[key])
 
-def read_docx(file_path: str) -> str:
-    """Lee el contenido de un archivo DOCX y extrae el texto"""
-    try:
-        doc = Document(file_path)
-        text = ""
-        for para in doc.paragraphs:
-            text += para.text + "\n"
-        return text
-    except Exception as e:
-        logger.error(f"Error al leer el DOCX: {str(e)}")
-        return ""
-    
-def read_txt(file_path: str) -> str:
-    """Lee el contenido de un archivo TXT y extrae el texto"""
-    try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            text = file.read()
-        return text
-    except Exception as e:
-        logger.error(f"Error al leer el TXT: {str(e)}")
-        return ""
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        # Evita el aviso de "excepción no recuperada" si nadie más esperaba esta respuesta
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[key] = future
+        try:
+            ollama_data = await fetch()
+            self.put(key, ollama_data)
+            future.set_result(ollama_data)
+            return ollama_data
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self._inflight[key]
 
-def read_pptx(file_path: str) -> str:
-    """Lee el contenido de un archivo PPTX y extrae el texto"""
-    try:
-        prs = Presentation(file_path)
-        text = ""
-        for slide in prs.slides:
-            for shape in slide.shapes:
-                if hasattr(shape, "text"):
-                    text += shape.text + "\n"
-        return text
-    except Exception as e:
-        logger.error(f"Error al leer el PPTX: {str(e)}")
-        return ""
-    
-def read_xlsx(file_path: str) -> str:
-    """Lee el contenido de un archivo XLSX y extrae el texto de todas las celdas"""
-    try:
-        # Cargar el archivo Excel
-        wb = openpyxl.load_workbook(file_path, data_only=True)
-        sheet = wb.active  # Obtener la hoja activa
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_ratio": round((self.hits + self.coalesced) / lookups, 3) if lookups else 0.0,
+        }
 
-        text = ""
-        # Iterar sobre todas las filas y columnas de la hoja activa
-        for row in sheet.iter_rows():
-            for cell in row:
-                if cell.value:
-                    text += str(cell.value) + "\t"  # Usamos tabulador para separar los valores
-            text += "\n"  # Nueva línea para cada fila
 
-        return text.strip()  # Eliminar espacios adicionales al final
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL)
 
-    except Exception as e:
-        logger.error(f"Error al leer el XLSX: {str(e)}")
-        return ""
 
-def read_image(file_path: str) -> str:
-    """Lee el contenido de una imagen JPG y extrae el texto usando OCR (easyOCR)."""
-    try:
-        # Crear un objeto Reader de easyOCR para el idioma deseado (puedes usar 'es' para español, por ejemplo)
-        reader = easyocr.Reader(['es','en'])  # Usa ['es'] para español, ['en'] para inglés, o ambos.
+class FairScheduler:
+    """
+    Control de admisión de las generaciones enviadas a Ollama.
 
-        # Usar easyOCR para extraer el texto de la imagen
-        result = reader.readtext(file_path)
+    Deja pasar como mucho `max_concurrency` generaciones a la vez. El resto espera en
+    una cola acotada por prioridad y, dentro de cada prioridad, se atiende por turnos a
+    cada sesión para que un usuario con muchas peticiones no acapare el modelo. Si la
+    cola está llena se responde 429 y si se espera más de `timeout` segundos, 503.
+    """
 
-        # Extraer el texto de la salida de easyOCR
-        text = ""
-        for detection in result:
-            text += detection[1] + "\n"  # El texto extraído está en la segunda posición de la tupla
+    def __init__(self, max_concurrency: int, max_queue: int, timeout: float):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.active = 0
+        self.queued = 0
+        self._queues = {}  # prioridad -> OrderedDict(session_id -> deque de futures)
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._service_time = 10.0  # Media móvil de la duración de una generación (para Retry-After)
 
-        return text.strip()  # Eliminar espacios adicionales al final
+    def _retry_after(self) -> str:
+        """Estimación de los segundos hasta que haya hueco"""
+        return str(max(1, int(self._service_time * (self.queued + 1) / self.max_concurrency)))
 
-    except Exception as e:
-        logger.error(f"Error al leer la imagen: {str(e)}")
-        return ""
+    async def acquire(self, session_id: Optional[str], priority: int = 1) -> float:
+        """
+        Espera un hueco para generar; hay que llamar a release() al terminar
 
-@app.post("/upload_file")
-async def upload_file(file: UploadFile = File(...)):
+        Returns:
+            float: Instante en que se concedió el hueco (se pasa a release())
+        """
+        start = time.perf_counter()
+        if self.active < self.max_concurrency and self.queued == 0:
+            self.active += 1
+        else:
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                raise HTTPException(429, detail="Demasiadas peticiones en cola, inténtalo más tarde", headers={"Retry-After": self._retry_after()})
+
+            future = asyncio.get_running_loop().create_future()
+            sessions = self._queues.setdefault(min(max(priority, 0), 2), OrderedDict())
+            sessions.setdefault(session_id, deque()).append(future)
+            self.queued += 1
+            try:
+                await asyncio.wait_for(asyncio.shield(future), self.timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if future.done():
+                    # Se concedió el hueco justo a la vez: devolverlo
+                    self.release()
+                else:
+                    future.cancel()
+                    self._remove(sessions, session_id, future)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                self.timeouts += 1
+                raise HTTPException(503, detail="El modelo está saturado, inténtalo más tarde", headers={"Retry-After": self._retry_after()})
+
+        waited = time.perf_counter() - start
+        record("queue_wait", waited)
+        self.admitted += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        return time.perf_counter()
+
+    def try_acquire(self) -> Optional[float]:
+        """Ocupa un hueco solo si hay uno libre y nadie esperando (para trabajo opcional); None si no"""
+        if self.active >= self.max_concurrency or self.queued:
+            return None
+        self.active += 1
+        return time.perf_counter()
+
+    def _remove(self, sessions: OrderedDict, session_id: Optional[str], future: asyncio.Future):
+        waiters = sessions.get(session_id)
+        if waiters is not None and future in waiters:
+            waiters.remove(future)
+            self.queued -= 1
+            if not waiters:
+                del sessions[session_id]
+
+    def release(self, started: Optional[float] = None):
+        """Libera el hueco y se lo pasa a la siguiente petición (por prioridad y por turnos entre sesiones)"""
+        if started is not None:
+            self._service_time = 0.8 * self._service_time + 0.2 * (time.perf_counter() - started)
+
+        for priority in sorted(self._queues):
+            sessions = self._queues[priority]
+            while sessions:
+                session_id, waiters = next(iter(sessions.items()))
+                future = waiters.popleft()
+                self.queued -= 1
+                if waiters:
+                    sessions.move_to_end(session_id)  # La sesión pasa al final de la ronda
+                else:
+                    del sessions[session_id]
+                if not future.done():
+                    future.set_result(None)  # El hueco pasa directamente a esta petición
+                    return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, session_id: Optional[str], priority: int = 1):
+        started = await self.acquire(session_id, priority)
+        try:
+            yield
+        finally:
+            self.release(started)
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "max_concurrency": self.max_concurrency,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "wait_avg_seconds": round(self.wait_total / self.admitted, 3) if self.admitted else 0.0,
+            "wait_max_seconds": round(self.wait_max, 3),
+        }
+
+
+scheduler = FairScheduler(OLLAMA_MAX_CONCURRENCY, OLLAMA_MAX_QUEUE, OLLAMA_QUEUE_TIMEOUT)
+
+
+def client_priority(prompt_request: PromptRequest) -> int:
+    """Prioridad pedida por el cliente; no puede colarse por delante de la normal"""
+    return min(max(prompt_request.priority, 1), 2)
+
+
+def ollama_path() -> str:
+    return "/api/chat" if OLLAMA_API == "chat" else "/api/generate"
+
+
+def response_text(ollama_data: dict) -> str:
+    """Texto generado en una respuesta (o fragmento) de /api/chat o /api/generate"""
+    if "message" in ollama_data:
+        return ollama_data["message"].get("content", "")
+    return ollama_data.get("response", "")
+
+
+def log_prompt(messages: List[dict]):
+    """Escribe el prompt completo en el log solo en una fracción de las peticiones (PROMPT_LOG_SAMPLE_RATE)"""
+    if PROMPT_LOG_SAMPLE_RATE > 0 and random.random() < PROMPT_LOG_SAMPLE_RATE:
+        logger.info(messages_to_prompt(messages))
+    elif logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Prompt de {len(messages)} mensajes y {sum(len(message['content']) for message in messages)} caracteres")
+
+
+def observe_generation(ollama_data: dict, model: str):
+    """Publica los contadores que devuelve Ollama al terminar (tokens y tokens por segundo)"""
+    eval_count = ollama_data.get("eval_count", 0)
+    eval_duration = ollama_data.get("eval_duration", 0)  # En nanosegundos
+    metrics.inc("ollama_prompt_tokens_total", ollama_data.get("prompt_eval_count", 0), model=model)
+    metrics.inc("ollama_generated_tokens_total", eval_count, model=model)
+    if eval_count and eval_duration:
+        metrics.observe("ollama_tokens_per_second", eval_count / (eval_duration / 1e9), buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300), model=model)
+
+
+SUMMARY_PROMPT = """Eres un asistente que resume conversaciones. Recibirás el resumen actual de una conversación y los intercambios nuevos entre el usuario y el modelo.
+Escribe un resumen actualizado que los combine: conserva los datos concretos, nombres, cifras, decisiones, preferencias del usuario y preguntas pendientes, y omite saludos y repeticiones.
+Escribe en el idioma de la conversación y responde solo con el resumen, sin introducciones."""
+
+
+class HistoryCompactor:
     """
-    Endpoint para cargar documentos (PDF, DOCX, TXT, PPTX) o imágenes (JPG, PNG, JPEG, WEBP).
-    
-    - Extrae texto de documentos.
-    - Convierte imágenes a Base64.
-    
-    Args:
-        file (UploadFile): Archivo a procesar.
-    
-    Returns:
-        dict: Texto extraído o imagen en Base64.
+    Resume en segundo plano los intercambios antiguos de cada sesión.
+
+    El prompt lleva los últimos `recent_turns` intercambios literales y un resumen de
+    todo lo anterior, así su tamaño no crece con la conversación. Cuando quedan `batch`
+    intercambios sin resumir fuera de esa ventana se pide al modelo un resumen nuevo (el
+    anterior más esos intercambios), fuera de la petición y con prioridad baja en la
+    cola. Se resumen varios de una vez para que el principio del prompt, y con él la
+    caché de prompt de Ollama, cambie pocas veces.
     """
-    try:
-        file_ext = file.filename.split(".")[-1].lower()
-        temp_file_path = f"temp_{uuid.uuid4()}.{file_ext}"
 
-        with open(temp_file_path, "wb") as f:
-            f.write(await file.read())
-        
-        match file_ext:
-            case "pdf":
-                # 📜 Leer texto de PDF
-                text = read_pdf(temp_file_path)
-            case "docx":
-                # 📜 Leer texto de DOCX
-                text = read_docx(temp_file_path)
-            case "txt":
-                # 📜 Leer texto de TXT
-                text = read_txt(temp_file_path)
-            case "pptx":
-                # 📜 Leer texto de PPTX
-                text = read_pptx(temp_file_path)
-            case "xlsx":
-                # 📜 Leer texto de XLSX
-                text = read_xlsx(temp_file_path)
-            case "jpg" | "png" | "jpeg" | "webp":
-                # 🖼️ Leer texto de imagen
-                text = read_image(temp_file_path)
-            case _:
-                os.remove(temp_file_path)
-                raise HTTPException(status_code=400, detail="Formato de archivo no soportado")
+    def __init__(self, recent_turns: int, batch: int, max_tokens: int, model: str):
+        self.recent_turns = recent_turns
+        self.batch = batch
+        self.max_tokens = max_tokens
+        self.model = model
+        self._tasks = {}  # session_id -> tarea en curso
+        self.completed = 0
+        self.failed = 0
 
-        # Eliminar archivo temporal después de procesarlo
-        os.remove(temp_file_path)
+    def schedule(self, session_id: Optional[str]):
+        """Lanza la compactación de la sesión si no hay ya una en marcha"""
+        if not session_id or session_id in self._tasks:
+            return
+        task = asyncio.create_task(self._run(session_id))
+        self._tasks[session_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(session_id, None))
 
-        # Devolver respuesta con el texto extraído y el nombre del archivo
-        return {"file_type": "documento" if file_ext in ["pdf", "docx", "txt", "pptx", "xlsx"] else "imagen", "file_text": text[:8000], "file_name": file.filename}
+    async def _run(self, session_id: str):
+        # Traza propia: la petición que la lanzó ya ha terminado
+        with trace():
+            try:
+                while True:
+                    history = await asyncio.to_thread(session_store.history, session_id)
+                    summary = await asyncio.to_thread(session_store.summary, session_id)
+                    pending = pending_turns(history, summary)
+                    fold = pending[:max(0, len(pending) - self.recent_turns)]
+                    if len(fold) < self.batch or fold[-1].get("seq") is None:
+                        return
+                    with span("history_summary"):
+                        text = await self.summarize(session_id, summary, fold)
+                    if not text:
+                        raise ValueError("el modelo devolvió un resumen vacío")
+                    turns = (summary["turns"] if summary else 0) + len(fold)
+                    # Los ids de los documentos resumidos se conservan para poder volver a indexarlos
+                    document_ids = session_document_ids(fold, summary)
+                    await asyncio.to_thread(session_store.set_summary, session_id, {"text": text, "through": fold[-1]["seq"], "turns": turns, "document_ids": document_ids})
+                    self.completed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                logger.warning(f"No se pudo resumir el historial de la sesión {session_id}: {str(e)}")
 
-        
-    except Exception as e:
-        logger.error(f"Error al procesar el archivo: {str(e)}")
-        raise HTTPException(status_code=500, detail="Error al procesar el archivo")
+    async def summarize(self, session_id: str, summary: Optional[dict], turns: List[dict]) -> str:
+        """Pide al modelo el resumen anterior actualizado con los intercambios `turns`"""
+        exchanges = []
+        for entry in turns:
+            # Los documentos no se resumen: siguen disponibles en el índice de la sesión
+            user = entry["user_input"] + (" (con un archivo adjunto)" if entry["Former_document_text"] or entry.get("document_ids") else "")
+            exchanges.append(f"Usuario: {user}\nModelo: {truncate_tokens(entry['model_response'], self.max_tokens)}")
+        previous = summary["text"] if summary else "No hay resumen previo."
+        messages = [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": f"Resumen actual:\n{previous}\n\nIntercambios nuevos:\n" + "\n\n".join(exchanges) + "\n\nResumen actualizado:"},
+        ]
+        payload = {
+            "model": self.model or MODEL_SMALL or MODEL_NAME,
+            "stream": False,
+            "keep_alive": OLLAMA_KEEP_ALIVE,
+            "options": {"num_predict": self.max_tokens, "num_ctx": NUM_CTX, "temperature": 0.2},
+        }
+        if OLLAMA_API == "chat":
+            payload["messages"] = messages
+        else:
+            payload["prompt"] = f"{messages[0]['content']}\n\n{messages[1]['content']}"
+
+        async with scheduler.slot(session_id, 2):
+            response = await ollama_post(ollama_path(), payload, session_id=session_id)
+        ollama_data = response.json()
+        observe_generation(ollama_data, payload["model"])
+        return truncate_tokens(response_text(ollama_data).strip(), self.max_tokens)
+
+    def shutdown(self):
+        for task in self._tasks.values():
+            task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "running": len(self._tasks),
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+
+history_compactor = HistoryCompactor(HISTORY_TURNS, HISTORY_SUMMARY_BATCH, HISTORY_SUMMARY_MAX_TOKENS, HISTORY_SUMMARY_MODEL)
+
+
+class ModelWarmer:
+    """
+    Mantiene los modelos cargados en Ollama y adelanta la lectura de los prompts.
+
+    - Al arrancar, y después cada `interval` segundos, manda a cada servidor un
+      /api/generate sin prompt con keep_alive: Ollama carga el modelo si no lo tenía y
+      renueva el tiempo que lo mantiene en memoria, así la primera pregunta tras un rato
+      sin uso no paga la carga.
+    - Al terminar una subida lanza en segundo plano el principio del prompt que tendrá el
+      siguiente turno con num_predict=1. Ollama lee ese prefijo y lo guarda en su caché,
+      y cuando llega la pregunta solo le queda leer el final. Si el documento va entero
+      el prefijo llega hasta el final del documento; si se buscan fragmentos en el índice
+      (RAG), estos dependen de la pregunta, así que solo se adelantan las instrucciones,
+      el resumen y el historial. Solo se hace si hay hueco libre en la cola y si hay algo
+      que adelantar, para no retrasar a nadie.
+    """
+
+    def __init__(self, models: List[str]):
+        self.models = models
+        self._prefills = {}  # session_id -> tarea en curso
+        self.pings = 0
+        self.ping_failures = 0
+        self.last_ping = None
+        self.prefills = 0
+        self.prefills_skipped = 0
+        self.prefill_failures = 0
+
+    async def ping(self):
+        """Carga (o mantiene cargados) los modelos en todos los servidores sanos"""
+        async def warm(backend: OllamaBackend, model: str):
+            try:
+                # Con el mismo num_ctx que las generaciones: si cambia, Ollama vuelve a cargar el modelo
+                payload = {"model": model, "keep_alive": OLLAMA_KEEP_ALIVE, "stream": False, "options": {"num_ctx": NUM_CTX}}
+                response = await ollama_client.post(f"{backend.url}/api/generate", json=payload)
+                response.raise_for_status()
+                self.pings += 1
+            except httpx.HTTPError as e:
+                self.ping_failures += 1
+                logger.warning(f"No se pudo mantener cargado {model} en Ollama {backend.url}: {e}")
+
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            warm(backend, model)
+            for backend in ollama_backends.backends if backend.healthy
+            for model in self.models if backend.has_model(model)
+        ))
+        self.last_ping = time.time()
+        logger.info(f"Modelos cargados en Ollama en {time.perf_counter() - start:.2f}s: {', '.join(self.models)}")
+
+    async def run(self, interval: float):
+        # Saber antes qué servidores están sanos y qué modelos tienen
+        await ollama_backends.probe()
+        while True:
+            await self.ping()
+            await asyncio.sleep(interval)
+
+    def prefill(self, session_id: Optional[str], document_ids: List[str]):
+        """Lanza la lectura anticipada del prompt del siguiente turno (sustituye a la anterior de la sesión)"""
+        if not session_id or not document_ids:
+            return
+        previous = self._prefills.pop(session_id, None)
+        if previous is not None:
+            previous.cancel()
+        task = asyncio.create_task(self._prefill(session_id, document_ids))
+        self._prefills[session_id] = task
+
+        def forget(_):
+            if self._prefills.get(session_id) is task:
+                del self._prefills[session_id]
+
+        task.add_done_callback(forget)
+
+    async def _prefill(self, session_id: str, document_ids: List[str]):
+        # Traza propia: la subida que la lanzó ya ha respondido
+        with trace():
+            started = scheduler.try_acquire()
+            if started is None:
+                self.prefills_skipped += 1
+                return
+            try:
+                messages, model = await self.prefix_messages(session_id, document_ids)
+                if messages is None:
+                    self.prefills_skipped += 1
+                    return
+                payload = build_payload(PromptRequest(prompt=""), "", messages, stream=False)
+                payload["model"] = model
+                payload["options"]["num_predict"] = 1
+                with span("speculative_prefill"):
+                    await ollama_post(ollama_path(), payload, session_id=session_id)
+                self.prefills += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.prefill_failures += 1
+                logger.warning(f"No se pudo adelantar el prompt de la sesión {session_id}: {str(e)}")
+            finally:
+                scheduler.release()
+
+    @staticmethod
+    async def prefix_messages(session_id: str, document_ids: List[str]) -> tuple:
+        """
+        Mensajes que coinciden con el principio del prompt del siguiente turno
+
+        Returns:
+            tuple: (mensajes o None si solo coincidirían las instrucciones fijas, que ya
+                comparten todas las peticiones; modelo que usará ese turno)
+        """
+        # El mismo prompt que montará /generate con estos documentos, salvo la pregunta
+        prompt_request = PromptRequest(prompt="", document_ids=document_ids)
+        context, _, retrieved = await build_context(prompt_request, session_id)
+        messages = await asyncio.to_thread(build_messages, prompt_request, context, session_id)
+        model = choose_model(prompt_request, context, messages)
+        if retrieved:
+            # Los fragmentos se eligen con la pregunta: el último mensaje solo coincide en su cabecera
+            if len(messages) == 2:
+                return None, model
+            messages[-1] = {"role": "user", "content": "Contexto disponible:\n"}
+        else:
+            # Todo salvo la pregunta, que va al final
+            content = messages[-1]["content"]
+            messages[-1] = {"role": "user", "content": content[:content.rindex(QUESTION_PREFIX) + len(QUESTION_PREFIX)]}
+        return messages, model
+
+    def shutdown(self):
+        for task in self._prefills.values():
+            task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "models": self.models,
+            "pings": self.pings,
+            "ping_failures": self.ping_failures,
+            "last_ping_age_seconds": round(time.time() - self.last_ping, 1) if self.last_ping else None,
+            "prefills": self.prefills,
+            "prefills_skipped": self.prefills_skipped,
+            "prefill_failures": self.prefill_failures,
+        }
+
+
+model_warmer = ModelWarmer(OLLAMA_WARM_MODELS or list(dict.fromkeys(model for model in (MODEL_NAME, MODEL_SMALL, HISTORY_SUMMARY_MODEL) if model)))
+
+
+async def save_history(session_id: Optional[str], prompt_request: PromptRequest, model_response: str, retrieved: bool = False):
+    """Añade el intercambio actual al historial de la sesión y, si toca, resume los antiguos"""
+    ahora = datetime.now().strftime("%H:%M")
+    entry = {
+        "Former_document_text": "", "document_hash": None, "user_input": prompt_request.prompt,
+        "model_response": model_response, "timestamp": ahora, "retrieved": retrieved,
+        # Los documentos del almacén se guardan solo por id, aunque estén indexados: así
+        # cualquier worker puede volver a indexarlos (ver restore_index)
+        "document_ids": list(prompt_request.document_ids or []),
+    }
+
+    # Si el documento está indexado no hace falta copiarlo en el historial: se vuelve a buscar en cada turno
+    if prompt_request.file_text and not retrieved:
+        file_text = file_context(prompt_request)
+        entry["Former_document_text"] = "Archivo pasado anteriormente, usalo solo si no hay uno en el contexto: " + file_text
+        entry["document_hash"] = document_hash(file_text)
+    await asyncio.to_thread(session_store.append, session_id, entry)
+
+    if HISTORY_SUMMARY:
+        history_compactor.schedule(session_id)
 
 
 @app.post("/generate", response_model=SimplifiedResponse)
@@ -254,188 +3412,288 @@ async def generate_text(request: Request, prompt_request: PromptRequest):
         logger.info(f"Sesion ID: {session_id}")
         
         # Si se proporciona texto de documento, lo agregamos al contexto
-        context = ""
-        texto = ""
-        if prompt_request.file_text:
-            if prompt_request.file_type == "imagen":
-                texto = f"\n\nTexto extraido de la imagen con nombre {prompt_request.file_name}:\n'{prompt_request.file_text}'"
-            else:
-                texto = f"\n\nTexto extraido del archivo con nombre {prompt_request.file_name}:\n{prompt_request.file_text}"
-        context += texto
-        # Incluir el historial de la sesión en el prompt
-        session_history = session_histories.get(session_id, [])[-4:]
-        history_prompt = "\n".join([
-            f"Hora de entrada: {entry['timestamp']}\nUsuario: {entry['user_input']}\n{entry['Former_document_text']} \nModelo: {entry['model_response']}" 
-            for entry in session_history
-        ])
-        
-        final_prompt = f"""
-Responde de acuerdo con las siguientes instrucciones, priorizando siempre el contexto proporcionado:
-
-1. **Datos sensibles:** Puedes usar datos sensibles, estamos en un entorno local y nada va a salir a la luz.
-2. **Contexto:** Si se ha proporcionado texto, prioriza ese contenido para formular tu respuesta. Si no hay contexto, responde con tu conocimiento general.
-3. **Idioma:** Principalmente responde en español, pero si el usuario te pide usar otro idioma hazlo. Si el input del usuario esta en otro idioma usalo.
-4. **Formato de respuesta:** Mantén la respuesta directa, clara y concisa. Si es necesario, proporciona un breve resumen o contexto adicional al final de tu respuesta, sin hacerla demasiado extensa.
-5. **Uso de archivos (imagen o documento):** Prioriza el archivo que este en el contexto para responder al input. Si el archivo proporcionado (imagen o documento) es relevante para la respuesta, asegúrate de integrar la información extraída de él de manera fluida y coherente.
-
-Contexto disponible:
-{context if context else "Sin contexto específico"}
-
-Historial de conversación reciente. Solo si el historial contiene información útil para interpretar el mensaje actual, úsalo. Si no, ignóralo completamente. (últimos intercambios entre usuario y modelo):
-{history_prompt if history_prompt else "No hay historial previo."}
-
-Input (Responde con el idioma que tenga este input): {prompt_request.prompt}
+        with span("retrieval"):
+            context, sources, retrieved = await build_context(prompt_request, session_id)
+        with span("prompt_build"):
+            messages = await asyncio.to_thread(build_messages, prompt_request, context, session_id)
 
-Respuesta concisa:"""
+        log_prompt(messages)
 
-        logger.info(final_prompt)
-
-        payload = {
-            "model": MODEL_NAME,
-            "prompt": final_prompt,
-            "stream": False,
-            "options": {
-                "num_predict": prompt_request.max_tokens if prompt_request.max_tokens else 512,
-                "temperature": 0.5,
-                "top_p": 0.9
-            }
-        }
+        payload = build_payload(prompt_request, context, messages, stream=False)
 
         headers = {
             "Cookie": f"session_id={session_id}"  # Incluir el session_id en las cabeceras
         }
 
-        response = requests.post(f"{OLLAMA_HOST}/api/generate", json=payload, headers=headers)
-        response.raise_for_status()
-        ollama_data = response.json()
-
-        # Actualizar el historial de la sesión
-        if session_id not in session_histories:
-            session_histories[session_id] = []
-
-        ahora = datetime.now().strftime("%H:%M")
+        async def fetch() -> dict:
+            # Esperar turno en la cola antes de ocupar el modelo
+            async with scheduler.slot(session_id, client_priority(prompt_request)):
+                with span("ollama"):
+                    response = await ollama_post(ollama_path(), payload, headers=headers, session_id=session_id)
+            ollama_data = response.json()
+            # Sin streaming el primer token no se ve: se usa lo que tardó Ollama en cargar y leer el prompt
+            record("ollama_ttft", (ollama_data.get("load_duration", 0) + ollama_data.get("prompt_eval_duration", 0)) / 1e9)
+            observe_generation(ollama_data, payload["model"])
+            return ollama_data
 
-        if prompt_request.file_text:
-            session_histories[session_id].append({"Former_document_text": "Archivo pasado anteriormente, usalo solo si no hay uno en el contexto: " + texto, "user_input": prompt_request.prompt, "model_response": ollama_data.get("response", ""), "timestamp": ahora})
+        # Las peticiones idénticas (mismo modelo, opciones y prompt) comparten respuesta
+        if ResponseCache.cacheable(prompt_request):
+            ollama_data = await response_cache.get_or_fetch(ResponseCache.key(payload), fetch)
         else:
-            session_histories[session_id].append({"Former_document_text": "", "user_input": prompt_request.prompt, "model_response": ollama_data.get("response", ""), "timestamp": ahora})           
+            ollama_data = await fetch()
+
+        # Actualizar el historial de la sesión
+        await save_history(session_id, prompt_request, response_text(ollama_data), retrieved)
         
         return {
-            "model": ollama_data.get("model", MODEL_NAME),
-            "response": ollama_data.get("response", ""),
-            "sources": None,
+            "model": ollama_data.get("model", payload["model"]),
+            "response": response_text(ollama_data),
+            "sources": sources,
             "context_used": bool(context)
         }
 
-    except requests.exceptions.RequestException as e:
+    except HTTPException:
+        raise
+    except httpx.HTTPError as e:
         logger.error(f"Error en Ollama: {str(e)}")
         raise HTTPException(503, detail="Servicio de modelo no disponible")
     except Exception as e:
         logger.error(f"Error inesperado: {str(e)}", exc_info=True)
         raise HTTPException(500, detail="Error interno del servidor")
-    
 
-@app.post("/generate", response_model=SimplifiedResponse)
-async def generate_text(request: Request, prompt_request: PromptRequest):
+
+def sse_event(data: dict, event: Optional[str] = None) -> str:
+    """Formatea un evento Server-Sent Events"""
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/generate/stream")
+async def generate_text_stream(request: Request, prompt_request: PromptRequest):
     """
-    Endpoint para generación de respuestas inteligentes con documentos
-    
+    Endpoint de generación que envía la respuesta token a token (Server-Sent Events)
+
+    Cada fragmento llega como `data: {"token": "..."}`. Al terminar se envía un evento
+    `done` con los metadatos de la respuesta y se guarda el intercambio en el historial.
+    Si falla Ollama se envía un evento `error`.
+
     Args:
         request (Request): Objeto de solicitud FastAPI
         prompt_request (PromptRequest): Solicitud con el prompt y parámetros
-    
+
     Returns:
-        SimplifiedResponse: Respuesta generada con metadatos
-    
+        StreamingResponse: Flujo text/event-stream con los tokens generados
+    """
+    session_id = request.cookies.get("session_id")
+    logger.info(f"Sesion ID: {session_id}")
+
+    with span("retrieval"):
+        context, sources, retrieved = await build_context(prompt_request, session_id)
+    with span("prompt_build"):
+        messages = await asyncio.to_thread(build_messages, prompt_request, context, session_id)
+    log_prompt(messages)
+    payload = build_payload(prompt_request, context, messages, stream=True)
+
+    cache_key = ResponseCache.key(payload) if ResponseCache.cacheable(prompt_request) else None
+    cached = response_cache.get(cache_key) if cache_key else None
+    slot = {"started": None}
+    if cached is None:
+        # Esperar turno antes de empezar a responder, así los 429/503 llegan como códigos HTTP
+        slot["started"] = await scheduler.acquire(session_id, client_priority(prompt_request))
+
+    def release_slot():
+        # Se llama al terminar el stream y como tarea de fondo (por si el cliente se va antes de empezar)
+        if slot["started"] is not None:
+            scheduler.release(slot["started"])
+            slot["started"] = None
+
+    async def events():
+        parts = []
+        model = payload["model"]
+
+        if cached is not None:
+            # Respuesta ya generada para este mismo prompt: se envía de una vez
+            answer = response_text(cached)
+            await save_history(session_id, prompt_request, answer, retrieved)
+            yield sse_event({"token": answer})
+            yield sse_event({"model": cached.get("model", MODEL_NAME), "response": answer, "sources": sources, "context_used": bool(context)}, event="done")
+            return
+
+        start = time.perf_counter()
+        try:
+            async for chunk in ollama_stream(ollama_path(), payload, session_id=session_id):
+                model = chunk.get("model", model)
+                token = response_text(chunk)
+                if token:
+                    if not parts:
+                        record("ollama_ttft", time.perf_counter() - start)
+                    parts.append(token)
+                    yield sse_event({"token": token})
+                if chunk.get("done"):
+                    observe_generation(chunk, model)
+                    break
+        except httpx.HTTPError as e:
+            logger.error(f"Error en Ollama: {str(e)}")
+            yield sse_event({"detail": "Servicio de modelo no disponible"}, event="error")
+            return
+        finally:
+            record("ollama", time.perf_counter() - start)
+            release_slot()
+
+        # Actualizar el historial de la sesión con la respuesta completa
+        answer = "".join(parts)
+        if cache_key:
+            response_cache.put(cache_key, {"model": model, "response": answer})
+        await save_history(session_id, prompt_request, answer, retrieved)
+        yield sse_event({"model": model, "response": answer, "sources": sources, "context_used": bool(context)}, event="done")
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}, background=BackgroundTask(release_slot))
+
+
+@asynccontextmanager
+async def extract_service_lifespan(service: FastAPI):
+    """Arranca el pool de extracción (y el warm-up de OCR) del servicio compartido"""
+    extraction_pipeline.start()
+    startup.mark_ready()
+    yield
+    await extraction_pipeline.aclose()
+
+
+# Servicio de extracción compartido por los workers de chat (python app.py --role extract)
+extract_service = FastAPI(title="Servicio de extracción", lifespan=extract_service_lifespan)
+
+
+@extract_service.post("/extract")
+async def extract_service_extract(request: Request, ext: str = Query(...), max_chars: Optional[int] = Query(None, ge=1), path: Optional[str] = Query(None)):
+    """
+    Extrae el texto del archivo enviado en el cuerpo de la petición
+
+    Args:
+        ext (str): Extensión del archivo.
+        max_chars (int): Caracteres máximos a extraer.
+        path (str): Archivo ya volcado en UPLOAD_TMP_DIR a leer en vez del cuerpo.
+
+    Returns:
+        dict: Texto extraído, duración de cada etapa y contadores del OCR de cada worker del servicio.
+
     Raises:
-        HTTPException: 503 si Ollama no está disponible
-        HTTPException: 500 para otros errores internos
+        HTTPException: Si el formato no está soportado, la ruta no es válida o el pool está saturado (429)
     """
+    if file_format(ext) is None:
+        raise HTTPException(status_code=400, detail="Formato de archivo no soportado")
+
+    if path is not None:
+        # Solo se leen los temporales de las subidas, nunca rutas arbitrarias
+        source = os.path.realpath(path)
+        if os.path.dirname(source) != os.path.realpath(UPLOAD_TMP_DIR) or not os.path.isfile(source):
+            raise HTTPException(status_code=400, detail="Ruta de archivo no válida")
+    else:
+        source = await request.body()
+
     try:
-        session_id = request.cookies.get("session_id")
-        logger.info(f"Sesion ID: {session_id}")
-        
-        # Si se proporciona texto de documento, lo agregamos al contexto
-        context = ""
-        texto = ""
-        if prompt_request.file_text:
-            if prompt_request.file_type == "imagen":
-                texto = f"\n\nTexto extraido de la imagen con nombre {prompt_request.file_name}:\n'{prompt_request.file_text}'"
-            else:
-                texto = f"\n\nTexto extraido del archivo con nombre {prompt_request.file_name}:\n{prompt_request.file_text}"
-        context += texto
-        # Incluir el historial de la sesión en el prompt
-        session_history = session_histories.get(session_id, [])[-4:]
-        history_prompt = "\n".join([
-            f"Hora de entrada: {entry['timestamp']}\nUsuario: {entry['user_input']}\n{entry['Former_document_text']} \nModelo: {entry['model_response']}" 
-            for entry in session_history
-        ])
-        
-        final_prompt = f"""
-Responde de acuerdo con las siguientes instrucciones, priorizando siempre el contexto proporcionado:
+        with trace() as stages:
+            text = await extraction_pipeline.extract(request, ext, source, max_chars)
+    except ClientDisconnected:
+        raise HTTPException(status_code=499, detail="Cliente desconectado")
+    return {"text": text, "stages": stages, "ocr_workers": extraction_pipeline._worker_ocr}
 
-1. **Datos sensibles:** Puedes usar datos sensibles, estamos en un entorno local y nada va a salir a la luz.
-2. **Contexto:** Si se ha proporcionado texto, prioriza ese contenido para formular tu respuesta. Si no hay contexto, responde con tu conocimiento general.
-3. **Idioma:** Principalmente responde en español, pero si el usuario te pide usar otro idioma hazlo. Si el input del usuario esta en otro idioma usalo.
-4. **Formato de respuesta:** Mantén la respuesta directa, clara y concisa. Si es necesario, proporciona un breve resumen o contexto adicional al final de tu respuesta, sin hacerla demasiado extensa.
-5. **Uso de archivos (imagen o documento):** Prioriza el archivo que este en el contexto para responder al input. Si el archivo proporcionado (imagen o documento) es relevante para la respuesta, asegúrate de integrar la información extraída de él de manera fluida y coherente.
 
-Contexto disponible:
-{context if context else "Sin contexto específico"}
+@extract_service.get("/stats")
+async def extract_service_stats():
+    """Estadísticas del pool de extracción y del OCR del servicio"""
+    return {"ocr": extraction_pipeline.ocr_stats(), "extraction": extraction_pipeline.stats(), "startup": startup.stats()}
 
-Historial de conversación reciente. Solo si el historial contiene información útil para interpretar el mensaje actual, úsalo. Si no, ignóralo completamente. (últimos intercambios entre usuario y modelo):
-{history_prompt if history_prompt else "No hay historial previo."}
 
-Input (Responde con el idioma que tenga este input): {prompt_request.prompt}
+def wait_for_socket(process: subprocess.Popen, socket_path: str, timeout: float = 120):
+    """Espera a que el servicio de extracción abra su socket"""
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(socket_path):
+        if process.poll() is not None:
+            raise SystemExit(f"El servicio de extracción terminó al arrancar (código {process.returncode})")
+        if time.monotonic() > deadline:
+            process.terminate()
+            raise SystemExit(f"El servicio de extracción no abrió {socket_path} en {timeout:.0f}s")
+        time.sleep(0.1)
 
-Respuesta concisa:"""
 
-        logger.info(final_prompt)
+def main():
+    """
+    Arranca el servidor
 
-        payload = {
-            "model": MODEL_NAME,
-            "prompt": final_prompt,
-            "stream": False,
-            "options": {
-                "num_predict": prompt_request.max_tokens if prompt_request.max_tokens else 512,
-                "temperature": 0.5,
-                "top_p": 0.9
-            }
-        }
+    - `--role all` (por defecto): la APP completa. Con `--workers` > 1 arranca además un
+      servicio de extracción compartido en un socket unix y los workers le mandan las
+      extracciones, así el pool de procesos y el modelo de OCR se cargan una sola vez.
+    - `--role chat`: solo los workers de chat, contra un servicio de extracción ya
+      arrancado (EXTRACT_SERVICE o `--extract-socket`).
+    - `--role extract`: solo el servicio de extracción.
 
-        headers = {
-            "Cookie": f"session_id={session_id}"  # Incluir el session_id en las cabeceras
-        }
+    Al recibir SIGTERM/SIGINT se deja de aceptar peticiones y se esperan las que están en
+    curso (y los trabajos de /ingest) hasta `--drain-timeout` segundos.
+    """
+    parser = argparse.ArgumentParser(description="Chat con Ollama y extracción de documentos")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1, help="Procesos de uvicorn que atienden el chat")
+    parser.add_argument("--role", choices=["all", "chat", "extract"], default="all", help="Qué parte de la APP se arranca")
+    parser.add_argument("--extract-socket", default=os.path.join(tempfile.gettempdir(), "app-extract.sock"), help="Socket unix del servicio de extracción")
+    parser.add_argument("--drain-timeout", type=float, default=DRAIN_TIMEOUT, help="Segundos que se esperan las peticiones en curso al apagar")
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+    # Los workers importan el módulo de nuevo y leen la configuración de las variables de entorno
+    os.environ["DRAIN_TIMEOUT"] = str(args.drain_timeout)
 
-        response = requests.post(f"{OLLAMA_HOST}/api/generate", json=payload, headers=headers)
-        response.raise_for_status()
-        ollama_data = response.json()
+    if args.role == "extract":
+        if EXTRACT_SERVICE:
+            raise SystemExit("El servicio de extracción no puede usar a su vez EXTRACT_SERVICE")
+        if os.path.exists(args.extract_socket):
+            os.remove(args.extract_socket)  # Socket de una ejecución anterior que no se cerró bien
+        uvicorn.run("app:extract_service", uds=args.extract_socket, app_dir=APP_DIR, log_level=args.log_level, timeout_graceful_shutdown=args.drain_timeout)
+        return
 
-        # Actualizar el historial de la sesión
-        if session_id not in session_histories:
-            session_histories[session_id] = []
+    if args.workers > 1 and "SESSION_BACKEND" not in os.environ:
+        # Los historiales en memoria no se ven entre procesos
+        logger.info("Varios workers: se usa SESSION_BACKEND=sqlite para compartir las sesiones")
+        os.environ["SESSION_BACKEND"] = "sqlite"
 
-        ahora = datetime.now().strftime("%H:%M")
+    if args.workers > 1:
+        # Cada worker tiene su propio planificador: se reparte el límite entre ellos. Cada uno
+        # admite ceil(valor/workers) y al menos una, así que el total efectivo es
+        # workers * ceil(valor/workers), que supera el valor si no es múltiplo de los workers
+        for name, value in (("OLLAMA_MAX_CONCURRENCY", OLLAMA_MAX_CONCURRENCY), ("OLLAMA_MAX_QUEUE", OLLAMA_MAX_QUEUE)):
+            os.environ[name] = str(math.ceil(value / args.workers))
+        per_worker = int(os.environ["OLLAMA_MAX_CONCURRENCY"])
+        logger.info(f"Varios workers: cada uno manda a Ollama hasta {per_worker} generaciones a la vez ({per_worker * args.workers} en total)")
 
-        if prompt_request.file_text:
-            session_histories[session_id].append({"Former_document_text": "Archivo pasado anteriormente, usalo solo si no hay uno en el contexto: " + texto, "user_input": prompt_request.prompt, "model_response": ollama_data.get("response", ""), "timestamp": ahora})
-        else:
-            session_histories[session_id].append({"Former_document_text": "", "user_input": prompt_request.prompt, "model_response": ollama_data.get("response", ""), "timestamp": ahora})           
-        
-        return {
-            "model": ollama_data.get("model", MODEL_NAME),
-            "response": ollama_data.get("response", ""),
-            "sources": None,
-            "context_used": bool(context)
-        }
+    service = None
+    if not EXTRACT_SERVICE and (args.role == "chat" or args.workers > 1):
+        if args.role == "all":
+            if os.path.exists(args.extract_socket):
+                os.remove(args.extract_socket)
+            env = {key: value for key, value in os.environ.items() if key != "EXTRACT_SERVICE"}
+            service = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "--role", "extract", "--extract-socket", args.extract_socket,
+                 "--drain-timeout", str(args.drain_timeout), "--log-level", args.log_level],
+                # En su propio grupo de procesos para que un Ctrl+C no lo pare antes de que los workers terminen de drenar
+                env=env, start_new_session=True,
+            )
+            wait_for_socket(service, args.extract_socket)
+        os.environ["EXTRACT_SERVICE"] = f"unix:{args.extract_socket}"
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error en Ollama: {str(e)}")
-        raise HTTPException(503, detail="Servicio de modelo no disponible")
-    except Exception as e:
-        logger.error(f"Error inesperado: {str(e)}", exc_info=True)
-        raise HTTPException(500, detail="Error interno del servidor")
+    try:
+        uvicorn.run(
+            "app:app", host=args.host, port=args.port, workers=args.workers, app_dir=APP_DIR,
+            log_level=args.log_level, timeout_graceful_shutdown=args.drain_timeout,
+        )
+    finally:
+        if service is not None:
+            service.terminate()
+            try:
+                service.wait(timeout=args.drain_timeout + 5)
+            except subprocess.TimeoutExpired:
+                service.kill()
+            if os.path.exists(args.extract_socket):
+                os.remove(args.extract_socket)
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
+    main()
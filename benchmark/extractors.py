@@ -0,0 +1,75 @@
+import argparse
+import importlib
+import logging
+import os
+import sys
+import time
+
+from report import peak_rss_mb, summarize, write_report
+
+# Micro-benchmarks de los extractores de texto de la APP (read_pdf, read_docx, ...)
+# sobre los archivos de archivosDePrueba, en este mismo proceso y sin servidor
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def bench_file(app, path: str, repeat: int, max_chars) -> dict:
+    file_ext = path.split(".")[-1].lower()
+    with open(path, "rb") as file:
+        data = file.read()
+
+    # La primera extracción carga librerías y modelos (OCR): se mide aparte
+    started = time.perf_counter()
+    text = app.extract_text(file_ext, data, max_chars)
+    first = time.perf_counter() - started
+
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        app.extract_text(file_ext, data, max_chars)
+        latencies.append(time.perf_counter() - started)
+
+    summary = summarize(latencies)
+    return {
+        "format": app.file_format(file_ext),
+        "bytes": len(data),
+        "chars": len(text),
+        "first_run_seconds": round(first, 4),
+        "latency": summary,
+        "mb_per_second": round(len(data) / summary["p50"] / 1e6, 3) if summary["p50"] else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks de los extractores de texto")
+    parser.add_argument("--files", default=os.path.join(ROOT, "archivosDePrueba"), help="Carpeta con los archivos de prueba")
+    parser.add_argument("--repeat", type=int, default=20, help="Extracciones medidas de cada archivo")
+    parser.add_argument("--max-chars", type=int, default=None, help="Límite de caracteres como el de /upload_file (por defecto sin límite)")
+    parser.add_argument("--skip-ocr", action="store_true", help="No medir las imágenes (el OCR es mucho más lento y necesita el modelo)")
+    parser.add_argument("--output", help="Archivo JSON donde guardar el informe (por defecto se imprime)")
+    args = parser.parse_args()
+    folder = os.path.abspath(args.files)
+    output = os.path.abspath(args.output) if args.output else None
+
+    sys.path.insert(0, ROOT)
+    app = importlib.import_module("app")
+    logging.getLogger("app").setLevel(logging.WARNING)
+
+    files = {}
+    for name in sorted(os.listdir(folder)):
+        file_format = app.file_format(name.split(".")[-1].lower())
+        if file_format is None or (args.skip_ocr and file_format == "imagen"):
+            continue
+        files[name] = bench_file(app, os.path.join(folder, name), args.repeat, args.max_chars)
+        print(f"{name}: p50 {files[name]['latency']['p50'] * 1000:.1f} ms", file=sys.stderr)
+
+    write_report({
+        "benchmark": "extractors",
+        "config": {"repeat": args.repeat, "max_chars": args.max_chars, "extractor_version": app.EXTRACTOR_VERSION},
+        "files": files,
+        "peak_rss_mb": peak_rss_mb(),
+    }, output)
+
+
+if __name__ == "__main__":
+    main()
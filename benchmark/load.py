@@ -0,0 +1,172 @@
+import argparse
+import asyncio
+import os
+import random
+import time
+import uuid
+from collections import Counter, defaultdict
+
+import httpx
+
+from report import peak_rss_mb, summarize, write_report
+
+# Generador de carga contra la APP: lanza peticiones a /generate (o /generate/stream) y
+# /upload_file con la concurrencia y la mezcla indicadas y mide las latencias
+
+PROMPTS = [
+    "¿Qué es un modelo de lenguaje?",
+    "Resume el documento en tres frases.",
+    "¿Qué modelos necesitan menos de 8GB de GPU?",
+    "Explica la diferencia entre CPU y GPU para inferencia.",
+    "Dame una lista de pasos para instalar Ollama.",
+    "¿Cuál es la conclusión principal del archivo?",
+]
+UPLOAD_EXTENSIONS = (".pdf", ".docx", ".txt", ".pptx", ".xlsx", ".jpg", ".jpeg", ".png", ".webp")
+
+
+def parse_mix(mix: str) -> dict:
+    """Convierte "generate=8,upload=2" en pesos por tipo de petición"""
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        weights[name.strip()] = float(weight or 1)
+    unknown = set(weights) - {"generate", "upload"}
+    if unknown:
+        raise SystemExit(f"Tipos de petición desconocidos en --mix: {', '.join(sorted(unknown))}")
+    return weights
+
+
+async def run_generate(client: httpx.AsyncClient, session_id: str, args, result: dict):
+    body = {"prompt": random.choice(PROMPTS), "use_cache": not args.no_cache}
+    cookies = {"session_id": session_id}
+    if not args.stream:
+        response = await client.post("/generate", json=body, cookies=cookies)
+        await response.aread()
+        result["status"] = response.status_code
+        return
+
+    # En streaming se mide también el tiempo hasta el primer token
+    async with client.stream("POST", "/generate/stream", json=body, cookies=cookies) as response:
+        result["status"] = response.status_code
+        async for line in response.aiter_lines():
+            if line.startswith("event: error"):
+                result["status"] = "stream_error"
+            if line.startswith("data: ") and "ttft" not in result:
+                result["ttft"] = time.perf_counter() - result["started"]
+
+
+async def run_upload(client: httpx.AsyncClient, session_id: str, args, result: dict):
+    path = random.choice(args.upload_files)
+    with open(path, "rb") as file:
+        data = file.read()
+    response = await client.post("/upload_file", files={"file": (os.path.basename(path), data)}, cookies={"session_id": session_id})
+    await response.aread()
+    result["status"] = response.status_code
+
+
+async def worker(client: httpx.AsyncClient, jobs: asyncio.Queue, args, results: list):
+    while True:
+        try:
+            kind, session_id = jobs.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        result = {"kind": kind, "started": time.perf_counter()}
+        try:
+            if kind == "generate":
+                await run_generate(client, session_id, args, result)
+            else:
+                await run_upload(client, session_id, args, result)
+        except httpx.HTTPError as e:
+            result["status"] = type(e).__name__
+        result["latency"] = time.perf_counter() - result["started"]
+        results.append(result)
+
+
+async def run(args) -> dict:
+    weights = parse_mix(args.mix)
+    if weights.get("upload") and not args.upload_files:
+        raise SystemExit(f"No hay archivos para subir en {args.files}")
+    sessions = [str(uuid.uuid4()) for _ in range(max(1, args.sessions))]
+    kinds = random.choices(list(weights), weights=list(weights.values()), k=args.warmup + args.requests)
+
+    timeout = httpx.Timeout(args.timeout)
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, timeout=timeout, limits=limits) as client:
+        # Calentamiento: no cuenta en el informe (carga de modelos, OCR, cachés frías...)
+        if args.warmup:
+            warmup = asyncio.Queue()
+            for kind in kinds[:args.warmup]:
+                warmup.put_nowait((kind, random.choice(sessions)))
+            await asyncio.gather(*(worker(client, warmup, args, []) for _ in range(args.concurrency)))
+
+        jobs = asyncio.Queue()
+        for kind in kinds[args.warmup:]:
+            jobs.put_nowait((kind, random.choice(sessions)))
+        results = []
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client, jobs, args, results) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    by_kind = defaultdict(list)
+    for result in results:
+        by_kind[result["kind"]].append(result)
+
+    endpoints = {}
+    for kind, kind_results in by_kind.items():
+        ok = [result for result in kind_results if result.get("status") == 200]
+        endpoints[kind] = {
+            "latency": summarize([result["latency"] for result in ok], elapsed),
+            "errors": len(kind_results) - len(ok),
+            "status": dict(Counter(str(result.get("status")) for result in kind_results)),
+        }
+        ttfts = [result["ttft"] for result in ok if "ttft" in result]
+        if ttfts:
+            endpoints[kind]["ttft"] = summarize(ttfts)
+
+    return {
+        "benchmark": "load",
+        "config": {
+            "url": args.url,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "sessions": args.sessions,
+            "mix": weights,
+            "stream": args.stream,
+            "use_cache": not args.no_cache,
+        },
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_per_second": round(len(results) / elapsed, 3) if elapsed else 0.0,
+        "endpoints": endpoints,
+        "peak_rss_mb": {
+            "server": peak_rss_mb(args.server_pid) if args.server_pid else None,
+            "load_generator": peak_rss_mb(),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga de la APP")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="URL de la APP")
+    parser.add_argument("--requests", type=int, default=200, help="Peticiones medidas")
+    parser.add_argument("--warmup", type=int, default=10, help="Peticiones previas que no se miden")
+    parser.add_argument("--concurrency", type=int, default=8, help="Peticiones simultáneas")
+    parser.add_argument("--sessions", type=int, default=20, help="Sesiones distintas entre las que se reparten las peticiones")
+    parser.add_argument("--mix", default="generate=8,upload=2", help="Pesos de cada tipo de petición, p. ej. generate=1 o generate=8,upload=2")
+    parser.add_argument("--stream", action="store_true", help="Usar /generate/stream y medir el tiempo hasta el primer token")
+    parser.add_argument("--no-cache", action="store_true", help="Pedir use_cache=false para que cada petición llegue a Ollama")
+    parser.add_argument("--files", default=os.path.join(os.path.dirname(__file__), "..", "archivosDePrueba"), help="Carpeta con los archivos a subir")
+    parser.add_argument("--timeout", type=float, default=300, help="Segundos máximos por petición")
+    parser.add_argument("--server-pid", type=int, help="PID del servidor para informar de su pico de memoria (Linux)")
+    parser.add_argument("--seed", type=int, default=0, help="Semilla para que la mezcla de peticiones sea reproducible")
+    parser.add_argument("--output", help="Archivo JSON donde guardar el informe (por defecto se imprime)")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    args.upload_files = sorted(
+        os.path.join(args.files, name) for name in os.listdir(args.files) if name.lower().endswith(UPLOAD_EXTENSIONS)
+    ) if os.path.isdir(args.files) else []
+    write_report(asyncio.run(run(args)), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+# Servidor que imita la API de Ollama para medir la APP sin GPU ni modelo:
+# tarda `ttft` en "procesar el prompt" y luego genera tokens cada `token_delay`
+
+WORDS = ["El", " documento", " indica", " que", " el", " modelo", " responde", " con", " datos", " del", " contexto", "."]
+
+app = FastAPI()
+settings = argparse.Namespace(tokens=64, ttft=0.25, token_delay=0.03, jitter=0.2, models=["gemma3:12b"])
+
+
+def jittered(seconds: float) -> float:
+    """Añade una variación aleatoria de ±jitter a un retardo"""
+    return max(0.0, seconds * random.uniform(1 - settings.jitter, 1 + settings.jitter))
+
+
+def final_chunk(body: dict, key: str, text: str, prompt_chars: int, started: float) -> dict:
+    """Último fragmento con las métricas que devuelve Ollama (duraciones en nanosegundos)"""
+    eval_duration = int(settings.tokens * settings.token_delay * 1e9)
+    chunk = {
+        "model": body.get("model"),
+        "done": True,
+        "total_duration": int((time.perf_counter() - started) * 1e9),
+        "prompt_eval_count": max(1, prompt_chars // 4),
+        "prompt_eval_duration": int(settings.ttft * 1e9),
+        "eval_count": settings.tokens,
+        "eval_duration": eval_duration,
+    }
+    if key == "message":
+        chunk["message"] = {"role": "assistant", "content": text}
+    else:
+        chunk["response"] = text
+    return chunk
+
+
+async def generate(body: dict, key: str, prompt_chars: int):
+    started = time.perf_counter()
+    tokens = [WORDS[i % len(WORDS)] for i in range(settings.tokens)]
+
+    if not body.get("stream", True):
+        await asyncio.sleep(jittered(settings.ttft) + sum(jittered(settings.token_delay) for _ in tokens))
+        return final_chunk(body, key, "".join(tokens), prompt_chars, started)
+
+    async def stream():
+        await asyncio.sleep(jittered(settings.ttft))
+        for token in tokens:
+            chunk = {"model": body.get("model"), "done": False}
+            if key == "message":
+                chunk["message"] = {"role": "assistant", "content": token}
+            else:
+                chunk["response"] = token
+            yield json.dumps(chunk) + "\n"
+            await asyncio.sleep(jittered(settings.token_delay))
+        yield json.dumps(final_chunk(body, key, "", prompt_chars, started)) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+@app.get("/api/tags")
+async def tags():
+    return {"models": [{"name": model} for model in settings.models]}
+
+
+@app.post("/api/generate")
+async def api_generate(request: Request):
+    body = await request.json()
+    return await generate(body, "response", len(body.get("prompt", "")))
+
+
+@app.post("/api/chat")
+async def api_chat(request: Request):
+    body = await request.json()
+    return await generate(body, "message", sum(len(message.get("content", "")) for message in body.get("messages", [])))
+
+
+@app.post("/api/embed")
+async def api_embed(request: Request):
+    body = await request.json()
+    texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    # Vectores deterministas a partir del texto, suficientes para ejercitar la búsqueda híbrida
+    return {"embeddings": [[(hash(text) % 97) / 97, len(text) % 13 / 13, 1.0] for text in texts]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor falso de Ollama con latencias configurables")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--tokens", type=int, default=settings.tokens, help="Tokens de cada respuesta")
+    parser.add_argument("--ttft", type=float, default=settings.ttft, help="Segundos hasta el primer token")
+    parser.add_argument("--token-delay", type=float, default=settings.token_delay, help="Segundos entre tokens")
+    parser.add_argument("--jitter", type=float, default=settings.jitter, help="Variación relativa de los retardos (0.2 = ±20%%)")
+    parser.add_argument("--models", default=",".join(settings.models), help="Modelos que anuncia /api/tags")
+    args = parser.parse_args()
+
+    settings.tokens = args.tokens
+    settings.ttft = args.ttft
+    settings.token_delay = args.token_delay
+    settings.jitter = args.jitter
+    settings.models = [model.strip() for model in args.models.split(",") if model.strip()]
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import json
+import os
+import platform
+import resource
+import time
+from typing import List, Optional
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Percentil `p` (0-100) por interpolación lineal entre los valores ordenados"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize(latencies: List[float], elapsed: Optional[float] = None) -> dict:
+    """Resumen de una lista de latencias (en segundos): percentiles, media y throughput"""
+    summary = {
+        "count": len(latencies),
+        "p50": round(percentile(latencies, 50), 4),
+        "p95": round(percentile(latencies, 95), 4),
+        "p99": round(percentile(latencies, 99), 4),
+        "mean": round(sum(latencies) / len(latencies), 4) if latencies else 0.0,
+        "max": round(max(latencies), 4) if latencies else 0.0,
+    }
+    if elapsed:
+        summary["throughput_per_second"] = round(len(latencies) / elapsed, 3)
+    return summary
+
+
+def peak_rss_mb(pid: Optional[int] = None) -> Optional[float]:
+    """
+    Pico de memoria residente en MB
+
+    Sin `pid` es el de este proceso; con `pid` se lee VmHWM de /proc (solo Linux) y
+    devuelve None si no se puede leer.
+    """
+    if pid is None:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # En macOS ru_maxrss viene en bytes y en Linux en KB
+        return round(rss / (1024 * 1024 if platform.system() == "Darwin" else 1024), 1)
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def write_report(report: dict, output: Optional[str]):
+    """Añade metadatos al informe y lo guarda en JSON (o lo imprime si no hay ruta)"""
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        **report,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if output:
+        with open(output, "w", encoding="utf-8") as file:
+            file.write(text + "\n")
+        print(f"Informe guardado en {output}")
+    else:
+        print(text)
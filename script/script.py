@@ -5,18 +5,20 @@ import time
 import tkinter as Tk
 from tkinter import filedialog  # Importa filedialog para abrir el explorador de archivos
 import mimetypes
+import json
 
 
 # Configuración de la API
 API_BASE_URL = "http://192.168.9.102:8000"  # Cambia esto si tu API está en otro lugar
 
-def generate_text(prompt: str, session_id: str = "",  file_text: str = "", file_type: str = "", file_name: str = "") -> Optional[dict]:
+def generate_text(prompt: str, session_id: str = "",  file_text: str = "", file_type: str = "", file_name: str = "", document_ids: Optional[list] = None) -> Optional[dict]:
     """
     Función para enviar una solicitud a la API de generación de texto
     
     Args:
         prompt: El texto prompt para enviar al modelo
         session_id: Identificador de sesión del usuario
+        document_ids: Ids de los documentos subidos (devueltos por upload_file)
         
     Returns:
         dict: La respuesta de la API o None si hay error
@@ -34,7 +36,8 @@ def generate_text(prompt: str, session_id: str = "",  file_text: str = "", file_
         "prompt": prompt,
         "file_text": file_text,
         "file_type": file_type,
-        "file_name": file_name
+        "file_name": file_name,
+        "document_ids": document_ids or []
     }
     
     try:
@@ -51,6 +54,74 @@ def generate_text(prompt: str, session_id: str = "",  file_text: str = "", file_
         print(f"Error al llamar a la API: {e}")  # Imprimimos el error en caso de fallo
         return None
 
+def generate_text_stream(prompt: str, session_id: str = "",  file_text: str = "", file_type: str = "", file_name: str = "", document_ids: Optional[list] = None) -> Optional[dict]:
+    """
+    Función para pedir una respuesta a la API en streaming, imprimiendo los tokens según llegan
+    
+    Args:
+        prompt: El texto prompt para enviar al modelo
+        session_id: Identificador de sesión del usuario
+        document_ids: Ids de los documentos subidos (devueltos por upload_file)
+        
+    Returns:
+        dict: Los metadatos de la respuesta (con los tiempos) o None si hay error
+    """
+    headers = {
+        "Cookie": f"session_id={session_id}"  # Incluir el session_id en las cabeceras
+    }
+
+    url = f"{API_BASE_URL}/generate/stream"
+
+    payload = {
+        "prompt": prompt,
+        "file_text": file_text,
+        "file_type": file_type,
+        "file_name": file_name,
+        "document_ids": document_ids or []
+    }
+
+    try:
+        start_time = time.time()  # Registramos el tiempo de inicio
+        first_token_time = None
+        response_data = {}
+        event = "message"
+
+        with requests.post(url, json=payload, headers=headers, stream=True) as response:
+            response.raise_for_status()  # Verificar si hubo un error en la respuesta
+
+            # Cada evento SSE llega como líneas "event: ..." / "data: ..." separadas por una línea vacía
+            for line in response.iter_lines(decode_unicode=True):
+                if not line:
+                    event = "message"
+                    continue
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                    continue
+                if not line.startswith("data: "):
+                    continue
+
+                data = json.loads(line[len("data: "):])
+                if event == "error":
+                    print(f"\nError al generar la respuesta: {data.get('detail')}")
+                    return None
+                if event == "done":
+                    response_data = data
+                    continue
+
+                if first_token_time is None:
+                    first_token_time = time.time()
+                print(data.get("token", ""), end="", flush=True)  # Mostramos cada token según llega
+
+        end_time = time.time()  # Registramos el tiempo de finalización
+        print()
+
+        response_data['response_time'] = end_time - start_time  # Añadimos el tiempo de respuesta
+        response_data['first_token_time'] = (first_token_time or end_time) - start_time  # Tiempo hasta el primer token
+        return response_data
+    except requests.exceptions.RequestException as e:
+        print(f"Error al llamar a la API: {e}")  # Imprimimos el error en caso de fallo
+        return None
+
 # Obtener el tipo MIME basado en la extensión del archivo
 def get_mime_type(file_path: str):
     mime_type, _ = mimetypes.guess_type(file_path)
@@ -74,20 +145,27 @@ def upload_file(session_id: str) -> Optional[dict]:
     root.withdraw()
     root.attributes('-topmost', True)
 
-    # Abrir el cuadro de diálogo para seleccionar un archivo
-    file_path = filedialog.askopenfilename(
-        title="Selecciona un archivo PDF, TXT, DOCX, PPTX, XLSX, PNG o JPG",
+    # Abrir el cuadro de diálogo para seleccionar uno o varios archivos
+    file_paths = filedialog.askopenfilenames(
+        title="Selecciona uno o varios archivos PDF, TXT, DOCX, PPTX, XLSX, PNG, JPG o ZIP",
         filetypes=[(
-            "Archivos PDF, TXT, DOCX, PPTX, XLSX, PNG y JPG",
-            "*.pdf;*.txt;*.docx;*.pptx;*.xlsx;*.png;*.jpg;*.jpeg"  # Usamos el punto y coma para separar las extensiones
+            "Archivos PDF, TXT, DOCX, PPTX, XLSX, PNG, JPG y ZIP",
+            "*.pdf;*.txt;*.docx;*.pptx;*.xlsx;*.png;*.jpg;*.jpeg;*.zip"  # Usamos el punto y coma para separar las extensiones
         )]
     )
 
     
-    if not file_path:  # Si el usuario no selecciona un archivo, retornar None
+    if not file_paths:  # Si el usuario no selecciona un archivo, retornar None
         print("No se seleccionó un archivo.")
         root.quit()  # Asegurarse de destruir la ventana después de usarla
         return None
+
+    # Varios archivos o un zip se suben juntos a /upload_files
+    if len(file_paths) > 1 or file_paths[0].lower().endswith(".zip"):
+        root.quit()
+        return upload_files(file_paths, session_id)
+
+    file_path = file_paths[0]
     
     url = f"{API_BASE_URL}/upload_file"
     
@@ -118,6 +196,63 @@ def upload_file(session_id: str) -> Optional[dict]:
             root.quit()  # Asegurarse de destruir la ventana después de usarla
             return None
 
+def upload_files(file_paths, session_id: str) -> Optional[dict]:
+    """
+    Función para subir varios archivos (o zips) a la vez y recibir el texto extraído de cada uno
+
+    El servidor envía el resultado de cada archivo según termina (una línea JSON por archivo).
+
+    Args:
+        file_paths: Rutas de los archivos a subir
+        session_id: Identificador de sesión del usuario
+
+    Returns:
+        dict: Texto de todos los archivos juntos e ids de sus documentos (document_ids), o None si hay error
+    """
+    url = f"{API_BASE_URL}/upload_files"
+    handles = [open(file_path, "rb") for file_path in file_paths]
+    files = [("files", (file_path, handle, get_mime_type(file_path))) for file_path, handle in zip(file_paths, handles)]
+    headers = {
+        "Cookie": f"session_id={session_id}"  # Incluir el session_id en las cabeceras
+    }
+
+    try:
+        start_time = time.time()  # Registrar el tiempo de inicio
+        texts = []
+        names = []
+        document_ids = []
+        with requests.post(url, files=files, headers=headers, stream=True) as response:
+            response.raise_for_status()  # Verificar si hubo un error en la respuesta
+            for line in response.iter_lines(decode_unicode=True):
+                if not line:
+                    continue
+                result = json.loads(line)
+                name = result["file_name"][result["file_name"].rfind("/")+1:]
+                if "error" in result:
+                    print(f"Error al procesar {name}: {result['error']}")
+                else:
+                    print(f"Archivo procesado: {name} ({time.time() - start_time:.2f} segundos)")
+                    texts.append(f"{name}:\n{result['file_text']}")
+                    names.append(name)
+                    if result.get("document_id"):
+                        document_ids.append(result["document_id"])
+
+        if not names:
+            return None
+        return {
+            "file_text": "\n\n".join(texts),
+            "file_type": "documento",
+            "file_name": ", ".join(names),
+            "document_ids": document_ids,
+            "response_time": time.time() - start_time,
+        }
+    except requests.exceptions.RequestException as e:
+        print(f"Error al subir los archivos: {e}")  # Imprimir el error en caso de fallo
+        return None
+    finally:
+        for handle in handles:
+            handle.close()
+
 def main():
     """
     Función principal para manejar la interacción con el usuario
@@ -141,33 +276,29 @@ def main():
         while choice.lower() != "y" and choice.lower() != "n":
             choice = input("Debe seleccionar una opción correcta (Y/N): ").strip()
 
-        file_text = ""
-        file_name = ""
-        file_type = ""
+        # El texto de los archivos se queda en el servidor: solo se envían sus ids
+        document_ids = []
 
         if choice.lower() == "y":
             print("Selecciona un archivo PDF, TXT, DOCX, PPTX, XLSX, PNG, WEBP o JPG para subirlo...")
             response = upload_file(session_id)
             if response:
-                file_text = response.get("file_text", "No se pudo extraer texto")   
-                file_type = response.get("file_type", "No se pudo extraer texto")
-                file_name = response.get("file_name", "No se pudo extraer texto")
-                file_name = file_name[file_name.rfind("/")+1:]
+                document_ids = response.get("document_ids") or ([response["document_id"]] if response.get("document_id") else [])
             else:
                 print("No se pudo procesar el archivo.")
                 continue
         
         print("\nGenerando respuesta...\n")
         
-        # Llamar a la API con el prompt del usuario y el session_id
-        response = generate_text(prompt=user_input, session_id=session_id, file_text=file_text, file_type=file_type, file_name=file_name)
+        print("Respuesta:")
+
+        # Llamar a la API con el prompt del usuario y el session_id, mostrando la respuesta según se genera
+        response = generate_text_stream(prompt=user_input, session_id=session_id, document_ids=document_ids)
         
         if response:  # Si la respuesta de la API es válida
-            print("\nRespuesta:")
-            print(response.get("response", "No se recibió respuesta"))
-            
-            # Mostramos el tiempo de respuesta en segundos con 2 decimales
-            print(f"\nTiempo de respuesta: {response.get('response_time', 0):.2f} segundos")
+            # Mostramos los tiempos en segundos con 2 decimales
+            print(f"\nTiempo hasta el primer token: {response.get('first_token_time', 0):.2f} segundos")
+            print(f"Tiempo de respuesta: {response.get('response_time', 0):.2f} segundos")
         else:
             print("No se pudo obtener una respuesta de la API")  # Mensaje de error si no hay respuesta
 
@@ -5,9 +5,8 @@ document.addEventListener('DOMContentLoaded', function () {
     const typingIndicator = document.getElementById('typingIndicator');
     const documentUpload = document.getElementById('documentUpload');
     const fileInfo = document.getElementById('fileInfo');
-    let file_text = "";
-    let file_name = "";
-    let file_type = "";
+    // Ids de los documentos subidos (el texto se queda en el servidor)
+    let document_ids = [];
 
     function escapeHtml(unsafe) {
         return unsafe
@@ -23,10 +22,7 @@ document.addEventListener('DOMContentLoaded', function () {
         return now.toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' });
     }
 
-    function addMessage(text, isUser, isDocument = false) {
-        const messageDiv = document.createElement('div');
-        messageDiv.className = `message ${isUser ? 'user-message' : isDocument ? 'document-message' : 'bot-message'}`;
-
+    function renderMessage(messageDiv, text) {
         let safeText = escapeHtml(text);
         safeText = safeText.replace(/(```(\w*)([\s\S]*?)```|`([^`]*)`)/g,
             (match, p1, p2, p3, p4) => {
@@ -40,10 +36,17 @@ document.addEventListener('DOMContentLoaded', function () {
 
         safeText += `<span class="message-time">${getCurrentTime()}</span>`;
         messageDiv.innerHTML = safeText;
-        chatBox.appendChild(messageDiv);
         chatBox.scrollTop = chatBox.scrollHeight;
     }
 
+    function addMessage(text, isUser, isDocument = false) {
+        const messageDiv = document.createElement('div');
+        messageDiv.className = `message ${isUser ? 'user-message' : isDocument ? 'document-message' : 'bot-message'}`;
+        chatBox.appendChild(messageDiv);
+        renderMessage(messageDiv, text);
+        return messageDiv;
+    }
+
     async function sendMessage() {
         const message = userInput.value.trim();
         if (!message) return;
@@ -54,26 +57,62 @@ document.addEventListener('DOMContentLoaded', function () {
         typingIndicator.style.display = 'flex';
 
         try {
-            const response = await fetch('http://192.168.9.102:8000/generate', {
+            const response = await fetch('http://192.168.9.102:8000/generate/stream', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify({
                     prompt: message,
-                    file_text: file_text,
-                    file_name: file_name,
-                    file_type: file_type
+                    document_ids: document_ids
                 }),
                 credentials: 'include'
             });
-            file_text = "";
-            file_name = "";
-            file_type = "";
+            document_ids = [];
             if (!response.ok) throw new Error('Error en la respuesta');
 
-            const data = await response.json();
-            addMessage(data.response, false);
+            // Leer los eventos SSE y pintar los tokens según llegan
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = "";
+            let answer = "";
+            let botMessage = null;
+            let data = null;
 
-            if (data.sources?.length > 0) {
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+
+                const events = buffer.split("\n\n");
+                buffer = events.pop();
+                for (const rawEvent of events) {
+                    let eventName = "message";
+                    let eventData = "";
+                    for (const line of rawEvent.split("\n")) {
+                        if (line.startsWith("event: ")) eventName = line.slice(7);
+                        else if (line.startsWith("data: ")) eventData += line.slice(6);
+                    }
+                    if (!eventData) continue;
+                    const payload = JSON.parse(eventData);
+
+                    if (eventName === "error") throw new Error(payload.detail);
+                    if (eventName === "done") {
+                        data = payload;
+                        continue;
+                    }
+
+                    answer += payload.token;
+                    if (!botMessage) {
+                        typingIndicator.style.display = 'none';
+                        botMessage = addMessage(answer, false);
+                    } else {
+                        renderMessage(botMessage, answer);
+                    }
+                }
+            }
+
+            if (!botMessage) addMessage(answer, false);
+
+            if (data?.sources?.length > 0) {
                 addMessage("Fuentes consultadas: " + data.sources.join(", "), false);
             }
 
@@ -90,6 +129,66 @@ document.addEventListener('DOMContentLoaded', function () {
         userInput.style.height = 'auto';
     }
 
+    async function uploadFiles(files) {
+        // Varios archivos (o un zip): se suben juntos y cada resultado llega en cuanto termina
+        let formData = new FormData();
+        for (const file of files) formData.append("files", file);
+
+        fileInfo.innerHTML = `<i class="bi bi-arrow-up-circle file-icon"></i><span>Subiendo ${files.length} archivos...</span>`;
+
+        try {
+            let response = await fetch("http://192.168.9.102:8000/upload_files", {
+                method: "POST",
+                body: formData,
+                credentials: 'include'
+            });
+
+            if (!response.ok) {
+                let result = await response.json();
+                fileInfo.innerHTML = '<i class="bi bi-exclamation-circle-fill text-danger"></i><span>Error al subir</span>';
+                addMessage("❌ Error al procesar los archivos: " + result.detail, false);
+                return;
+            }
+
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = "";
+            let ids = [];
+            let names = [];
+            let doneCount = 0;
+
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+
+                const lines = buffer.split("\n");
+                buffer = lines.pop();
+                for (const line of lines) {
+                    if (!line.trim()) continue;
+                    const result = JSON.parse(line);
+                    doneCount++;
+                    fileInfo.innerHTML = `<i class="bi bi-arrow-up-circle file-icon"></i><span>Procesados ${doneCount} archivos...</span>`;
+                    if (result.error) {
+                        addMessage("❌ Error al procesar " + result.file_name + ": " + result.error, false);
+                    } else {
+                        if (result.document_id) ids.push(result.document_id);
+                        names.push(result.file_name);
+                        addMessage("📄 Archivo cargado correctamente: " + result.file_name, false, true);
+                    }
+                }
+            }
+
+            document_ids = ids;
+            fileInfo.innerHTML = `<i class="bi bi-check-circle-fill text-success"></i><span>${names.length} archivos (listo)</span>`;
+
+        } catch (error) {
+            console.error("Error al subir los archivos:", error);
+            fileInfo.innerHTML = '<i class="bi bi-exclamation-circle-fill text-danger"></i><span>Error al subir</span>';
+            addMessage("❌ Error de conexión al subir los archivos", false);
+        }
+    }
+
     document.getElementById("documentUpload").addEventListener("change", async function(event) {
         let fileInput = event.target.files[0];
 
@@ -98,6 +197,11 @@ document.addEventListener('DOMContentLoaded', function () {
             return;
         }
 
+        if (event.target.files.length > 1 || fileInput.name.toLowerCase().endsWith(".zip")) {
+            await uploadFiles(event.target.files);
+            return;
+        }
+
         let formData = new FormData();
         formData.append("file", fileInput);
 
@@ -106,14 +210,13 @@ document.addEventListener('DOMContentLoaded', function () {
         try {
             let response = await fetch("http://192.168.9.102:8000/upload_file", {
                 method: "POST",
-                body: formData
+                body: formData,
+                credentials: 'include'
             });
 
             let result = await response.json();
            
-            file_text = result.file_text;
-            file_name = result.file_name;
-            file_type = result.file_type;
+            document_ids = result.document_id ? [result.document_id] : [];
 
             if (response.ok) {
                 fileInfo.innerHTML = `<i class="bi bi-check-circle-fill text-success"></i><span>${fileInput.name} (listo)</span>`;
@@ -0,0 +1,33 @@
+import os
+import sys
+
+import pytest
+
+# Los tests importan app.py directamente desde la raíz del repositorio, sin Ollama, sin
+# embeddings y con todo el estado en memoria
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.update({"SESSION_BACKEND": "memory", "EMBED_MODEL": "", "EXTRACT_CACHE_DB": "", "EXTRACT_SERVICE": ""})
+
+import app  # noqa: E402
+
+
+@pytest.fixture
+def stores(monkeypatch):
+    """Almacenes de sesiones y documentos, índice y caché de extracción vacíos para cada test"""
+    monkeypatch.setattr(app, "session_store", app.MemorySessionStore(app.SESSION_MAX_ENTRIES, app.SESSION_MAX_SESSIONS, app.SESSION_IDLE_TTL))
+    monkeypatch.setattr(app, "document_store", app.MemoryDocumentStore(app.DOCUMENT_STORE_MAX_BYTES, app.SESSION_IDLE_TTL))
+    monkeypatch.setattr(app, "retrieval_index", app.RetrievalIndex(app.RAG_MAX_DOCUMENTS, app.SESSION_MAX_SESSIONS))
+    monkeypatch.setattr(app, "extraction_cache", app.ExtractionCache(16, 1 << 20, 60))
+    # Los resúmenes del historial necesitan Ollama: los tests que los usan los guardan a mano
+    monkeypatch.setattr(app.history_compactor, "schedule", lambda session_id: None)
+    return app
+
+
+@pytest.fixture
+def extracted(monkeypatch):
+    """Sustituye la extracción por el propio contenido del archivo (como texto)"""
+    async def extract(request, file_ext, source, max_chars=None):
+        return source.decode("utf-8")[:max_chars]
+
+    monkeypatch.setattr(app.extraction_pipeline, "extract", extract)
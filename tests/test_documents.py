@@ -0,0 +1,78 @@
+import asyncio
+
+import app
+
+TEXT = "\n".join(f"Parrafo {number}: el contrato de alquiler fija una renta de {number} euros." for number in range(200))
+
+
+def upload(session_id, name="contrato.txt", text=TEXT, max_chars=500):
+    return asyncio.run(app.process_upload(None, session_id, name, text.encode("utf-8"), max_chars))
+
+
+def test_upload_indexes_under_the_document_store_id(stores, extracted):
+    result = upload("s1")
+    assert result["document_id"] is not None
+    assert app.document_store.get("s1", result["document_id"])["text"] == TEXT
+    assert app.retrieval_index.get(result["document_id"]) is app.retrieval_index.documents("s1")[0][1]
+
+
+def test_same_document_in_two_sessions_is_stored_and_indexed_once(stores, extracted):
+    first = upload("s1")
+    second = upload("s2", name="copia.txt")
+    assert first["document_id"] == second["document_id"]
+    assert app.document_store.stats()["documents"] == 1
+    assert app.retrieval_index.stats()["documents"] == 1
+
+
+def test_sessions_sharing_a_document_keep_their_own_file_name(stores, extracted):
+    document_id = upload("s1", name="nomina_ana.txt")["document_id"]
+    upload("s2", name="copia.txt")
+    assert app.document_store.get("s2", document_id)["name"] == "copia.txt"
+
+    question = app.PromptRequest(prompt="¿Qué renta fija el parrafo 150?")
+    context, sources, _ = asyncio.run(app.build_context(question, "s2"))
+    assert sources and all(source.startswith("copia.txt") for source in sources)
+    assert "nomina_ana" not in context
+
+    # Otra sesión que usa el id sin haberlo subido no ve el nombre original
+    other = app.PromptRequest(prompt="¿Qué renta fija el parrafo 150?", document_ids=[document_id])
+    context, sources, _ = asyncio.run(app.build_context(other, "s3"))
+    assert sources and all(source.startswith(app.UNNAMED_DOCUMENT) for source in sources)
+    assert "nomina_ana" not in context
+
+
+def test_follow_up_on_another_worker_reindexes_from_the_document_store(stores, extracted, monkeypatch):
+    document_id = upload("s1")["document_id"]
+    first = app.PromptRequest(prompt="¿Qué renta fija el parrafo 150?", document_ids=[document_id])
+    context, sources, retrieved = asyncio.run(app.build_context(first, "s1"))
+    assert retrieved and "Parrafo 150" in context
+    asyncio.run(app.save_history("s1", first, "150 euros", retrieved))
+    assert app.session_store.history("s1")[-1]["document_ids"] == [document_id]
+
+    # La siguiente pregunta llega a otro worker, con su propio índice vacío y sin document_ids
+    monkeypatch.setattr(app, "retrieval_index", app.RetrievalIndex(app.RAG_MAX_DOCUMENTS, app.SESSION_MAX_SESSIONS))
+    follow_up = app.PromptRequest(prompt="¿Y el parrafo 42?")
+    context, sources, retrieved = asyncio.run(app.build_context(follow_up, "s1"))
+    assert retrieved and "Parrafo 42" in context
+    # El documento indexado no se copia además en el historial del prompt
+    messages = app.build_messages(follow_up, context, "s1")
+    assert sum(message["content"].count("Parrafo 150:") for message in messages[:-1]) == 0
+
+
+def test_upload_is_indexed_even_when_max_chars_covers_the_rag_budget(stores, extracted, monkeypatch):
+    monkeypatch.setattr(app, "RAG_MAX_CHARS", 1000)
+    result = upload("s1", max_chars=5000)
+    assert app.retrieval_index.get(result["document_id"]) is not None
+
+
+def test_upload_without_session_extracts_only_max_chars(stores, monkeypatch):
+    requested = []
+
+    async def extract(request, file_ext, source, max_chars=None):
+        requested.append(max_chars)
+        return source.decode("utf-8")[:max_chars]
+
+    monkeypatch.setattr(app.extraction_pipeline, "extract", extract)
+    result = upload(None, max_chars=300)
+    assert requested == [300] and len(result["file_text"]) == 300
+    assert app.retrieval_index.stats()["documents"] == 0
@@ -0,0 +1,169 @@
+import fitz
+import pytest
+
+import app
+
+
+def make_pdf(text_pages: int, scanned_cover: bool = True) -> bytes:
+    """PDF con una portada escaneada (solo una imagen) seguida de páginas de texto"""
+    doc = fitz.open()
+    if scanned_cover:
+        page = doc.new_page()
+        pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 32, 32), False)
+        pix.clear_with(200)
+        page.insert_image(page.rect, pixmap=pix)
+    for number in range(text_pages):
+        doc.new_page().insert_text((72, 72), f"Pagina {number} " + "texto " * 15)
+    return doc.tobytes()
+
+
+@pytest.fixture
+def pages_read(monkeypatch):
+    """Cuenta las páginas de las que se llega a sacar el texto"""
+    calls = []
+    get_text = fitz.Page.get_text
+
+    def counting(self, *args, **kwargs):
+        calls.append(self.number)
+        return get_text(self, *args, **kwargs)
+
+    monkeypatch.setattr(fitz.Page, "get_text", counting)
+    monkeypatch.setattr(app, "ocr_images", lambda images: ["texto de la portada\n"] * len(images))
+    monkeypatch.setattr(app, "PDF_OCR", True)
+    return calls
+
+
+def test_collect_text_stops_at_max_chars():
+    consumed = []
+
+    def chunks():
+        for number in range(1000):
+            consumed.append(number)
+            yield "x" * 10
+
+    assert app.collect_text(chunks(), 25) == "x" * 25
+    assert len(consumed) == 3
+
+
+def test_read_pdf_stops_early_without_scanned_pages(pages_read):
+    text = app.read_pdf(make_pdf(300, scanned_cover=False), max_chars=500)
+    assert len(text) == 500
+    assert len(pages_read) < 10
+
+
+def test_read_pdf_stops_early_after_scanned_cover(pages_read):
+    text = app.read_pdf(make_pdf(300), max_chars=500)
+    assert text.startswith("texto de la portada")
+    assert len(text) == 500
+    assert len(pages_read) < 10
+
+
+def test_read_pdf_keeps_page_order_with_ocr_batches(pages_read, monkeypatch):
+    monkeypatch.setattr(app, "OCR_BATCH_SIZE", 4)
+    text = app.read_pdf(make_pdf(3))
+    assert text.index("texto de la portada") < text.index("Pagina 0") < text.index("Pagina 2")
+
+
+def test_pdf_page_count_of_corrupt_pdf_is_zero():
+    assert app.pdf_page_count(b"%PDF-1.4 esto no es un PDF") == 0
+    assert app.read_pdf(b"%PDF-1.4 esto no es un PDF") == ""
+
+
+def test_pipeline_falls_back_to_single_task_for_corrupt_pdf():
+    import asyncio
+
+    async def run():
+        pipeline = app.ExtractionPipeline(2, 10, {})
+        pipeline.start()
+        try:
+            return await pipeline.extract(None, "pdf", b"%PDF-1.4 esto no es un PDF", 100)
+        finally:
+            await pipeline.aclose()
+
+    assert asyncio.run(run()) == ""
+
+
+def run_pipeline(source, max_chars=None, workers=2):
+    """Extrae un PDF con un pipeline de `workers` procesos y devuelve (texto, argumentos de cada tarea)"""
+    import asyncio
+
+    tasks = []
+
+    async def run():
+        pipeline = app.ExtractionPipeline(workers, 10, {})
+        pipeline.start()
+        submit = pipeline.executor.submit
+
+        def recording(fn, *args):
+            tasks.append(args)
+            return submit(fn, *args)
+
+        pipeline.executor.submit = recording
+        try:
+            return await pipeline.extract(None, "pdf", source, max_chars)
+        finally:
+            await pipeline.aclose()
+
+    return asyncio.run(run()), tasks
+
+
+def test_large_pdf_ranges_read_one_spooled_copy(monkeypatch, tmp_path):
+    monkeypatch.setattr(app, "UPLOAD_TMP_DIR", str(tmp_path))
+    monkeypatch.setattr(app, "PDF_PARALLEL_MIN_BYTES", 0)
+    text, tasks = run_pipeline(make_pdf(40, scanned_cover=False))
+    assert text.index("Pagina 0 ") < text.index("Pagina 20 ") < text.index("Pagina 39 ")
+    ranges = [args for args in tasks if args and args[0] is app.read_pdf]
+    assert len(ranges) == 3
+    # Ninguna tarea (tampoco el recuento de páginas) recibe el PDF en bytes
+    assert not any(isinstance(arg, bytes) for args in tasks for arg in args)
+    assert list(tmp_path.iterdir()) == []  # El temporal se borra al terminar
+
+
+def test_small_pdf_goes_straight_to_one_task():
+    data = make_pdf(40, scanned_cover=False)
+    assert len(data) < app.PDF_PARALLEL_MIN_BYTES
+    text, tasks = run_pipeline(data)
+    assert "Pagina 39 " in text
+    # Sin recuento previo de páginas: una sola tarea con el archivo
+    assert len([args for args in tasks if args]) == 1 and tasks[-1][0] is app.extract_text
+
+
+class StubReader:
+    """Lector de easyOCR falso: anota la forma de cada lote y devuelve la marca de cada imagen"""
+
+    def __init__(self):
+        self.batches = []
+
+    def readtext_batched(self, images, batch_size):
+        self.batches.append([image.shape for image in images])
+        # La esquina superior izquierda no se toca al rellenar: lleva el número de la imagen
+        return [[(None, f"imagen {image[0, 0, 0]}", 0.9)] for image in images]
+
+
+def test_ocr_images_batches_by_size_and_keeps_input_order(monkeypatch):
+    import numpy as np
+
+    reader = StubReader()
+    pool = app.OCRReaderPool()
+    monkeypatch.setattr(pool, "_load", lambda langs: reader)
+    monkeypatch.setattr(app, "ocr_pool", pool)
+    monkeypatch.setattr(app, "OCR_BUCKET_PX", 128)
+    monkeypatch.setattr(app, "OCR_BATCH_SIZE", 2)
+    monkeypatch.setattr(app, "OCR_SKIP_TEXTLESS", False)
+
+    sizes = [(100, 100), (120, 90), (300, 200), (110, 50), (290, 260)]
+    images = []
+    for number, (height, width) in enumerate(sizes):
+        image = np.full((height, width, 3), 200, dtype=np.uint8)
+        image[0, 0] = number
+        images.append(image)
+
+    texts = app.ocr_images(images)
+    assert texts == [f"imagen {number}\n" for number in range(len(images))]
+    assert reader.batches == [
+        [(120, 100, 3), (120, 100, 3)],  # Tramo 128x128: las dos primeras, rellenas al mayor alto y ancho
+        [(110, 50, 3)],                  # El mismo tramo, partido por OCR_BATCH_SIZE
+        [(300, 200, 3)],
+        [(290, 260, 3)],
+    ]
+    assert pool.misses == 1  # Un único lector para todos los lotes
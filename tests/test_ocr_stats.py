@@ -0,0 +1,35 @@
+import asyncio
+import os
+
+import app
+
+
+def ocr_report(pid, hits, misses, load_time):
+    return {"pid": pid, "ocr": {"size": 1, "readers": {"en,es": 1}, "hits": hits, "misses": misses, "load_time_seconds": load_time}}
+
+
+def test_ocr_stats_add_up_the_latest_counters_of_each_worker():
+    pipeline = app.ExtractionPipeline(2, 10, {})
+    assert pipeline._merge(("uno", {}, ocr_report(101, 1, 1, 2.0))) == "uno"
+    pipeline._merge(("dos", {}, ocr_report(102, 0, 1, 3.0)))
+    pipeline._merge(("tres", {}, ocr_report(101, 4, 1, 2.0)))  # Contadores acumulados del mismo proceso
+
+    stats = pipeline.ocr_stats()
+    assert (stats["processes"], stats["hits"], stats["misses"], stats["load_time_seconds"]) == (2, 4, 2, 5.0)
+    assert stats["readers"] == {"en,es": 2}
+    assert stats["workers"]["101"]["hits"] == 4
+
+
+def test_extraction_workers_report_their_own_process():
+    async def run():
+        pipeline = app.ExtractionPipeline(1, 10, {})
+        pipeline.start()
+        try:
+            text = await pipeline.extract(None, "txt", b"hola desde un worker", 100)
+        finally:
+            await pipeline.aclose()
+        return text, pipeline.ocr_stats()
+
+    text, stats = asyncio.run(run())
+    assert text == "hola desde un worker"
+    assert stats["processes"] == 1 and str(os.getpid()) not in stats["workers"]
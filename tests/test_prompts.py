@@ -0,0 +1,97 @@
+import asyncio
+import os
+
+import pytest
+
+import app
+
+TEXT = "\n".join(f"Clausula {number}: el inquilino abonara {number} euros por el concepto {number}." for number in range(300))
+
+
+def common_prefix(a: str, b: str) -> int:
+    return len(os.path.commonprefix([a, b]))
+
+
+@pytest.fixture
+def prefill_payloads(stores, extracted, monkeypatch):
+    """Prompts que el ModelWarmer manda a Ollama (en formato /api/generate para compararlos como texto)"""
+    payloads = []
+
+    async def ollama_post(path, payload, headers=None, session_id=None):
+        payloads.append(payload)
+
+    monkeypatch.setattr(app, "ollama_post", ollama_post)
+    monkeypatch.setattr(app, "OLLAMA_API", "generate")
+    return payloads
+
+
+def real_prompt(session_id, prompt, document_ids):
+    prompt_request = app.PromptRequest(prompt=prompt, document_ids=document_ids)
+    context, _, _ = asyncio.run(app.build_context(prompt_request, session_id))
+    return app.build_payload(prompt_request, context, app.build_messages(prompt_request, context, session_id), stream=False)
+
+
+def prefill(session_id, document_ids):
+    asyncio.run(app.model_warmer._prefill(session_id, document_ids))
+
+
+def upload(session_id, text=TEXT, name="contrato.txt"):
+    return asyncio.run(app.process_upload(None, session_id, name, text.encode("utf-8"), 4000))["document_id"]
+
+
+def previous_turn(session_id):
+    asyncio.run(app.save_history(session_id, app.PromptRequest(prompt="Hola, ¿me ayudas con un contrato?"), "Claro, pásame el contrato."))
+
+
+def test_build_messages_prefix_does_not_depend_on_the_question(stores):
+    previous_turn("s1")
+    app.session_store.set_summary("s1", {"text": "El usuario pregunta por un contrato.", "through": 0, "turns": 2})
+    first = app.build_messages(app.PromptRequest(prompt="¿Cuánto se paga?"), "Texto del contrato", "s1")
+    second = app.build_messages(app.PromptRequest(prompt="¿Y quién firma?"), "Texto del contrato", "s1")
+    assert first[:-1] == second[:-1]
+    assert common_prefix(first[-1]["content"], second[-1]["content"]) >= first[-1]["content"].index(app.QUESTION_PREFIX) + len(app.QUESTION_PREFIX)
+
+
+def test_prefill_with_retrieval_covers_only_the_stable_prefix(prefill_payloads):
+    document_id = upload("s1")
+    previous_turn("s1")
+    prefill("s1", [document_id])
+    real = real_prompt("s1", "¿Qué se paga por el concepto 250?", [document_id])
+
+    assert len(prefill_payloads) == 1
+    sent = prefill_payloads[0]["prompt"]
+    assert real["prompt"].startswith(sent)
+    assert "Claro, pásame el contrato." in sent
+    assert sent.endswith("Contexto disponible:\n")
+    assert prefill_payloads[0]["model"] == real["model"]
+
+
+def test_prefill_with_retrieval_and_no_history_is_skipped(prefill_payloads):
+    skipped = app.model_warmer.prefills_skipped
+    prefill("s1", [upload("s1")])
+    assert prefill_payloads == []
+    assert app.model_warmer.prefills_skipped == skipped + 1
+
+
+def test_prefill_without_retrieval_covers_the_whole_document(prefill_payloads, monkeypatch):
+    monkeypatch.setattr(app, "RAG_ENABLED", False)
+    document_id = upload("s1")
+    previous_turn("s1")
+    prefill("s1", [document_id])
+    real = real_prompt("s1", "¿Qué se paga por el concepto 250?", [document_id])
+
+    sent = prefill_payloads[0]["prompt"]
+    assert real["prompt"].startswith(sent)
+    assert sent.endswith(app.QUESTION_PREFIX)
+    assert "Clausula 0:" in sent
+
+
+def test_small_model_only_for_short_prompts_without_documents(monkeypatch):
+    monkeypatch.setattr(app, "MODEL_SMALL", "pequeño")
+    messages = [{"role": "user", "content": "hola"}]
+    assert app.choose_model(app.PromptRequest(prompt="hola"), "", messages) == "pequeño"
+    assert app.choose_model(app.PromptRequest(prompt="hola", file_text="texto"), "", messages) == app.MODEL_NAME
+    assert app.choose_model(app.PromptRequest(prompt="hola", document_ids=["d"]), "", messages) == app.MODEL_NAME
+    assert app.choose_model(app.PromptRequest(prompt="hola"), "Fragmento 1 del archivo...", messages) == app.MODEL_NAME
+    long_messages = [{"role": "user", "content": "palabra " * (app.MODEL_SMALL_MAX_TOKENS + 1)}]
+    assert app.choose_model(app.PromptRequest(prompt="hola"), "", long_messages) == app.MODEL_NAME
@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+import app
+
+
+def test_identical_requests_share_one_generation():
+    async def run():
+        cache = app.ResponseCache(8, 60)
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return {"message": {"content": "respuesta"}}
+
+        results = await asyncio.gather(*(cache.get_or_fetch("clave", fetch) for _ in range(5)))
+        again = await cache.get_or_fetch("clave", fetch)
+        return cache, calls, results, again
+
+    cache, calls, results, again = asyncio.run(run())
+    assert len(calls) == 1
+    assert all(result == {"message": {"content": "respuesta"}} for result in results + [again])
+    assert (cache.misses, cache.coalesced, cache.hits) == (1, 4, 1)
+
+
+def test_failed_generation_is_shared_but_not_cached():
+    async def run():
+        cache = app.ResponseCache(8, 60)
+        calls = []
+
+        async def failing():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            raise RuntimeError("Ollama no responde")
+
+        results = await asyncio.gather(*(cache.get_or_fetch("clave", failing) for _ in range(3)), return_exceptions=True)
+
+        async def working():
+            return {"message": {"content": "ya funciona"}}
+
+        return calls, results, await cache.get_or_fetch("clave", working)
+
+    calls, results, retried = asyncio.run(run())
+    assert len(calls) == 1
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert retried == {"message": {"content": "ya funciona"}}
+
+
+def test_waiters_are_released_when_the_leading_request_is_cancelled():
+    async def run():
+        cache = app.ResponseCache(8, 60)
+
+        async def slow():
+            await asyncio.sleep(10)
+
+        leader = asyncio.create_task(cache.get_or_fetch("clave", slow))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(cache.get_or_fetch("clave", slow))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(follower, 1)
+        return cache
+
+    cache = asyncio.run(run())
+    assert cache._inflight == {}
+
+
+def test_cache_expires_and_is_bounded(monkeypatch):
+    cache = app.ResponseCache(2, 60)
+    for key in ("a", "b", "c"):
+        cache.put(key, {"key": key})
+    assert cache.get("a") is None and cache.get("c") == {"key": "c"}
+    now = app.time.time()
+    monkeypatch.setattr(app.time, "time", lambda: now + 61)
+    assert cache.get("c") is None
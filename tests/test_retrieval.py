@@ -0,0 +1,49 @@
+import app
+
+
+def test_split_chunks_respects_size_and_overlap():
+    text = " ".join(f"palabra{number}" for number in range(2000))
+    chunks = app.split_chunks(text, 500, 100)
+    assert all(len(chunk) <= 500 for chunk in chunks)
+    # Cada fragmento empieza dentro del anterior (solapamiento) y juntos cubren todo el texto
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert chunk.split()[0] in previous
+    assert chunks[0].startswith("palabra0 ") and chunks[-1].endswith("palabra1999")
+
+
+def test_tokenize_ignores_case_accents_and_stopwords():
+    assert app.tokenize("La Información del CONTRATO") == ["informacion", "contrato"]
+
+
+def index_with(*documents):
+    index = app.RetrievalIndex(8, 8)
+    for doc_id, (name, text) in enumerate(documents):
+        index.add("s1", str(doc_id), name, app.ChunkIndex(text))
+    return index
+
+
+def test_search_returns_the_matching_chunk_in_document_order():
+    text = "\n".join(f"Seccion {number}: " + ("relleno " * 30) for number in range(50))
+    text += "\nSeccion final: la fianza es de dos mensualidades."
+    index = index_with(("contrato.txt", text))
+    results = index.search("s1", "¿De cuánto es la fianza?", 3)
+    assert results
+    name, chunk_index, chunk_id = results[0]
+    assert name == "contrato.txt" and "fianza" in chunk_index.chunks[chunk_id]
+    assert [chunk for _, _, chunk in results] == sorted(chunk for _, _, chunk in results)
+
+
+def test_search_without_matches_only_falls_back_when_asked():
+    index = index_with(("a.txt", "manzanas y peras " * 200), ("b.txt", "coches y motos " * 200))
+    assert index.search("s1", "astronomia", 2) == []
+    results = index.search("s1", "astronomia", 2, fallback=True)
+    # Los primeros fragmentos del documento más reciente
+    assert [(name, chunk_id) for name, _, chunk_id in results] == [("b.txt", 0), ("b.txt", 1)]
+
+
+def test_index_is_bounded_per_document():
+    index = app.RetrievalIndex(2, 8)
+    for doc_id in "abc":
+        index.add("s1", doc_id, doc_id, app.ChunkIndex("texto " * 10))
+    assert index.get("a") is None
+    assert index.document_ids("s1") == ["b", "c"]
@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import app
+
+
+async def admit_order(scheduler, requests):
+    """Encola `requests` (sesión, prioridad, nombre) con el único hueco ocupado y devuelve el orden en que entran"""
+    order = []
+    held = await scheduler.acquire("ocupado")
+
+    async def worker(session_id, priority, name):
+        async with scheduler.slot(session_id, priority):
+            order.append(name)
+
+    tasks = []
+    for request in requests:
+        tasks.append(asyncio.create_task(worker(*request)))
+        await asyncio.sleep(0)
+    scheduler.release(held)
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_scheduler_serves_by_priority_then_round_robin():
+    scheduler = app.FairScheduler(1, 10, 5)
+    requests = [
+        ("a", 1, "a1"), ("a", 1, "a2"), ("a", 1, "a3"),
+        ("b", 1, "b1"),
+        ("c", 2, "c1"),
+        (None, 0, "interno"),
+    ]
+    assert asyncio.run(admit_order(scheduler, requests)) == ["interno", "a1", "b1", "a2", "a3", "c1"]
+    assert scheduler.active == 0 and scheduler.queued == 0
+
+
+def test_scheduler_rejects_with_429_when_queue_is_full():
+    async def run():
+        scheduler = app.FairScheduler(1, 1, 5)
+        held = await scheduler.acquire("a")
+        waiting = asyncio.create_task(scheduler.acquire("b"))
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as error:
+            await scheduler.acquire("c")
+        scheduler.release(held)
+        scheduler.release(await waiting)
+        return error.value, scheduler
+
+    error, scheduler = asyncio.run(run())
+    assert error.status_code == 429 and "Retry-After" in error.headers
+    assert scheduler.rejected == 1 and scheduler.active == 0
+
+
+def test_scheduler_times_out_with_503_and_frees_the_queue():
+    async def run():
+        scheduler = app.FairScheduler(1, 5, 0.05)
+        held = await scheduler.acquire("a")
+        with pytest.raises(HTTPException) as error:
+            await scheduler.acquire("b")
+        scheduler.release(held)
+        return error.value, scheduler
+
+    error, scheduler = asyncio.run(run())
+    assert error.status_code == 503
+    assert scheduler.timeouts == 1 and scheduler.queued == 0 and scheduler.active == 0
+
+
+def test_clients_cannot_jump_the_queue():
+    assert app.client_priority(app.PromptRequest(prompt="hola", priority=0)) == 1
+    assert app.client_priority(app.PromptRequest(prompt="hola", priority=2)) == 2
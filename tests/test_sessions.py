@@ -0,0 +1,154 @@
+import asyncio
+
+import pytest
+
+import app
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def session_store(request, tmp_path):
+    if request.param == "sqlite":
+        return app.SqliteSessionStore(str(tmp_path / "sessions.db"), 3, 2, 60)
+    return app.MemorySessionStore(3, 2, 60)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def document_store(request, tmp_path):
+    if request.param == "sqlite":
+        return app.SqliteDocumentStore(str(tmp_path / "sessions.db"), 100, 60)
+    return app.MemoryDocumentStore(100, 60)
+
+
+def entry(number: int) -> dict:
+    return {"id": str(number), "user_input": f"pregunta {number}", "model_response": f"respuesta {number}", "Former_document_text": "", "timestamp": "10:00"}
+
+
+def test_session_store_keeps_the_last_entries(session_store):
+    for number in range(5):
+        session_store.append("s1", entry(number))
+    assert [item["id"] for item in session_store.history("s1")] == ["2", "3", "4"]
+    assert session_store.history("otra") == []
+
+
+def test_session_store_summary_and_clear(session_store):
+    session_store.set_summary("s1", {"text": "nada"})
+    assert session_store.summary("s1") is None  # Sin sesión no se guarda
+    session_store.append("s1", entry(0))
+    session_store.set_summary("s1", {"text": "resumen", "through": 1, "turns": 1, "document_ids": ["d"]})
+    assert session_store.summary("s1")["document_ids"] == ["d"]
+    session_store.clear("s1")
+    assert session_store.history("s1") == [] and session_store.summary("s1") is None
+
+
+def test_session_store_evicts_the_least_recently_used_session(session_store):
+    for session_id in ("a", "b", "c"):
+        session_store.append(session_id, entry(0))
+    assert session_store.history("a") == []
+    assert session_store.stats()["sessions"] == 2
+
+
+def test_document_store_deduplicates_and_evicts_unreferenced_first(document_store):
+    first = document_store.put("s1", "a.txt", "documento", "a" * 40, 40)
+    assert document_store.put("s2", "copia.txt", "documento", "a" * 40, 10) == first
+    assert document_store.stats()["documents"] == 1
+    assert document_store.get("s3", first)["chars"] == 40
+
+    unused = document_store.put("s4", "b.txt", "documento", "b" * 40, 40)
+    document_store.release("s4")
+    document_store.put("s5", "c.txt", "documento", "c" * 40, 40)
+    # Sobran 20 bytes: se va el documento que ya no usa nadie aunque se usara después que el primero
+    assert document_store.get("s4", unused) is None
+    assert document_store.get("s1", first) is not None
+
+
+def test_document_store_keeps_the_file_name_per_session(document_store):
+    doc_id = document_store.put("s1", "nomina_ana.pdf", "pdf", "a" * 40, 40)
+    document_store.put("s2", "copia.txt", "documento", "a" * 40, 40)
+    assert (document_store.get("s1", doc_id)["name"], document_store.get("s1", doc_id)["file_type"]) == ("nomina_ana.pdf", "pdf")
+    assert (document_store.get("s2", doc_id)["name"], document_store.get("s2", doc_id)["file_type"]) == ("copia.txt", "documento")
+    assert document_store.get("s3", doc_id)["name"] == app.UNNAMED_DOCUMENT
+    assert document_store.get("s3", doc_id)["name"] == app.UNNAMED_DOCUMENT
+
+
+def test_pending_turns_skips_what_the_summary_covers():
+    history = [{**entry(number), "seq": number + 1} for number in range(4)]
+    assert app.pending_turns(history, None) == history
+    assert app.pending_turns(history, {"through": 2}) == history[2:]
+    # Resúmenes antiguos que guardaban el id del último intercambio
+    assert app.pending_turns(history, {"through": "1"}) == history[2:]
+    assert app.pending_turns(history, {"through": "ya no está"}) == history
+
+
+def test_pending_turns_after_the_summarized_turn_is_evicted(session_store):
+    for number in range(3):
+        session_store.append("s1", entry(number))
+    through = session_store.history("s1")[1]["seq"]
+    session_store.set_summary("s1", {"text": "resumen", "through": through, "turns": 2})
+    for number in range(3, 5):
+        session_store.append("s1", entry(number))
+
+    # Solo quedan los intercambios 2, 3 y 4: el 1 se descartó pero sigue resumido
+    history = session_store.history("s1")
+    assert [item["id"] for item in app.pending_turns(history, session_store.summary("s1"))] == ["2", "3", "4"]
+    assert [item["seq"] for item in history] == sorted({item["seq"] for item in history})
+
+
+def test_compactor_folds_old_turns_in_batches(stores, monkeypatch):
+    monkeypatch.setattr(app, "HISTORY_SUMMARY", True)
+    compactor = app.HistoryCompactor(recent_turns=2, batch=2, max_tokens=50, model="")
+    folded = []
+
+    async def summarize(session_id, summary, turns):
+        folded.append([turn["id"] for turn in turns])
+        return f"resumen hasta {turns[-1]['id']}"
+
+    monkeypatch.setattr(compactor, "summarize", summarize)
+    for number in range(3):
+        app.session_store.append("s1", {**entry(number), "document_ids": [f"doc{number}"]})
+    asyncio.run(compactor._run("s1"))
+    assert folded == []  # Solo hay un intercambio fuera de la ventana: aún no se resume
+
+    for number in range(3, 6):
+        app.session_store.append("s1", {**entry(number), "document_ids": [f"doc{number}"]})
+    asyncio.run(compactor._run("s1"))
+    assert folded == [["0", "1", "2", "3"]]
+    summary = app.session_store.summary("s1")
+    seqs = {item["id"]: item["seq"] for item in app.session_store.history("s1")}
+    assert summary["through"] == seqs["3"] and summary["turns"] == 4
+    assert summary["document_ids"] == ["doc0", "doc1", "doc2", "doc3"]
+
+    # En el prompt van el resumen y solo los intercambios que no cubre
+    messages = app.build_messages(app.PromptRequest(prompt="¿y ahora?"), "", "s1")
+    assert "resumen hasta 3" in messages[1]["content"]
+    assert [message["content"].split("Usuario: ")[-1] for message in messages if message["role"] == "user"][:-1] == ["pregunta 4", "pregunta 5"]
+
+
+def test_incomplete_backends_fail_when_created():
+    class HistoryOnly(app.SessionStore):
+        def history(self, session_id):
+            return []
+
+    class PutOnly(app.DocumentStore):
+        def put(self, session_id, name, file_type, text, chars):
+            return ""
+
+    with pytest.raises(TypeError):
+        HistoryOnly(3, 2, 60)
+    with pytest.raises(TypeError):
+        PutOnly(100, 60)
+
+
+def test_save_history_writes_outside_the_event_loop(stores, monkeypatch):
+    import threading
+
+    threads = []
+    append = app.session_store.append
+
+    def recording(session_id, entry):
+        threads.append(threading.current_thread())
+        append(session_id, entry)
+
+    monkeypatch.setattr(app.session_store, "append", recording)
+    asyncio.run(app.save_history("s1", app.PromptRequest(prompt="hola"), "adiós"))
+    assert threads and threads[0] is not threading.main_thread()
+    assert app.session_store.history("s1")[0]["model_response"] == "adiós"